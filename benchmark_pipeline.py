@@ -0,0 +1,184 @@
+"""
+Benchmark do pipeline de entrada (utils.create_image_dataset), sem nenhum modelo.
+
+Mede, para cada combinação de paralelismo, cache, random jitter, IMG_SIZE e batch size:
+- imagens / segundo
+- latência p50 e p99 de cada batch
+- pico de memória residente (RSS) do processo
+
+Cada configuração roda em um subprocesso próprio, para que o pico de RSS e o cache em memória
+de uma configuração não interfiram nas outras. Por padrão é usado um dataset sintético de JPEGs
+gerados aleatoriamente (1024 x 1024, como o CelebA-HQ), então o benchmark não depende do dataset real.
+
+Uso:
+    python benchmark_pipeline.py
+    python benchmark_pipeline.py --parallel 1 4 -1 --cache 0 1 --jitter 0 1 --img_size 128 256 --batch_size 6 16
+    python benchmark_pipeline.py --dataset_folder ../../0_Datasets/celeba_hq/ --dataset_filter_string "*/*.jpg"
+
+Com --parallel -1 o paralelismo é AUTOTUNE.
+"""
+
+# Imports
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import subprocess
+import numpy as np
+
+# Tensorflow
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+import tensorflow as tf
+
+# Módulos próprios
+import utils
+
+# O módulo resource só existe em sistemas Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# %% DATASET SINTÉTICO
+
+def generate_synthetic_dataset(dataset_folder, num_images, image_size=1024, labels=('male', 'female'), seed=0):
+    """Gera um dataset de JPEGs aleatórios em dataset_folder/train/<label>/, se ele ainda não existir.
+
+    As imagens são gradientes com ruído, para que o JPEG tenha um tamanho próximo ao de uma foto.
+    """
+    rng = np.random.default_rng(seed)
+    for i in range(num_images):
+        label = labels[i % len(labels)]
+        image_path = os.path.join(dataset_folder, 'train', label, f'{i:06d}.jpg')
+        if os.path.exists(image_path):
+            continue
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+
+        gradient = np.linspace(0, 255, image_size, dtype=np.float32)
+        image = (gradient[None, :, None] + gradient[:, None, None]) / 2 * rng.uniform(0.3, 1.0, size=3)
+        image = image + rng.normal(0, 20, size=(image_size, image_size, 3))
+        image = np.clip(image, 0, 255).astype(np.uint8)
+        tf.io.write_file(image_path, tf.io.encode_jpeg(image, quality=95))
+
+
+# %% BENCHMARK
+
+def run_benchmark(file_pattern, img_size, batch_size, num_parallel_calls, use_cache, use_jitter, num_batches, reduced_decoding):
+    """Roda o pipeline de treino de uma configuração e mede vazão, latência dos batches e pico de memória."""
+    files_ds = tf.data.Dataset.list_files(file_pattern, shuffle=True)
+    num_images = int(files_ds.cardinality().numpy())
+    dataset = utils.create_image_dataset(files_ds, 'train', img_size, 3, batch_size, use_jitter=use_jitter, use_cache=use_cache,
+                                         shuffle_buffer=100, deterministic=False, reduced_decoding=reduced_decoding,
+                                         num_parallel_calls=num_parallel_calls)
+    iterator = iter(dataset.repeat())
+
+    # Aquecimento: com cache, uma época inteira (preenche o cache); sem cache, alguns batches
+    warmup_batches = int(np.ceil(num_images / batch_size)) if use_cache else 5
+    for _ in range(warmup_batches):
+        next(iterator)
+
+    latencies = []
+    num_read = 0
+    t_start = time.perf_counter()
+    for _ in range(num_batches):
+        t = time.perf_counter()
+        batch = next(iterator)
+        latencies.append(time.perf_counter() - t)
+        num_read += int(batch.shape[0])
+    dt = time.perf_counter() - t_start
+
+    # ru_maxrss é dado em KB no Linux e em bytes no macOS
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_rss_mb = peak_rss / 1024**2 if sys.platform == 'darwin' else peak_rss / 1024
+    else:
+        peak_rss_mb = None
+
+    results = {
+        'images_per_sec': num_read / dt,
+        'p50_batch_latency_ms': float(np.percentile(latencies, 50)) * 1000,
+        'p99_batch_latency_ms': float(np.percentile(latencies, 99)) * 1000,
+        'peak_rss_mb': peak_rss_mb,
+    }
+    return results
+
+
+def run_in_subprocess(run_config):
+    """Roda uma configuração em um novo processo Python e retorna os resultados."""
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', json.dumps(run_config)],
+                            capture_output=True, text=True)
+    if output.returncode != 0:
+        print(output.stderr)
+        raise BaseException(f"Erro no benchmark da configuração {run_config}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def print_results_table(all_results):
+    """Imprime os resultados em forma de tabela."""
+    header = f"{'paralelo':>8} {'cache':>5} {'jitter':>6} {'img':>4} {'batch':>5} | {'img/s':>8} {'p50 (ms)':>9} {'p99 (ms)':>9} {'RSS (MB)':>9}"
+    print(header)
+    print('-' * len(header))
+    for run_config, results in all_results:
+        parallel = 'auto' if run_config['num_parallel_calls'] == tf.data.AUTOTUNE else run_config['num_parallel_calls']
+        rss = f"{results['peak_rss_mb']:9.0f}" if results['peak_rss_mb'] is not None else f"{'-':>9}"
+        print(f"{parallel:>8} {run_config['use_cache']:>5} {run_config['use_jitter']:>6} {run_config['img_size']:>4} {run_config['batch_size']:>5} | "
+              f"{results['images_per_sec']:8.1f} {results['p50_batch_latency_ms']:9.2f} {results['p99_batch_latency_ms']:9.2f} {rss}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark do pipeline de entrada (sem modelo)")
+    parser.add_argument('--dataset_folder', default=None, help="Pasta do dataset. Se omitida, usa um dataset sintético")
+    parser.add_argument('--dataset_filter_string', default='*/*.jpg', help="Filtro dos arquivos dentro de <dataset_folder>/train/")
+    parser.add_argument('--synthetic_folder', default='./benchmark_dataset/', help="Pasta onde o dataset sintético é gerado")
+    parser.add_argument('--synthetic_images', type=int, default=512, help="Número de imagens do dataset sintético")
+    parser.add_argument('--parallel', type=int, nargs='+', default=[1, 4, tf.data.AUTOTUNE], help="num_parallel_calls (-1 = AUTOTUNE)")
+    parser.add_argument('--cache', type=int, nargs='+', default=[0, 1], help="Cache em memória desligado / ligado")
+    parser.add_argument('--jitter', type=int, nargs='+', default=[0, 1], help="Random jitter desligado / ligado")
+    parser.add_argument('--img_size', type=int, nargs='+', default=[128, 256], help="IMG_SIZE")
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[6, 16], help="Tamanho do batch")
+    parser.add_argument('--num_batches', type=int, default=50, help="Batches medidos em cada configuração")
+    parser.add_argument('--no_reduced_decoding', action='store_true', help="Desliga a decodificação reduzida do JPEG")
+    parser.add_argument('--output_json', default=None, help="Arquivo para salvar os resultados")
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)  # Uso interno: roda uma única configuração
+    args = parser.parse_args()
+
+    # Subprocesso: roda uma configuração e devolve o resultado como JSON
+    if args.run is not None:
+        run_config = json.loads(args.run)
+        results = run_benchmark(**run_config)
+        print(json.dumps(results))
+        sys.exit(0)
+
+    if args.dataset_folder is None:
+        print(f"Gerando o dataset sintético em {args.synthetic_folder}...")
+        generate_synthetic_dataset(args.synthetic_folder, args.synthetic_images)
+        file_pattern = os.path.join(args.synthetic_folder, 'train', '*', '*.jpg')
+    else:
+        file_pattern = args.dataset_folder + 'train/' + args.dataset_filter_string
+
+    all_results = []
+    for parallel, cache, jitter, img_size, batch_size in itertools.product(args.parallel, args.cache, args.jitter, args.img_size, args.batch_size):
+        run_config = {
+            'file_pattern': file_pattern,
+            'img_size': img_size,
+            'batch_size': batch_size,
+            'num_parallel_calls': parallel,
+            'use_cache': bool(cache),
+            'use_jitter': bool(jitter),
+            'num_batches': args.num_batches,
+            'reduced_decoding': not args.no_reduced_decoding,
+        }
+        print(f"Rodando {run_config}")
+        results = run_in_subprocess(run_config)
+        all_results.append((run_config, results))
+
+    print("")
+    print_results_table(all_results)
+
+    if args.output_json is not None:
+        with open(args.output_json, 'w') as f:
+            json.dump([{**run_config, **results} for run_config, results in all_results], f, indent=4)
@@ -0,0 +1,431 @@
+"""
+Benchmark da precisão mista no treinamento (float32 x mixed_float16 / mixed_bfloat16).
+
+A política mista é escolhida pelo hardware (utils.get_mixed_precision_policy): float16 nas GPUs com compute capability 7.0
+ou maior e bfloat16 nas CPUs com AVX512_BF16 / AMX. Sem suporte, as duas execuções usam float32.
+
+Para cada política de precisão, cria o gerador e o discriminador, treina por alguns passos com os mesmos dados
+e a mesma semente, e mede:
+- tempo médio do passo de treinamento (sem os passos de aquecimento / tracing)
+- pico de memória (da GPU, se houver, ou RSS do processo)
+- qualidade do gerador treinado: L1 e FID em uma amostra de imagens
+
+A diferença de qualidade entre as políticas só aparece depois de alguns milhares de passos, por isso o padrão de
+--train_steps é 2000. Para medir apenas o tempo do passo e a memória, algumas centenas de passos bastam.
+
+Cada política roda em um subprocesso próprio, porque a política do Keras é global e vale para os modelos criados depois dela.
+Os passos medidos são os do trainer.Trainer, os mesmos do main.py (com --accumulation_steps e --n_critic, cada passo
+é uma iteração completa, com vários batches).
+
+Com --jit_report, em vez da comparação de precisão, o passo de treinamento é compilado com e sem XLA (jit_compile)
+para todas as combinações de gerador / discriminador do main.py, e são reportados o tempo de compilação, o tempo
+dos passos seguintes e a diferença da loss entre os dois modos.
+
+Com --recompute_report, o passo de treinamento roda com e sem a recomputação das ativações dos blocos residuais
+do gerador (gradient checkpointing, RECOMPUTE_RESIDUAL_BLOCKS do main.py) para cada tamanho de batch em
+--recompute_batch_sizes, e são reportados o tempo do passo e o pico de memória de cada modo.
+
+Uso:
+    python benchmark_training.py
+    python benchmark_training.py --jit_report --img_size 128 --batch_size 6
+    python benchmark_training.py --recompute_report --gen_model full_residual --recompute_batch_sizes 6 12 24
+    python benchmark_training.py --gen_model full_residual --disc_model progan --loss_type wgan-gp --img_size 128 --batch_size 6
+    python benchmark_training.py --dataset_folder ../../0_Datasets/celeba_hq/ --train_steps 5000
+    python benchmark_training.py --train_steps 300  # apenas tempo do passo e memória
+"""
+
+# Imports
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+# Tensorflow
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+import tensorflow as tf
+
+# Módulos próprios
+import utils
+import metrics
+import trainer
+import networks_general as net
+import networks_resnet as rn
+import benchmark_pipeline
+
+# O módulo resource só existe em sistemas Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# %% MODELOS E TREINADOR
+
+# Modelos do main.py (exceto o 'transfer', que depende de um gerador salvo)
+GEN_MODELS = ['pix2pix', 'unet', 'residual', 'residual_vetor', 'full_residual', 'simple_decoder', 'resnet_adaptado']
+DISC_MODELS = ['patchgan', 'progan_adapted', 'progan', 'residual', 'resnet_adaptado']
+
+
+def create_models(gen_model, disc_model, img_size, num_channels, norm_type, loss_type, disentanglement='smooth', num_residual_blocks=6,
+                  recompute=False):
+    """Cria o gerador e o discriminador (None no treinamento não adversário), como no main.py"""
+    if gen_model == 'pix2pix':
+        generator = net.pix2pix_generator(img_size, num_channels, norm_type)
+    elif gen_model == 'unet':
+        generator = net.unet_generator(img_size, num_channels, norm_type)
+    elif gen_model == 'residual':
+        generator = net.residual_generator(img_size, num_channels, norm_type, num_residual_blocks=num_residual_blocks, recompute=recompute)
+    elif gen_model == 'residual_vetor':
+        generator = net.residual_generator(img_size, num_channels, norm_type, create_latent_vector=True, num_residual_blocks=num_residual_blocks, recompute=recompute)
+    elif gen_model == 'full_residual':
+        generator = net.full_residual_generator(img_size, num_channels, norm_type, disentanglement=disentanglement, num_residual_blocks=num_residual_blocks, recompute=recompute)
+    elif gen_model == 'simple_decoder':
+        generator = net.simple_decoder_generator(img_size, num_channels, norm_type, disentanglement=disentanglement, num_residual_blocks=num_residual_blocks, recompute=recompute)
+    elif gen_model == 'resnet_adaptado':
+        generator = rn.resnet_adapted_generator(img_size, num_channels, norm_type, disentanglement=disentanglement, recompute=recompute)
+    else:
+        raise utils.GeneratorError(gen_model)
+
+    if loss_type == 'l1' or loss_type == 'l2':
+        return generator, None
+
+    constrained = loss_type == 'wgan'
+    if disc_model == 'patchgan':
+        disc = net.patchgan_discriminator(img_size, num_channels, constrained=constrained)
+    elif disc_model == 'progan_adapted':
+        disc = net.progan_discriminator(img_size, num_channels, constrained=constrained, output_type='patchgan')
+    elif disc_model == 'progan':
+        disc = net.progan_discriminator(img_size, num_channels, constrained=constrained, output_type='unit')
+    elif disc_model == 'residual':
+        disc = net.residual_discriminator(img_size, num_channels, constrained=constrained)
+    elif disc_model == 'resnet_adaptado':
+        disc = rn.resnet_adapted_discriminator(img_size, num_channels, norm_type)
+    else:
+        raise utils.DiscriminatorError(disc_model)
+    return generator, disc
+
+
+def create_trainer(generator, disc, loss_type, img_size, policy='float32', jit_compile=False, accumulation_steps=1, n_critic=1):
+    """Cria os otimizadores e o trainer.Trainer, com os mesmos passos compilados usados no main.py"""
+    beta_1 = 0.5 if loss_type == 'patchganloss' else 0.9
+    generator_optimizer = utils.get_optimizer(1e-5, beta_1, policy)
+    discriminator_optimizer = utils.get_optimizer(1e-5, beta_1, policy) if disc is not None else None
+    batched_discriminator = disc is not None and not utils.has_batch_normalization(disc)
+    return trainer.Trainer(generator, disc, generator_optimizer, discriminator_optimizer, loss_type, img_size, 3,
+                           accumulation_steps=accumulation_steps, n_critic=n_critic, batched_discriminator=batched_discriminator,
+                           jit_compile=jit_compile)
+
+
+def make_train_call(gan_trainer, iterator):
+    """Retorna uma função que faz uma iteração de treinamento (train_multiple_steps com num_steps = 1), como no main.py,
+    e retorna a loss total do gerador. Com accumulation_steps ou n_critic > 1, a iteração lê vários batches do iterador."""
+    num_steps = tf.constant(1)
+
+    def train_call():
+        losses_train = gan_trainer.train_multiple_steps(iterator, num_steps)
+        return losses_train['gen_total_loss'][-1]
+
+    return train_call
+
+
+# %% BENCHMARK
+
+def get_peak_memory_mb():
+    """Pico de memória da GPU (se houver) ou do processo (RSS), em MB"""
+    if len(tf.config.list_physical_devices('GPU')) > 0:
+        return tf.config.experimental.get_memory_info('GPU:0')['peak'] / 1024**2
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss / 1024**2 if sys.platform == 'darwin' else peak_rss / 1024
+    return None
+
+
+def run_benchmark(mixed_precision, file_pattern, gen_model, disc_model, loss_type, norm_type, img_size, batch_size,
+                  train_steps, warmup_steps, eval_batches, seed, accumulation_steps=1, n_critic=1):
+    """Treina com uma política de precisão e mede tempo de passo, pico de memória e qualidade (L1 / FID)."""
+    policy = utils.set_precision_policy(mixed_precision)
+    tf.keras.utils.set_random_seed(seed)
+
+    files_ds = tf.data.Dataset.list_files(file_pattern, shuffle=True, seed=seed)
+    train_ds = utils.create_image_dataset(files_ds, 'train', img_size, 3, batch_size, use_cache=True, shuffle_buffer=100,
+                                          drop_remainder=True, reduced_decoding=True).repeat()
+    eval_ds = utils.create_image_dataset(files_ds, 'test', img_size, 3, 1, reduced_decoding=True).take(eval_batches)
+
+    generator, disc = create_models(gen_model, disc_model, img_size, 3, norm_type, loss_type)
+    gan_trainer = create_trainer(generator, disc, loss_type, img_size, policy, accumulation_steps=accumulation_steps, n_critic=n_critic)
+    train_call = make_train_call(gan_trainer, iter(train_ds))
+
+    # Aquecimento (tracing e preenchimento do cache)
+    for _ in range(warmup_steps):
+        float(train_call())
+
+    # Os passos são sincronizados (float) para que o tempo medido seja o do passo inteiro (incluindo a leitura do batch)
+    step_times = []
+    for _ in range(train_steps):
+        t = time.perf_counter()
+        float(train_call())
+        step_times.append(time.perf_counter() - t)
+
+    peak_memory_mb = get_peak_memory_mb()
+    metric_results = metrics.evaluate_metrics(eval_ds, generator, False, True, True, num_batches=eval_batches)
+
+    results = {
+        'policy': policy,
+        'mean_step_time_ms': float(np.mean(step_times)) * 1000,
+        'p50_step_time_ms': float(np.percentile(step_times, 50)) * 1000,
+        'peak_memory_mb': peak_memory_mb,
+        'l1_avg': float(metric_results['l1_avg']),
+        'fid_avg': float(metric_results['fid_avg']),
+    }
+    return results
+
+
+def run_jit_check(gen_model, disc_model, loss_type, norm_type, img_size, batch_size, steps, seed, accumulation_steps=1, n_critic=1):
+    """Compara o passo de treinamento com e sem XLA (jit_compile) para uma combinação de gerador / discriminador / loss.
+
+    Para cada modo, mede o tempo da primeira chamada (tracing + compilação) separado do tempo médio dos passos seguintes,
+    e verifica se a loss do primeiro passo é a mesma nos dois modos (mesmos pesos iniciais e mesmo batch).
+    """
+    images = tf.random.stateless_uniform([batch_size, img_size, img_size, 3], seed=[seed, 0], minval=-1, maxval=1)
+    results = {}
+    for jit_compile in [False, True]:
+        tf.keras.utils.set_random_seed(seed)
+        generator, disc = create_models(gen_model, disc_model, img_size, 3, norm_type, loss_type)
+        gan_trainer = create_trainer(generator, disc, loss_type, img_size, jit_compile=jit_compile, accumulation_steps=accumulation_steps,
+                                     n_critic=n_critic)
+        train_call = make_train_call(gan_trainer, iter(tf.data.Dataset.from_tensors(images).repeat()))
+
+        t = time.perf_counter()
+        first_loss = float(train_call())
+        compile_time = time.perf_counter() - t
+
+        t = time.perf_counter()
+        for _ in range(steps):
+            loss = train_call()
+        float(loss)
+        step_time = (time.perf_counter() - t) / steps
+
+        mode = 'xla' if jit_compile else 'graph'
+        results[f'{mode}_compile_time_s'] = compile_time
+        results[f'{mode}_step_time_ms'] = step_time * 1000
+        results[f'{mode}_first_loss'] = first_loss
+
+    results['loss_diff'] = abs(results['xla_first_loss'] - results['graph_first_loss'])
+    return results
+
+
+def run_recompute_check(gen_model, disc_model, loss_type, norm_type, img_size, batch_size, steps, seed, recompute, accumulation_steps=1,
+                        n_critic=1):
+    """Mede o tempo do passo de treinamento e o pico de memória com ou sem a recomputação dos blocos residuais.
+
+    Cada modo roda em um subprocesso próprio, pois o pico de memória (RSS) não pode ser zerado dentro do processo.
+    """
+    images = tf.random.stateless_uniform([batch_size, img_size, img_size, 3], seed=[seed, 0], minval=-1, maxval=1)
+    tf.keras.utils.set_random_seed(seed)
+    generator, disc = create_models(gen_model, disc_model, img_size, 3, norm_type, loss_type, recompute=recompute)
+    gan_trainer = create_trainer(generator, disc, loss_type, img_size, accumulation_steps=accumulation_steps, n_critic=n_critic)
+    train_call = make_train_call(gan_trainer, iter(tf.data.Dataset.from_tensors(images).repeat()))
+
+    # Aquecimento (tracing)
+    first_loss = float(train_call())
+
+    t = time.perf_counter()
+    for _ in range(steps):
+        loss = train_call()
+    float(loss)
+    step_time = (time.perf_counter() - t) / steps
+
+    results = {
+        'step_time_ms': step_time * 1000,
+        'peak_memory_mb': get_peak_memory_mb(),
+        'first_loss': first_loss,
+    }
+    return results
+
+
+def run_in_subprocess(run_config):
+    """Roda uma configuração em um novo processo Python e retorna os resultados."""
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', json.dumps(run_config)],
+                            capture_output=True, text=True)
+    if output.returncode != 0:
+        print(output.stderr)
+        raise BaseException(f"Erro no benchmark da configuração {run_config}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark da precisão mista no treinamento")
+    parser.add_argument('--dataset_folder', default=None, help="Pasta do dataset. Se omitida, usa o dataset sintético do benchmark_pipeline.py")
+    parser.add_argument('--dataset_filter_string', default='*/*.jpg', help="Filtro dos arquivos dentro de <dataset_folder>/train/")
+    parser.add_argument('--synthetic_folder', default='./benchmark_dataset/', help="Pasta onde o dataset sintético é gerado")
+    parser.add_argument('--synthetic_images', type=int, default=512, help="Número de imagens do dataset sintético")
+    parser.add_argument('--gen_model', default='full_residual', help="'pix2pix', 'unet', 'residual' ou 'full_residual'")
+    parser.add_argument('--disc_model', default='progan', help="'patchgan', 'progan' ou 'residual'")
+    parser.add_argument('--loss_type', default='wgan-gp', help="'patchganloss', 'wgan', 'wgan-gp', 'l1' ou 'l2'")
+    parser.add_argument('--norm_type', default='instancenorm', help="'batchnorm', 'instancenorm' ou 'pixelnorm'")
+    parser.add_argument('--img_size', type=int, default=128, help="IMG_SIZE")
+    parser.add_argument('--batch_size', type=int, default=6, help="Tamanho do batch")
+    parser.add_argument('--train_steps', type=int, default=2000, help="Passos de treinamento medidos (a comparação de L1 / FID precisa de milhares)")
+    parser.add_argument('--warmup_steps', type=int, default=10, help="Passos de aquecimento (não medidos)")
+    parser.add_argument('--eval_batches', type=int, default=50, help="Imagens usadas no cálculo de L1 / FID")
+    parser.add_argument('--seed', type=int, default=0, help="Semente aleatória (a mesma para as duas políticas)")
+    parser.add_argument('--accumulation_steps', type=int, default=1, help="ACCUMULATION_STEPS (micro-batches por iteração)")
+    parser.add_argument('--n_critic', type=int, default=1, help="N_CRITIC (atualizações do discriminador por iteração)")
+    parser.add_argument('--output_json', default=None, help="Arquivo para salvar os resultados")
+    parser.add_argument('--jit_report', action='store_true', help="Valida o jit_compile (XLA) em todas as combinações de modelos")
+    parser.add_argument('--jit_steps', type=int, default=20, help="Passos medidos em cada modo do relatório do XLA")
+    parser.add_argument('--recompute_report', action='store_true', help="Compara tempo e memória com e sem a recomputação dos blocos residuais")
+    parser.add_argument('--recompute_batch_sizes', type=int, nargs='+', default=None, help="Tamanhos de batch do relatório da recomputação. Padrão = --batch_size")
+    parser.add_argument('--recompute_steps', type=int, default=20, help="Passos medidos em cada modo do relatório da recomputação")
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)  # Uso interno: roda uma única configuração
+    args = parser.parse_args()
+
+    # Subprocesso: roda uma configuração e devolve o resultado como JSON
+    if args.run is not None:
+        run_config = json.loads(args.run)
+        if run_config.pop('jit_check', False):
+            results = run_jit_check(**run_config)
+        elif run_config.pop('recompute_check', False):
+            results = run_recompute_check(**run_config)
+        else:
+            results = run_benchmark(**run_config)
+        print(json.dumps(results))
+        sys.exit(0)
+
+    # Relatório do XLA: valida o jit_compile em todas as combinações de modelos e mede o custo da compilação
+    if args.jit_report:
+        combinations = [(gen_model, disc_model, args.loss_type) for gen_model in GEN_MODELS for disc_model in DISC_MODELS]
+        combinations += [(gen_model, None, 'l1') for gen_model in GEN_MODELS]
+        all_results = []
+        for gen_model, disc_model, loss_type in combinations:
+            run_config = {
+                'jit_check': True,
+                'gen_model': gen_model,
+                'disc_model': disc_model,
+                'loss_type': loss_type,
+                'norm_type': args.norm_type,
+                'img_size': args.img_size,
+                'batch_size': args.batch_size,
+                'steps': args.jit_steps,
+                'seed': args.seed,
+                'accumulation_steps': args.accumulation_steps,
+                'n_critic': args.n_critic,
+            }
+            print(f"Rodando {gen_model} / {disc_model} / {loss_type}...")
+            try:
+                results = run_in_subprocess(run_config)
+            except BaseException:
+                results = None
+            all_results.append(((gen_model, disc_model, loss_type), results))
+
+        print("")
+        header = (f"{'gerador':>16} {'discriminador':>16} {'loss':>12} | {'compilação (s)':>14} {'xla (s)':>8} | "
+                  f"{'passo (ms)':>10} {'xla (ms)':>9} | {'dif. loss':>9}")
+        print(header)
+        print('-' * len(header))
+        for (gen_model, disc_model, loss_type), results in all_results:
+            if results is None:
+                print(f"{gen_model:>16} {str(disc_model):>16} {loss_type:>12} | ERRO")
+                continue
+            print(f"{gen_model:>16} {str(disc_model):>16} {loss_type:>12} | {results['graph_compile_time_s']:14.1f} "
+                  f"{results['xla_compile_time_s']:8.1f} | {results['graph_step_time_ms']:10.1f} {results['xla_step_time_ms']:9.1f} | "
+                  f"{results['loss_diff']:9.2e}")
+
+        if args.output_json is not None:
+            with open(args.output_json, 'w') as f:
+                json.dump([{'gen_model': c[0], 'disc_model': c[1], 'loss_type': c[2], **(r or {})} for c, r in all_results], f, indent=4)
+        sys.exit(0)
+
+    # Relatório da recomputação: troca de memória por tempo da recomputação dos blocos residuais, por tamanho de batch
+    if args.recompute_report:
+        if args.norm_type == 'batchnorm':
+            raise BaseException("A recomputação dos blocos residuais não pode ser usada com batchnorm.")
+        batch_sizes = args.recompute_batch_sizes or [args.batch_size]
+        all_results = []
+        for batch_size in batch_sizes:
+            for recompute in [False, True]:
+                run_config = {
+                    'recompute_check': True,
+                    'gen_model': args.gen_model,
+                    'disc_model': args.disc_model,
+                    'loss_type': args.loss_type,
+                    'norm_type': args.norm_type,
+                    'img_size': args.img_size,
+                    'batch_size': batch_size,
+                    'steps': args.recompute_steps,
+                    'seed': args.seed,
+                    'recompute': recompute,
+                    'accumulation_steps': args.accumulation_steps,
+                    'n_critic': args.n_critic,
+                }
+                print(f"Rodando com batch_size = {batch_size} e recompute = {recompute}...")
+                try:
+                    results = run_in_subprocess(run_config)
+                except BaseException:
+                    results = None  # Ex.: falta de memória
+                all_results.append(((batch_size, recompute), results))
+
+        print("")
+        header = f"{'batch':>6} {'recompute':>10} | {'passo (ms)':>10} {'memória (MB)':>12} | {'dif. loss':>9}"
+        print(header)
+        print('-' * len(header))
+        baseline = {}
+        for (batch_size, recompute), results in all_results:
+            if results is None:
+                print(f"{batch_size:>6} {str(recompute):>10} | ERRO")
+                continue
+            memory = f"{results['peak_memory_mb']:12.0f}" if results['peak_memory_mb'] is not None else f"{'-':>12}"
+            if not recompute:
+                baseline[batch_size] = results['first_loss']
+            loss_diff = abs(results['first_loss'] - baseline[batch_size]) if batch_size in baseline else float('nan')
+            print(f"{batch_size:>6} {str(recompute):>10} | {results['step_time_ms']:10.1f} {memory} | {loss_diff:9.2e}")
+
+        if args.output_json is not None:
+            with open(args.output_json, 'w') as f:
+                json.dump([{'batch_size': c[0], 'recompute': c[1], **(r or {})} for c, r in all_results], f, indent=4)
+        sys.exit(0)
+
+    if args.dataset_folder is None:
+        print(f"Gerando o dataset sintético em {args.synthetic_folder}...")
+        benchmark_pipeline.generate_synthetic_dataset(args.synthetic_folder, args.synthetic_images)
+        file_pattern = os.path.join(args.synthetic_folder, 'train', '*', '*.jpg')
+    else:
+        file_pattern = args.dataset_folder + 'train/' + args.dataset_filter_string
+
+    all_results = []
+    for mixed_precision in [False, True]:
+        run_config = {
+            'mixed_precision': mixed_precision,
+            'file_pattern': file_pattern,
+            'gen_model': args.gen_model,
+            'disc_model': args.disc_model,
+            'loss_type': args.loss_type,
+            'norm_type': args.norm_type,
+            'img_size': args.img_size,
+            'batch_size': args.batch_size,
+            'train_steps': args.train_steps,
+            'warmup_steps': args.warmup_steps,
+            'eval_batches': args.eval_batches,
+            'seed': args.seed,
+            'accumulation_steps': args.accumulation_steps,
+            'n_critic': args.n_critic,
+        }
+        print(f"Rodando com mixed_precision = {mixed_precision}...")
+        all_results.append(run_in_subprocess(run_config))
+
+    print("")
+    header = f"{'política':>15} | {'passo (ms)':>10} {'p50 (ms)':>9} {'memória (MB)':>12} {'L1':>7} {'FID':>9}"
+    print(header)
+    print('-' * len(header))
+    for results in all_results:
+        memory = f"{results['peak_memory_mb']:12.0f}" if results['peak_memory_mb'] is not None else f"{'-':>12}"
+        print(f"{results['policy']:>15} | {results['mean_step_time_ms']:10.1f} {results['p50_step_time_ms']:9.1f} {memory} "
+              f"{results['l1_avg']:7.4f} {results['fid_avg']:9.2f}")
+
+    if args.output_json is not None:
+        with open(args.output_json, 'w') as f:
+            json.dump(all_results, f, indent=4)
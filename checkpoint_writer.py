@@ -0,0 +1,121 @@
+""" Escrita dos checkpoints em segundo plano """
+
+import os
+import uuid
+import queue
+import threading
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Silencia o TF (https://stackoverflow.com/questions/35911252/disable-tensorflow-debugging-information)
+import tensorflow as tf
+
+# %% ESCRITOR ASSÍNCRONO
+
+
+class AsyncCheckpointWriter:
+    """Salva checkpoints sem bloquear o treinamento, no lugar do tf.train.CheckpointManager.
+
+    O save() grava o checkpoint no sistema de arquivos em memória do Tensorflow (ram://), o que copia as variáveis
+    para a memória do host, e uma thread em segundo plano copia os arquivos para a pasta definitiva:
+    - Cada arquivo é escrito com um nome temporário (.tmp) e renomeado no fim (rename atômico), o índice por último.
+      Só então o arquivo 'checkpoint' (usado pelo tf.train.latest_checkpoint) é atualizado, então uma interrupção
+      no meio da escrita mantém o checkpoint anterior como o mais recente.
+    - No máximo max_in_flight checkpoints ficam na memória esperando a escrita. Se houver mais, o save() espera.
+    - Apenas os max_to_keep checkpoints mais recentes são mantidos (None mantém todos).
+
+    Com persist=False (workers que não são o chefe no treinamento distribuído), o checkpoint é gravado em memória,
+    como exige a estratégia, e descartado.
+    Erros da escrita são levantados no save() ou no close() seguinte.
+    """
+
+    def __init__(self, checkpoint, directory, max_to_keep=1, max_in_flight=1, persist=True, checkpoint_name='ckpt'):
+        self.checkpoint = checkpoint
+        self.directory = directory
+        self.max_to_keep = max_to_keep
+        self.persist = persist
+        self.checkpoint_name = checkpoint_name
+        self.in_flight = threading.Semaphore(max_in_flight)
+        self.queue = queue.Queue()
+        self.error = None
+
+        # Checkpoints já existentes na pasta, para que a retenção continue valendo ao retomar o treinamento
+        self.checkpoints = []
+        if persist:
+            tf.io.gfile.makedirs(directory)
+            # Restos de uma escrita interrompida
+            for path in tf.io.gfile.glob(os.path.join(directory, '*.tmp')):
+                tf.io.gfile.remove(path)
+            state = tf.train.get_checkpoint_state(directory)
+            if state is not None:
+                self.checkpoints = list(state.all_model_checkpoint_paths)
+
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def save(self, checkpoint_number):
+        """Grava o checkpoint em memória e agenda a escrita na pasta. Retorna o prefixo do checkpoint na pasta."""
+        self._raise_error()
+        self.in_flight.acquire()
+        name = f'{self.checkpoint_name}-{checkpoint_number}'
+        snapshot_prefix = self.checkpoint.write(f'ram://{uuid.uuid4().hex}/{name}')
+        prefix = os.path.join(self.directory, name)
+        self.queue.put((snapshot_prefix, prefix))
+        return prefix
+
+    def wait(self):
+        """Espera a escrita de todos os checkpoints agendados"""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Espera a escrita dos checkpoints agendados e termina a thread"""
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise BaseException(f"Erro na escrita do checkpoint: {error}")
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            snapshot_prefix, prefix = item
+            try:
+                if self.persist:
+                    self._write(snapshot_prefix, prefix)
+            except Exception as e:
+                self.error = e
+            finally:
+                # Libera a vaga antes da limpeza, para que um erro nela não trave o save() seguinte
+                self.in_flight.release()
+                try:
+                    tf.io.gfile.rmtree(os.path.dirname(snapshot_prefix))
+                except Exception as e:
+                    if self.error is None:
+                        self.error = e
+                self.queue.task_done()
+
+    def _write(self, snapshot_prefix, prefix):
+        # O índice é escrito por último: sem ele, os arquivos de dados não formam um checkpoint válido
+        files = sorted(tf.io.gfile.glob(snapshot_prefix + '.*'), key=lambda path: path.endswith('.index'))
+        for source in files:
+            destination = prefix + source[len(snapshot_prefix):]
+            tf.io.gfile.copy(source, destination + '.tmp', overwrite=True)
+            tf.io.gfile.rename(destination + '.tmp', destination, overwrite=True)
+
+        # Atualiza o arquivo 'checkpoint' (escrita atômica) e remove os checkpoints mais antigos
+        self.checkpoints = [path for path in self.checkpoints if path != prefix] + [prefix]
+        removed = []
+        if self.max_to_keep is not None and len(self.checkpoints) > self.max_to_keep:
+            removed = self.checkpoints[:-self.max_to_keep]
+            self.checkpoints = self.checkpoints[-self.max_to_keep:]
+        # (uma cópia da lista, pois o update_checkpoint_state torna os caminhos relativos à pasta na própria lista)
+        tf.compat.v1.train.update_checkpoint_state(self.directory, prefix, all_model_checkpoint_paths=list(self.checkpoints))
+        for old_prefix in removed:
+            for path in tf.io.gfile.glob(old_prefix + '.*'):
+                tf.io.gfile.remove(path)
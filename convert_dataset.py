@@ -0,0 +1,97 @@
+"""
+Converte um dataset de imagens JPEG em shards TFRecord com as imagens já redimensionadas para IMG_SIZE (uint8).
+
+Percorre dataset_folder + split + dataset_filter_string (como o main.py) e grava, para cada split,
+os arquivos <split>-XXXXX-of-YYYYY.tfrecord e <split>.json na pasta utils.get_tfrecord_folder(dataset_folder, IMG_SIZE).
+O nome da pasta de cada imagem (male / female, por exemplo) é guardado como label.
+
+Uso:
+    python convert_dataset.py --dataset_folder ../../0_Datasets/celeba_hq/ --dataset_filter_string "*/*/*.jpg" --img_size 128
+
+Depois da conversão, basta usar config.DATASET_FORMAT = 'tfrecord' no main.py.
+"""
+
+# Imports
+import os
+import json
+import random
+import argparse
+
+# Tensorflow
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+import tensorflow as tf
+
+# Módulos próprios
+import utils
+
+
+def decode_and_resize(image_file, img_size, num_channels):
+    """Lê uma imagem JPEG e a redimensiona para IMG_SIZE, da mesma forma que o load_image_test (mas em uint8)"""
+    image = tf.io.read_file(image_file)
+    image = tf.image.decode_jpeg(image, channels=num_channels)
+    image = utils.resize(image, img_size, img_size)
+    image = tf.cast(image, tf.uint8)
+    return image
+
+
+def convert_split(dataset_folder, dataset_filter_string, split, img_size, num_channels, num_shards, seed=0):
+    """Converte um split (train, test ou val) do dataset em shards TFRecord."""
+
+    # Lista os arquivos e embaralha, para que cada shard tenha imagens de todas as labels
+    image_files = sorted(tf.io.gfile.glob(dataset_folder + split + dataset_filter_string))
+    random.Random(seed).shuffle(image_files)
+    num_images = len(image_files)
+    if num_images == 0:
+        print(f"Nenhuma imagem encontrada para o split {split}")
+        return
+
+    # Prepara a pasta de saída e os writers
+    output_folder = utils.get_tfrecord_folder(dataset_folder, img_size)
+    os.makedirs(output_folder, exist_ok=True)
+    num_shards = min(num_shards, num_images)
+    shard_paths = [output_folder + f'{split}-{i:05d}-of-{num_shards:05d}.tfrecord' for i in range(num_shards)]
+    writers = [tf.io.TFRecordWriter(path) for path in shard_paths]
+
+    # Decodifica as imagens em paralelo
+    files_ds = tf.data.Dataset.from_tensor_slices(image_files)
+    images_ds = files_ds.map(lambda x: decode_and_resize(x, img_size, num_channels), num_parallel_calls=tf.data.AUTOTUNE)
+    images_ds = images_ds.prefetch(tf.data.AUTOTUNE)
+
+    print(f"Convertendo {num_images} imagens do split {split} em {num_shards} shards...")
+    progbar = tf.keras.utils.Progbar(num_images)
+    labels = set()
+    for i, (image_file, image) in enumerate(zip(image_files, images_ds)):
+        # A label é o nome da pasta da imagem
+        label = os.path.basename(os.path.dirname(image_file))
+        labels.add(label)
+        writers[i % num_shards].write(utils.serialize_image_example(image.numpy(), label))
+        progbar.update(i + 1)
+
+    for writer in writers:
+        writer.close()
+
+    # Salva os metadados do split
+    metadata = {
+        'num_images': num_images,
+        'img_size': img_size,
+        'num_channels': num_channels,
+        'num_shards': num_shards,
+        'labels': sorted(labels),
+    }
+    with open(output_folder + f'{split}.json', 'w') as f:
+        json.dump(metadata, f, indent=4)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Converte o dataset em shards TFRecord pré-redimensionados")
+    parser.add_argument('--dataset_folder', default='../../0_Datasets/celeba_hq/', help="Pasta raiz do dataset")
+    parser.add_argument('--dataset_filter_string', default='*/*/*.jpg', help="Filtro dos arquivos, como no main.py")
+    parser.add_argument('--img_size', type=int, default=128, help="IMG_SIZE das imagens convertidas")
+    parser.add_argument('--num_channels', type=int, default=3, help="Número de canais das imagens")
+    parser.add_argument('--num_shards', type=int, default=16, help="Número de shards por split")
+    parser.add_argument('--splits', nargs='+', default=['train', 'test', 'val'], help="Splits a converter")
+    args = parser.parse_args()
+
+    for split in args.splits:
+        convert_split(args.dataset_folder, args.dataset_filter_string, split, args.img_size, args.num_channels, args.num_shards)
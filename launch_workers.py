@@ -0,0 +1,135 @@
+"""
+Inicia o treinamento distribuído do main.py em vários processos locais, um por worker da MultiWorkerMirroredStrategy.
+
+Em uma máquina com muitos núcleos de CPU, um único processo do Tensorflow não consegue usar todos os núcleos
+em modelos convolucionais com batches pequenos. Com vários workers, cada um treina com a sua parte do dataset
+(BATCH_SIZE imagens por step) usando alguns núcleos, e os gradientes são somados entre eles a cada step.
+
+Para cada worker, o launcher:
+- define a variável TF_CONFIG com o cluster local (uma porta livre por worker)
+- limita as threads do Tensorflow (TF_NUM_INTRAOP_THREADS / TF_NUM_INTEROP_THREADS e OMP_NUM_THREADS)
+- opcionalmente fixa o processo em um bloco de núcleos (--pin_cores, apenas Linux)
+
+A saída do worker 0 (chefe) é mostrada no terminal, e a dos demais vai para <log_folder>/worker_<i>.log.
+Se algum worker terminar com erro, os demais são encerrados.
+
+Uso:
+    python launch_workers.py --num_workers 4
+    python launch_workers.py --num_workers 8 --threads_per_worker 8 --pin_cores
+"""
+
+# Imports
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+
+
+def get_free_ports(num_ports):
+    """Retorna portas TCP livres na máquina local"""
+    sockets = []
+    ports = []
+    for _ in range(num_ports):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('localhost', 0))
+        sockets.append(s)
+        ports.append(s.getsockname()[1])
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def get_worker_env(cluster, task_index, threads_per_worker):
+    """Cria as variáveis de ambiente de um worker"""
+    env = os.environ.copy()
+    env['TF_CONFIG'] = json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': task_index}})
+    env['TF_NUM_INTRAOP_THREADS'] = str(threads_per_worker)
+    env['TF_NUM_INTEROP_THREADS'] = str(max(1, threads_per_worker // 4))
+    env['OMP_NUM_THREADS'] = str(threads_per_worker)
+    return env
+
+
+def get_worker_cores(task_index, threads_per_worker):
+    """Retorna o bloco de núcleos de um worker (núcleos consecutivos costumam estar no mesmo socket)"""
+    available_cores = sorted(os.sched_getaffinity(0))
+    start = task_index * threads_per_worker
+    cores = available_cores[start:start + threads_per_worker]
+    if len(cores) == 0:
+        raise BaseException(f"Não há núcleos suficientes para o worker {task_index} com {threads_per_worker} threads")
+    return cores
+
+
+def launch_workers(num_workers, threads_per_worker, script, log_folder, pin_cores=False):
+    """Inicia os workers e espera todos terminarem. Retorna o código de saída (diferente de zero se algum falhar)."""
+    ports = get_free_ports(num_workers)
+    cluster = {'worker': [f'localhost:{port}' for port in ports]}
+    os.makedirs(log_folder, exist_ok=True)
+
+    # Os blocos de núcleos são verificados antes de iniciar qualquer worker
+    if pin_cores:
+        worker_cores = [get_worker_cores(task_index, threads_per_worker) for task_index in range(num_workers)]
+
+    processes = []
+    log_files = []
+    for task_index in range(num_workers):
+        env = get_worker_env(cluster, task_index, threads_per_worker)
+
+        # Apenas o chefe escreve no terminal
+        if task_index == 0:
+            stdout = None
+        else:
+            stdout = open(os.path.join(log_folder, f'worker_{task_index}.log'), 'w')
+            log_files.append(stdout)
+
+        preexec_fn = None
+        if pin_cores:
+            preexec_fn = (lambda cores: lambda: os.sched_setaffinity(0, cores))(worker_cores[task_index])
+
+        processes.append(subprocess.Popen([sys.executable, script], env=env, stdout=stdout, stderr=subprocess.STDOUT if stdout else None,
+                                          preexec_fn=preexec_fn))
+        print(f"Worker {task_index} iniciado (pid {processes[-1].pid}, porta {ports[task_index]})")
+
+    # Espera os workers. Se um deles falhar, os demais ficariam esperando nas operações coletivas, então são encerrados
+    return_code = 0
+    try:
+        while any(p.poll() is None for p in processes):
+            failed = [i for i, p in enumerate(processes) if p.poll() not in (None, 0)]
+            if failed:
+                print(f"O worker {failed[0]} terminou com erro. Encerrando os demais...")
+                return_code = processes[failed[0]].returncode
+                break
+            time.sleep(1)
+    except KeyboardInterrupt:
+        return_code = 1
+
+    for p in processes:
+        if p.poll() is None:
+            p.terminate()
+    for p in processes:
+        p.wait()
+        if return_code == 0 and p.returncode != 0:
+            return_code = p.returncode
+    for f in log_files:
+        f.close()
+    return return_code
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Treinamento distribuído em vários processos locais (MultiWorkerMirroredStrategy)")
+    parser.add_argument('--num_workers', type=int, required=True, help="Número de workers (processos)")
+    parser.add_argument('--threads_per_worker', type=int, default=None, help="Threads do Tensorflow por worker. Padrão = núcleos / workers")
+    parser.add_argument('--pin_cores', action='store_true', help="Fixa cada worker em um bloco de núcleos (Linux)")
+    parser.add_argument('--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'), help="Script de treinamento")
+    parser.add_argument('--log_folder', default='./worker_logs/', help="Pasta dos logs dos workers (exceto o chefe)")
+    args = parser.parse_args()
+
+    threads_per_worker = args.threads_per_worker
+    if threads_per_worker is None:
+        threads_per_worker = max(1, os.cpu_count() // args.num_workers)
+    print(f"Iniciando {args.num_workers} workers com {threads_per_worker} threads cada")
+
+    sys.exit(launch_workers(args.num_workers, threads_per_worker, args.script, args.log_folder, args.pin_cores))
@@ -5,6 +5,22 @@ import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Silencia o TF (https://stackoverflow.com/questions/35911252/disable-tensorflow-debugging-information)
 import tensorflow as tf
 
+# %% FUNÇÕES AUXILIARES
+
+
+# As losses do Keras são usadas com reduction=NONE e reduzidas com tf.reduce_mean, pois a redução padrão
+# (SUM_OVER_BATCH_SIZE) não pode ser usada dentro de uma tf.distribute.Strategy (treinamento distribuído)
+
+
+def to_float32(*tensors):
+    """Converte as saídas dos modelos para float32.
+
+    Com a precisão mista, as saídas dos discriminadores podem vir em float16 / bfloat16, e as losses
+    (principalmente as reduções) devem ser calculadas em float32.
+    """
+    return [tf.cast(tensor, tf.float32) for tensor in tensors]
+
+
 # %% DEFINIÇÃO DAS LOSSES
 
 '''
@@ -16,6 +32,7 @@ L2: Idem, com a loss L2
 @tf.function
 def loss_l1_generator(gen_output, target, lambda_l1):
     """Calcula a loss L1 (MAE - distância média absoluta pixel a pixel) entre a imagem gerada e o objetivo."""
+    gen_output, target = to_float32(gen_output, target)
     gan_loss = 0
     l1_loss = tf.reduce_mean(tf.abs(target - gen_output))  # mean absolute error
     total_gen_loss = lambda_l1 * l1_loss
@@ -25,9 +42,10 @@ def loss_l1_generator(gen_output, target, lambda_l1):
 @tf.function
 def loss_l2_generator(gen_output, target, lambda_l2):
     """Calcula a loss L2 (RMSE - raiz da distância média quadrada pixel a pixel) entre a imagem gerada e o objetivo."""
-    MSE = tf.keras.losses.MeanSquaredError()
+    gen_output, target = to_float32(gen_output, target)
+    MSE = tf.keras.losses.MeanSquaredError(reduction=tf.keras.losses.Reduction.NONE)
     gan_loss = 0
-    l2_loss = MSE(target, gen_output)  # mean squared error
+    l2_loss = tf.reduce_mean(MSE(target, gen_output))  # mean squared error
     # Usando a loss desse jeito, valores entre 0 e 1 serão subestimados. Deve-se tirar a raiz do MSE
     l2_loss = tf.sqrt(l2_loss)  # RMSE
     total_gen_loss = lambda_l2 * l2_loss
@@ -54,9 +72,10 @@ def loss_patchgan_generator(disc_generated_output, gen_output, target, lambda_l1
     O framework Pix2Pix / PatchGAN inclui também a loss L1 (distância absoluta pixel a pixel) entre a
     imagem gerada e a imagem objetivo (target), para direcionar o aprendizado do gerador.
     """
+    disc_generated_output, gen_output, target = to_float32(disc_generated_output, gen_output, target)
     # Lg = GANLoss + LAMBDA * L1_Loss
-    BCE = tf.keras.losses.BinaryCrossentropy(from_logits=True)
-    gan_loss = BCE(tf.ones_like(disc_generated_output), disc_generated_output)
+    BCE = tf.keras.losses.BinaryCrossentropy(from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+    gan_loss = tf.reduce_mean(BCE(tf.ones_like(disc_generated_output), disc_generated_output))
     l1_loss = tf.reduce_mean(tf.abs(target - gen_output))  # mean absolute error
     total_gen_loss = gan_loss + (lambda_l1 * l1_loss)
     return total_gen_loss, gan_loss, l1_loss
@@ -70,10 +89,11 @@ def loss_patchgan_discriminator(disc_real_output, disc_generated_output, lambda_
     Quando a imagem é sintética, a saída do discriminador deve ser 0 (ou uma matriz de 0s)
     O BCE (Binary Cross Entropy) avalia o quanto o discriminador acertou ou errou.
     """
+    disc_real_output, disc_generated_output = to_float32(disc_real_output, disc_generated_output)
     # Ld = RealLoss + FakeLoss
-    BCE = tf.keras.losses.BinaryCrossentropy(from_logits=True)
-    real_loss = BCE(tf.ones_like(disc_real_output), disc_real_output)
-    fake_loss = BCE(tf.zeros_like(disc_generated_output), disc_generated_output)
+    BCE = tf.keras.losses.BinaryCrossentropy(from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+    real_loss = tf.reduce_mean(BCE(tf.ones_like(disc_real_output), disc_real_output))
+    fake_loss = tf.reduce_mean(BCE(tf.zeros_like(disc_generated_output), disc_generated_output))
     total_disc_loss = lambda_disc * (real_loss + fake_loss)
     return total_disc_loss, real_loss, fake_loss
 
@@ -93,6 +113,7 @@ e usar a WGAN como substituta da GAN Loss
 @tf.function
 def loss_wgan_generator(disc_generated_output, gen_output, target, lambda_l1):
     """Calcula a loss de wasserstein (WGAN) para o gerador."""
+    disc_generated_output, gen_output, target = to_float32(disc_generated_output, gen_output, target)
     # O output do discriminador é de tamanho BATCH_SIZE x 1, o valor esperado é a média
     gan_loss = -tf.reduce_mean(disc_generated_output)
     l1_loss = tf.reduce_mean(tf.abs(target - gen_output))
@@ -103,6 +124,7 @@ def loss_wgan_generator(disc_generated_output, gen_output, target, lambda_l1):
 @tf.function
 def loss_wgan_discriminator(disc_real_output, disc_generated_output):
     """Calcula a loss de wasserstein (WGAN) para o discriminador."""
+    disc_real_output, disc_generated_output = to_float32(disc_real_output, disc_generated_output)
     # Maximizar E(D(x_real)) - E(D(x_fake)) é equivalente a minimizar -(E(D(x_real)) - E(D(x_fake))) ou E(D(x_fake)) -E(D(x_real))
     fake_loss = tf.reduce_mean(disc_generated_output)
     real_loss = tf.reduce_mean(disc_real_output)
@@ -123,11 +145,14 @@ def loss_wgangp_generator(disc_generated_output, gen_output, target, lambda_l1):
     return loss_wgan_generator(disc_generated_output, gen_output, target, lambda_l1)
 
 
-def loss_wgangp_discriminator(disc, disc_real_output, disc_generated_output, real_img, generated_img, target, lambda_gp):
-    """Calcula a loss de wasserstein com gradient-penalty (WGAN-GP) para o discriminador."""
+def loss_wgangp_discriminator(disc, disc_real_output, disc_generated_output, real_img, generated_img, target, lambda_gp, training=True):
+    """Calcula a loss de wasserstein com gradient-penalty (WGAN-GP) para o discriminador.
+    Na validação (training=False), o discriminador é usado em modo de inferência na penalidade de gradiente.
+    """
+    disc_real_output, disc_generated_output = to_float32(disc_real_output, disc_generated_output)
     fake_loss = tf.reduce_mean(disc_generated_output)
     real_loss = tf.reduce_mean(disc_real_output)
-    gp = gradient_penalty_conditional(disc, real_img, generated_img, target)
+    gp = gradient_penalty_conditional(disc, real_img, generated_img, target, training=training)
     total_disc_loss = total_disc_loss = -(real_loss - fake_loss) + lambda_gp * gp + (0.001 * tf.reduce_mean(disc_real_output**2))
     return total_disc_loss, real_loss, fake_loss, gp
 
@@ -135,8 +160,8 @@ def loss_wgangp_discriminator(disc, disc_real_output, disc_generated_output, rea
 @tf.function
 def gradient_penalty(discriminator, real_img, fake_img, training):
     """Calcula a penalidade de gradiente para a loss de wassertein-gp (WGAN-GP)."""
-    # Get the Batch Size
-    batch_size = real_img.shape[0]
+    # Get the Batch Size (dinâmico, para que batches de tamanhos diferentes não causem um novo tracing)
+    batch_size = tf.shape(real_img)[0]
 
     # Calcula gamma
     gamma = tf.random.uniform([batch_size, 1, 1, 1])
@@ -152,6 +177,7 @@ def gradient_penalty(discriminator, real_img, fake_img, training):
             pred = discriminator(interpolated, training=True)  # O discriminador usa duas imagens como entrada
         elif training == 'progressive':
             pred = discriminator(interpolated)
+        pred = tf.cast(pred, tf.float32)
 
     # 2. Calculate the gradients w.r.t to this interpolated image.
     grads = gp_tape.gradient(pred, [interpolated])[0]
@@ -162,24 +188,26 @@ def gradient_penalty(discriminator, real_img, fake_img, training):
 
 
 @tf.function
-def gradient_penalty_conditional(disc, real_img, generated_img, target):
+def gradient_penalty_conditional(disc, real_img, generated_img, target, training=True):
     """Calcula a penalidade de gradiente para a loss de wassertein-gp (WGAN-GP).
     Adaptada para o uso em discriminadores condicionais.
     """
-    # Get the Batch Size
-    batch_size = real_img.shape[0]
+    # Get the Batch Size (dinâmico, para que batches de tamanhos diferentes não causem um novo tracing)
+    batch_size = tf.shape(real_img)[0]
 
     # Calcula gamma
     gamma = tf.random.uniform([batch_size, 1, 1, 1])
 
     # Calcula a imagem interpolada
+    real_img, generated_img = to_float32(real_img, generated_img)
     interpolated = real_img * gamma + generated_img * (1 - gamma)
 
     with tf.GradientTape() as gp_tape:
         gp_tape.watch(interpolated)
 
         # 1. Get the discriminator output for this interpolated image.
-        pred = disc([interpolated, target], training=True)  # O discriminador usa duas imagens como entrada
+        pred = disc([interpolated, target], training=training)  # O discriminador usa duas imagens como entrada
+        pred = tf.cast(pred, tf.float32)
 
     # 2. Calculate the gradients w.r.t to this interpolated image.
     grads = gp_tape.gradient(pred, [interpolated])[0]
@@ -25,8 +25,9 @@ physical_devices = tf.config.list_physical_devices('GPU')
 print(physical_devices)
 print("")
 
-# Habilita a alocação de memória dinâmica
-tf.config.experimental.set_memory_growth(physical_devices[0], True)
+# Habilita a alocação de memória dinâmica (se houver GPU)
+for device in physical_devices:
+    tf.config.experimental.set_memory_growth(device, True)
 
 # Verifica a versão do Tensorflow
 tf_version = tf. __version__
@@ -34,18 +35,34 @@ print(f"Utilizando Tensorflow v {tf_version}")
 print("")
 
 # --- Módulos próprios
-import losses
 import utils
+
+# --- Treinamento distribuído
+# Com a variável de ambiente TF_CONFIG (definida pelo launch_workers.py), o treinamento é feito em vários processos
+# com a MultiWorkerMirroredStrategy. O worker 0 (chefe) é o único que registra as métricas e salva imagens e modelos.
+# A estratégia deve ser criada antes de qualquer operação do Tensorflow (o metrics.py cria a InceptionV3 ao ser importado)
+NUM_WORKERS, TASK_INDEX = utils.get_worker_info()
+IS_CHIEF = TASK_INDEX == 0
+strategy = utils.create_strategy(NUM_WORKERS)
+if NUM_WORKERS > 1:
+    print(f"Treinamento distribuído: worker {TASK_INDEX} de {NUM_WORKERS}")
+    print("")
+
 import metrics
 import networks_general as net
 import transferlearning as transfer
 import networks_resnet as rn
+import metrics_logger
+import trainer
+import checkpoint_writer
+import preview_writer
 
 # --- Weights & Biases
 import wandb
 
-# wandb.init(project='autoencoders', entity='vinyluis', mode="disabled")
-wandb.init(project='autoencoders', entity='vinyluis', mode="online")
+# O modo pode ser trocado pela variável de ambiente WANDB_MODE: "online", "offline" (sem conexão, sincroniza depois com wandb sync) ou "disabled"
+# Apenas o worker chefe registra o experimento
+wandb.init(project='autoencoders', entity='vinyluis', mode=os.environ.get('WANDB_MODE', "online") if IS_CHIEF else "disabled")
 
 # %% HIPERPARÂMETROS E CONFIGURAÇÕES
 config = wandb.config  # Salva os hiperparametros no Weights & Biases também
@@ -63,8 +80,14 @@ base_root = ""
 config.IMG_SIZE = 128
 config.OUTPUT_CHANNELS = 3
 config.USE_CACHE = True
+config.CACHE_MODE = 'memory'  # 'memory' (array uint8 em RAM), 'memmap' (arquivo .npy uint8 em disco) ou 'file' (cache tf.data em disco)
 config.DATASET = "CelebaHQ"  # "CelebaHQ" ou "InsetosFlickr" ou "CelebaHQ_Small"
+config.DATASET_FORMAT = 'jpeg'  # 'jpeg' (imagens originais) ou 'tfrecord' (shards pré-redimensionados, gerados pelo convert_dataset.py)
 config.USE_RANDOM_JITTER = False
+config.BATCH_JITTER = False  # Aplica o random jitter no batch inteiro, depois do batch(), a partir das imagens já em IMG_SIZE (não é o mesmo aumento de dados)
+config.REDUCED_JPEG_DECODING = True  # Decodifica os JPEGs já reduzidos (1/2, 1/4 ou 1/8) quando o IMG_SIZE permite
+config.DROP_REMAINDER = False  # Descarta o último batch (incompleto) de cada época do treino
+config.DETERMINISTIC_DATASET = False  # Com False, o tf.data pode entregar as imagens de treino fora de ordem (mais rápido)
 
 # Parâmetros de rede
 config.NORM_TYPE = "instancenorm"  # "batchnorm", "instancenorm", "pixelnorm"
@@ -73,14 +96,24 @@ config.LAMBDA_DISC = 1  # Ajuste de escala da loss do dicriminador
 config.LAMBDA_GP = 10  # Intensidade do Gradient Penalty da WGAN-GP
 config.NUM_RESIDUAL_BLOCKS = 6  # Número de blocos residuais dos geradores residuais
 config.DISENTANGLEMENT = 'smooth'  # 'none', 'normal', 'smooth'
+config.RECOMPUTE_RESIDUAL_BLOCKS = False  # Recalcula as ativações dos blocos residuais do gerador no backward (menos memória, step mais lento)
+config.BATCHED_DISCRIMINATOR = True  # Discrimina as imagens reais e sintéticas em uma única chamada (desligado automaticamente se o discriminador tiver batchnorm)
 # config.ADAM_BETA_1 e config.FIRST_EPOCH são definidos em código
 
 # Parâmetros de treinamento
 config.BATCH_SIZE = 6
-config.BUFFER_SIZE = 100
+config.BUFFER_SIZE = 100  # Buffer do shuffle das imagens decodificadas (os nomes dos arquivos já são embaralhados por completo a cada época)
 config.LEARNING_RATE_G = 1e-5
 config.LEARNING_RATE_D = 1e-5
 config.EPOCHS = 25
+config.MIXED_PRECISION = False  # Precisão mista: float16 na GPU com tensor cores (com loss scaling dinâmico) ou bfloat16 na CPU com AVX512_BF16 / AMX (ver utils.get_mixed_precision_policy)
+config.JIT_COMPILE = False  # Compila os steps de treino e validação com o XLA (recomenda-se DROP_REMAINDER = True, pois cada formato de batch é compilado)
+config.STEPS_PER_CALL = 1  # Iterações de treino executadas em cada chamada compilada (tf.function). Valores maiores reduzem o overhead do Python
+config.N_CRITIC = 1  # Atualizações do discriminador (crítico) por atualização do gerador. A WGAN costuma usar 5. Cada uma usa um batch novo e gera as suas imagens sintéticas (sem gradiente)
+config.ACCUMULATION_STEPS = 1  # Micro-batches de BATCH_SIZE imagens cujos gradientes são acumulados antes de cada atualização dos pesos
+config.NUM_WORKERS = NUM_WORKERS  # Definido pelo launch_workers.py. Cada worker treina com BATCH_SIZE imagens por réplica
+config.NUM_REPLICAS = strategy.num_replicas_in_sync
+config.GLOBAL_BATCH_SIZE = config.BATCH_SIZE * config.ACCUMULATION_STEPS * config.NUM_REPLICAS  # Batch efetivo de cada atualização dos pesos
 
 # Parâmetros das métricas
 config.EVALUATE_IS = True
@@ -97,6 +130,7 @@ config.EVALUATE_EVERY_EPOCH = True  # Define se vai avaliar em cada época ou ap
 config.VALIDATION = True  # Gera imagens da validação
 config.EVAL_ITERATIONS = 10  # A cada quantas iterações se faz a avaliação das métricas nas imagens de validação
 config.NUM_VAL_PRINTS = 10  # Controla quantas imagens de validação serão feitas. Com -1 plota todo o dataset de validação
+config.PREVIEW_GRID_SIZE = 16  # Quantas imagens (pares entrada / saída) são salvas em cada grade de validação e de teste
 
 # Configurações de teste
 config.TEST = True  # Teste do modelo
@@ -105,12 +139,19 @@ config.NUM_TEST_PRINTS = -1  # Controla quantas imagens de teste serão feitas.
 # Configurações de checkpoint
 config.SAVE_CHECKPOINT = True
 config.CHECKPOINT_EPOCHS = 1
+config.CHECKPOINT_STEPS = 0  # Salva também um checkpoint a cada CHECKPOINT_STEPS iterações, no meio das épocas (0 = desligado)
+config.CHECKPOINT_MINUTES = 0  # Salva também um checkpoint a cada CHECKPOINT_MINUTES minutos de treino, no meio das épocas (0 = desligado)
 config.KEEP_CHECKPOINTS = 1
+config.CHECKPOINT_MAX_IN_FLIGHT = 1  # Checkpoints mantidos em memória esperando a escrita em segundo plano (cada um ocupa o tamanho do checkpoint)
 config.LOAD_CHECKPOINT = False
+config.CHECKPOINT_DATASET_ITERATOR = True  # Salva o estado do dataset de treino no checkpoint (retoma no mesmo batch, com o mesmo embaralhamento)
 config.SAVE_MODELS = True
 
+# Configurações do registro das métricas
+config.LOG_SINK = 'wandb'  # 'wandb', 'jsonl' ou 'sqlite' (arquivo na pasta do experimento) ou 'none'
+config.LOG_EVERY = 50  # As losses de treino são registradas agregadas (média, mínimo e máximo) a cada LOG_EVERY iterações
+
 # Outras configurações
-QUIET_PLOT = True  # Controla se as imagens aparecerão na tela, o que impede a execução do código a depender da IDE
 SHUTDOWN_AFTER_FINISH = False  # Controla se o PC será desligado quando o código terminar corretamente
 
 # %% CONTROLE DA ARQUITETURA
@@ -161,6 +202,10 @@ else:
 if not(config.IMG_SIZE == 256 or config.IMG_SIZE == 128):
     raise utils.sizeCompatibilityError(config.IMG_SIZE)
 
+# Valida o modo de cache
+if not (config.CACHE_MODE == 'memory' or config.CACHE_MODE == 'memmap' or config.CACHE_MODE == 'file'):
+    raise BaseException("Modo de cache desconhecido. Opções = 'memory', 'memmap' ou 'file'.")
+
 # Valida se o número de blocos residuais é válido para o gerador residual
 if not (config.NUM_RESIDUAL_BLOCKS == 6 or config.NUM_RESIDUAL_BLOCKS == 9):
     raise BaseException("O número de blocos residuais do gerador não está correto. Opções = 6 ou 9.")
@@ -174,6 +219,33 @@ if not (config.DISENTANGLEMENT == 'smooth' or config.DISENTANGLEMENT == 'normal'
         or config.DISENTANGLEMENT is None or config.DISENTANGLEMENT == 'none'):
     raise BaseException("Selecione um tipo válido de desemaranhamento.")
 
+# Valida a recomputação dos blocos residuais. Com batchnorm, as médias móveis seriam atualizadas de novo na recomputação
+if config.RECOMPUTE_RESIDUAL_BLOCKS and config.NORM_TYPE == 'batchnorm':
+    raise BaseException("A recomputação dos blocos residuais (RECOMPUTE_RESIDUAL_BLOCKS) não pode ser usada com batchnorm.")
+
+# Valida o número de micro-batches da acumulação de gradientes
+if not (isinstance(config.ACCUMULATION_STEPS, int) and config.ACCUMULATION_STEPS >= 1):
+    raise BaseException("O número de micro-batches da acumulação de gradientes (ACCUMULATION_STEPS) deve ser um inteiro >= 1.")
+
+# Valida o número de passos do crítico
+if not (isinstance(config.N_CRITIC, int) and config.N_CRITIC >= 1):
+    raise BaseException("O número de atualizações do discriminador por atualização do gerador (N_CRITIC) deve ser um inteiro >= 1.")
+if config.N_CRITIC > 1 and config.ACCUMULATION_STEPS > 1:
+    raise BaseException("N_CRITIC > 1 não pode ser usado com a acumulação de gradientes (ACCUMULATION_STEPS > 1).")
+
+# Valida os checkpoints no meio das épocas
+if not (isinstance(config.CHECKPOINT_STEPS, int) and config.CHECKPOINT_STEPS >= 0):
+    raise BaseException("O intervalo de checkpoints em iterações (CHECKPOINT_STEPS) deve ser um inteiro >= 0.")
+if config.CHECKPOINT_MINUTES < 0:
+    raise BaseException("O intervalo de checkpoints em minutos (CHECKPOINT_MINUTES) deve ser >= 0.")
+# Todos os workers precisam salvar o checkpoint juntos, e o tempo medido em cada um é diferente
+if config.CHECKPOINT_MINUTES > 0 and NUM_WORKERS > 1:
+    raise BaseException("CHECKPOINT_MINUTES não pode ser usado com vários workers. Use CHECKPOINT_STEPS.")
+
+# Define a política de precisão (antes da criação dos modelos)
+config.PRECISION_POLICY = utils.set_precision_policy(config.MIXED_PRECISION)
+print(f"Política de precisão: {config.PRECISION_POLICY}")
+
 
 # %% PREPARA AS PASTAS
 
@@ -195,29 +267,33 @@ result_test_folder = experiment_folder + 'results-test/'
 result_val_folder = experiment_folder + 'results-val/'
 model_folder = experiment_folder + 'model/'
 
-# Cria as pastas, se não existirem
-if not os.path.exists(experiment_root):
-    os.mkdir(experiment_root)
+# Cria as pastas, se não existirem (apenas o worker chefe grava resultados)
+if IS_CHIEF:
+    if not os.path.exists(experiment_root):
+        os.mkdir(experiment_root)
 
-if not os.path.exists(experiment_folder):
-    os.mkdir(experiment_folder)
+    if not os.path.exists(experiment_folder):
+        os.mkdir(experiment_folder)
 
-if not os.path.exists(result_folder):
-    os.mkdir(result_folder)
+    if not os.path.exists(result_folder):
+        os.mkdir(result_folder)
 
-if not os.path.exists(result_test_folder):
-    os.mkdir(result_test_folder)
+    if not os.path.exists(result_test_folder):
+        os.mkdir(result_test_folder)
 
-if not os.path.exists(result_val_folder):
-    os.mkdir(result_val_folder)
+    if not os.path.exists(result_val_folder):
+        os.mkdir(result_val_folder)
 
-if not os.path.exists(model_folder):
-    os.mkdir(model_folder)
+    if not os.path.exists(model_folder):
+        os.mkdir(model_folder)
 
 # Pasta do checkpoint
 checkpoint_dir = experiment_folder + 'checkpoints'
 checkpoint_prefix = os.path.join(checkpoint_dir, "ckpt")
 
+# Registro das métricas, enviadas em segundo plano para o sink escolhido
+logger = metrics_logger.MetricsLogger(metrics_logger.get_sink(config.LOG_SINK if IS_CHIEF else 'none', experiment_folder), flush_every=config.LOG_EVERY)
+
 # %% DATASET
 
 # Pastas do dataset
@@ -238,6 +314,9 @@ elif config.DATASET == 'InsetosFlickr':
 else:
     raise BaseException("Selecione um dataset válido")
 
+# Pasta dos manifestos e caches em disco (compartilhada entre os experimentos)
+cache_folder = dataset_root + 'cache/'
+
 # Pastas de treino, teste e validação
 train_folder = dataset_folder + 'train'
 test_folder = dataset_folder + 'test'
@@ -247,30 +326,69 @@ val_folder = dataset_folder + 'val'
 
 print("Carregando os datasets...")
 
-# Dataset de treinamento
-train_dataset = tf.data.Dataset.list_files(train_folder + dataset_filter_string)
-config.TRAIN_SIZE = len(list(train_dataset))
-train_dataset = train_dataset.map(lambda x: utils.load_image_train(x, config.IMG_SIZE, config.OUTPUT_CHANNELS, config.USE_RANDOM_JITTER))
-if config.USE_CACHE:
-    train_dataset = train_dataset.cache()
-train_dataset = train_dataset.shuffle(config.BUFFER_SIZE)
-train_dataset = train_dataset.batch(config.BATCH_SIZE)
+
+def get_cache_path(split):
+    """Retorna o caminho do cache em disco de um split, de acordo com o CACHE_MODE"""
+    # Com vários workers, cada um tem o cache da sua parte do dataset de treino
+    if split == 'train' and NUM_WORKERS > 1:
+        split = f'train_worker{TASK_INDEX}of{NUM_WORKERS}'
+    if config.CACHE_MODE == 'memmap':
+        return utils.get_memmap_cache_path(cache_folder, config.DATASET, split, config.IMG_SIZE, config.OUTPUT_CHANNELS, config.REDUCED_JPEG_DECODING)
+    elif config.CACHE_MODE == 'file':
+        return utils.get_file_cache_prefix(cache_folder, config.DATASET, split, config.IMG_SIZE, config.OUTPUT_CHANNELS)
+    return None
+
+
+# Arquivos de cada split (imagens JPEG ou shards TFRecord)
+if config.DATASET_FORMAT == 'jpeg':
+    # Os manifestos guardam a lista de arquivos de cada split, e só são atualizados quando o dataset muda
+    train_manifest = utils.update_dataset_manifest(utils.get_manifest_path(cache_folder, config.DATASET, 'train'), train_folder + dataset_filter_string)
+    test_manifest = utils.update_dataset_manifest(utils.get_manifest_path(cache_folder, config.DATASET, 'test'), test_folder + dataset_filter_string)
+    val_manifest = utils.update_dataset_manifest(utils.get_manifest_path(cache_folder, config.DATASET, 'val'), val_folder + dataset_filter_string)
+    train_shard = utils.shard_manifest(train_manifest, NUM_WORKERS, TASK_INDEX)
+    train_files, config.TRAIN_SIZE, train_shard_size = utils.manifest_to_dataset(train_shard), len(train_manifest), len(train_shard)
+    test_files, config.TEST_SIZE = utils.manifest_to_dataset(test_manifest), len(test_manifest)
+    val_files, config.VAL_SIZE = utils.manifest_to_dataset(val_manifest), len(val_manifest)
+    # Identificam o conteúdo de cada split, para validar os caches memmap
+    train_fingerprint = utils.get_manifest_fingerprint(train_manifest)
+    test_fingerprint = utils.get_manifest_fingerprint(test_manifest)
+    val_fingerprint = utils.get_manifest_fingerprint(val_manifest)
+
+elif config.DATASET_FORMAT == 'tfrecord':
+    tfrecord_folder = utils.get_tfrecord_folder(dataset_folder, config.IMG_SIZE)
+    train_files, train_shard_size = utils.list_tfrecord_shards(tfrecord_folder, 'train', NUM_WORKERS, TASK_INDEX)
+    config.TRAIN_SIZE = train_shard_size * NUM_WORKERS if NUM_WORKERS > 1 else train_shard_size
+    test_files, config.TEST_SIZE = utils.list_tfrecord_shards(tfrecord_folder, 'test')
+    val_files, config.VAL_SIZE = utils.list_tfrecord_shards(tfrecord_folder, 'val')
+    train_fingerprint = utils.get_tfrecord_fingerprint(tfrecord_folder, 'train')
+    test_fingerprint = utils.get_tfrecord_fingerprint(tfrecord_folder, 'test')
+    val_fingerprint = utils.get_tfrecord_fingerprint(tfrecord_folder, 'val')
+
+else:
+    raise BaseException("Selecione um formato de dataset válido")
+
+# Todos os workers fazem o mesmo número de steps por época (o da menor parte do dataset de treino)
+config.TRAIN_SIZE_PER_WORKER = config.TRAIN_SIZE // NUM_WORKERS
+
+# Dataset de treinamento (com vários workers, apenas a parte deste worker, com BATCH_SIZE imagens por réplica)
+train_dataset = utils.create_image_dataset(train_files, 'train', config.IMG_SIZE, config.OUTPUT_CHANNELS, config.BATCH_SIZE,
+                                           use_jitter=config.USE_RANDOM_JITTER, use_cache=config.USE_CACHE, shuffle_buffer=config.BUFFER_SIZE,
+                                           drop_remainder=config.DROP_REMAINDER, deterministic=config.DETERMINISTIC_DATASET,
+                                           source_format=config.DATASET_FORMAT, cache_mode=config.CACHE_MODE, num_images=train_shard_size,
+                                           cache_path=get_cache_path('train'), source_fingerprint=train_fingerprint,
+                                           reduced_decoding=config.REDUCED_JPEG_DECODING, batch_jitter=config.BATCH_JITTER)
 
 # Dataset de teste
-test_dataset = tf.data.Dataset.list_files(test_folder + dataset_filter_string)
-config.TEST_SIZE = len(list(test_dataset))
-test_dataset = test_dataset.map(lambda x: utils.load_image_test(x, config.IMG_SIZE))
-if config.USE_CACHE:
-    test_dataset = test_dataset.cache()
-test_dataset = test_dataset.batch(1)
+test_dataset = utils.create_image_dataset(test_files, 'test', config.IMG_SIZE, config.OUTPUT_CHANNELS, 1, use_cache=config.USE_CACHE,
+                                          source_format=config.DATASET_FORMAT, cache_mode=config.CACHE_MODE, num_images=config.TEST_SIZE,
+                                          cache_path=get_cache_path('test'), source_fingerprint=test_fingerprint,
+                                          reduced_decoding=config.REDUCED_JPEG_DECODING)
 
 # Dataset de validação
-val_dataset = tf.data.Dataset.list_files(val_folder + dataset_filter_string)
-config.VAL_SIZE = len(list(val_dataset))
-val_dataset = val_dataset.map(lambda x: utils.load_image_test(x, config.IMG_SIZE))
-if config.USE_CACHE:
-    val_dataset = val_dataset.cache()
-val_dataset = val_dataset.batch(1)
+val_dataset = utils.create_image_dataset(val_files, 'val', config.IMG_SIZE, config.OUTPUT_CHANNELS, 1, use_cache=config.USE_CACHE,
+                                         source_format=config.DATASET_FORMAT, cache_mode=config.CACHE_MODE, num_images=config.VAL_SIZE,
+                                         cache_path=get_cache_path('val'), source_fingerprint=val_fingerprint,
+                                         reduced_decoding=config.REDUCED_JPEG_DECODING)
 
 print(f"O dataset de treino tem {config.TRAIN_SIZE} imagens")
 print(f"O dataset de teste tem {config.TEST_SIZE} imagens")
@@ -306,173 +424,7 @@ config.EVALUATED_IMAGES_VAL = config.METRIC_SAMPLE_SIZE_VAL * config.METRIC_BATC
 
 # %% FUNÇÕES DE TREINAMENTO
 
-
-@tf.function
-def train_step(generator, discriminator, input_image, target):
-    """Realiza um passo de treinamento no framework adversário.
-
-    A função gera a imagem sintética e a discrimina.
-    Usando a imagem real e a sintética, são calculadas as losses do gerador e do discriminador.
-    Finalmente usa backpropagation para atualizar o gerador e o discriminador, e retorna as losses
-    """
-
-    with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
-
-        gen_image = generator(input_image, training=True)
-
-        disc_real = discriminator([input_image, target], training=True)
-        disc_gen = discriminator([gen_image, target], training=True)
-
-        if config.loss_type == 'patchganloss':
-            gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_patchgan_generator(disc_gen, gen_image, target, config.LAMBDA)
-            disc_loss, disc_real_loss, disc_fake_loss = losses.loss_patchgan_discriminator(disc_real, disc_gen, config.LAMBDA_DISC)
-
-        elif config.loss_type == 'wgan':
-            gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_wgan_generator(disc_gen, gen_image, target, config.LAMBDA)
-            disc_loss, disc_real_loss, disc_fake_loss = losses.loss_wgan_discriminator(disc_real, disc_gen)
-
-        elif config.loss_type == 'wgan-gp':
-            gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_wgangp_generator(disc_gen, gen_image, target, config.LAMBDA)
-            disc_loss, disc_real_loss, disc_fake_loss, gp = losses.loss_wgangp_discriminator(discriminator, disc_real, disc_gen, input_image, gen_image, target, config.LAMBDA_GP)
-
-        # Incluído o else para não dar erro 'gen_loss' is used before assignment
-        else:
-            gen_loss = 0
-            disc_loss = 0
-            print("Erro de modelo. Selecione uma Loss válida")
-
-    generator_gradients = gen_tape.gradient(gen_loss, generator.trainable_variables)
-    discriminator_gradients = disc_tape.gradient(disc_loss, discriminator.trainable_variables)
-
-    generator_optimizer.apply_gradients(zip(generator_gradients, generator.trainable_variables))
-    discriminator_optimizer.apply_gradients(zip(discriminator_gradients, discriminator.trainable_variables))
-
-    # Cria um dicionário das losses
-    loss_dict = {
-        'gen_total_loss': gen_loss,
-        'gen_gan_loss': gen_gan_loss,
-        'gen_l1_loss': gen_l1_loss,
-        'disc_total_loss': disc_loss,
-        'disc_real_loss': disc_real_loss,
-        'disc_fake_loss': disc_fake_loss,
-    }
-    if config.loss_type == 'wgan-gp':
-        loss_dict['gp'] = gp
-
-    return loss_dict
-
-
-@tf.function
-def train_step_not_adversarial(generator, input_image, target):
-    """Realiza um passo de treinamento no framework não adversário.
-
-    A função gera a imagem sintética e a discrimina.
-    Usando a imagem real e a sintética, são calculadas as losses do gerador.
-    Finalmente usa backpropagation para atualizar o gerador, e retorna as losses.
-    """
-    with tf.GradientTape() as gen_tape:
-
-        gen_image = generator(input_image, training=True)
-
-        if config.loss_type == 'l1':
-            gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_l1_generator(gen_image, target, config.LAMBDA)
-
-        elif config.loss_type == 'l2':
-            gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_l2_generator(gen_image, target, config.LAMBDA)
-
-        # Incluído o else para não dar erro 'gen_loss' is used before assignment
-        else:
-            gen_loss = 0
-            print("Erro de modelo. Selecione uma Loss válida")
-
-    generator_gradients = gen_tape.gradient(gen_loss, generator.trainable_variables)
-    generator_optimizer.apply_gradients(zip(generator_gradients, generator.trainable_variables))
-
-    # Cria um dicionário das losses
-    loss_dict = {
-        'gen_total_loss': gen_loss,
-        'gen_l1_loss': gen_l1_loss
-    }
-
-    return loss_dict
-
-
-def evaluate_validation_losses(generator, discriminator, input_image, target):
-
-    """Avalia as losses para imagens de validação no treinamento adversário.
-
-    A função gera a imagem sintética e a discrimina.
-    Usando a imagem real e a sintética, são calculadas as losses do gerador e do discriminador.
-    Isso é úitil para monitorar o quão bem a rede está generalizando com dados não vistos.
-    """
-
-    gen_image = generator(input_image, training=True)
-
-    disc_real = discriminator([input_image, target], training=True)
-    disc_gen = discriminator([gen_image, target], training=True)
-
-    if config.loss_type == 'patchganloss':
-        gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_patchgan_generator(disc_gen, gen_image, target, config.LAMBDA)
-        disc_loss, disc_real_loss, disc_fake_loss = losses.loss_patchgan_discriminator(disc_real, disc_gen, config.LAMBDA_DISC)
-
-    elif config.loss_type == 'wgan':
-        gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_wgan_generator(disc_gen, gen_image, target, config.LAMBDA)
-        disc_loss, disc_real_loss, disc_fake_loss = losses.loss_wgan_discriminator(disc_real, disc_gen)
-
-    elif config.loss_type == 'wgan-gp':
-        gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_wgangp_generator(disc_gen, gen_image, target, config.LAMBDA)
-        disc_loss, disc_real_loss, disc_fake_loss, gp = losses.loss_wgangp_discriminator(discriminator, disc_real, disc_gen, input_image, gen_image, target, config.LAMBDA_GP)
-
-    # Incluído o else para não dar erro 'gen_loss' is used before assignment
-    else:
-        gen_loss = 0
-        disc_loss = 0
-        print("Erro de modelo. Selecione uma Loss válida")
-
-    # Cria um dicionário das losses
-    loss_dict = {
-        'gen_total_loss_val': gen_loss,
-        'gen_gan_loss_val': gen_gan_loss,
-        'gen_l1_loss_val': gen_l1_loss,
-        'disc_total_loss_val': disc_loss,
-        'disc_real_loss_val': disc_real_loss,
-        'disc_fake_loss_val': disc_fake_loss,
-    }
-    if config.loss_type == 'wgan-gp':
-        loss_dict['gp_val'] = gp
-
-    return loss_dict
-
-
-def evaluate_validation_losses_not_adversarial(generator, input_image, target):
-
-    """Avalia as losses para imagens de validação, no treinamento não adversário.
-
-    A função gera a imagem sintética e a discrimina.
-    Usando a imagem real e a sintética, são calculadas as losses do gerador.
-    Isso é úitil para monitorar o quão bem a rede está generalizando com dados não vistos.
-    """
-
-    gen_image = generator(input_image, training=True)
-
-    if config.loss_type == 'l1':
-        gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_l1_generator(gen_image, target, config.LAMBDA)
-
-    elif config.loss_type == 'l2':
-        gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_l2_generator(gen_image, target, config.LAMBDA)
-
-    # Incluído o else para não dar erro 'gen_loss' is used before assignment
-    else:
-        gen_loss = 0
-        print("Erro de modelo. Selecione uma Loss válida")
-
-    # Cria um dicionário das losses
-    loss_dict = {
-        'gen_total_loss_val': gen_loss,
-        'gen_l1_loss_val': gen_l1_loss
-    }
-
-    return loss_dict
+# Os passos de treinamento e de validação compilados ficam no trainer.py (Trainer)
 
 
 def fit(generator, discriminator, train_ds, val_ds, first_epoch, epochs, adversarial=True):
@@ -492,105 +444,171 @@ def fit(generator, discriminator, train_ds, val_ds, first_epoch, epochs, adversa
         if discriminator is None:
             raise BaseException("Erro! Treinamento adversário precisa de um discriminador")
 
-    # Prepara a progression bar
-    progbar_iterations = int(ceil(config.TRAIN_SIZE / config.BATCH_SIZE))
+    # Prepara a progression bar (uma época tem STEPS_PER_EPOCH iterações)
+    progbar_iterations = config.STEPS_PER_EPOCH
     progbar = tf.keras.utils.Progbar(progbar_iterations)
 
     # Separa imagens fixas para acompanhar o treinamento
     for train_input in train_ds.take(1):
         fixed_train = train_input
-    for val_input in val_ds.shuffle(1).take(1):
+    for val_input in val_ds.unbatch().batch(config.BATCH_SIZE).take(1):
         fixed_val = val_input
 
     # Mostra como está a geração das imagens antes do treinamento
-    utils.generate_fixed_images(fixed_train, fixed_val, generator, first_epoch - 1, epochs, result_folder, QUIET_PLOT)
+    if IS_CHIEF:
+        previews.write_fixed_images(fixed_train, fixed_val, first_epoch - 1, epochs, result_folder)
 
-    # Listas para o cálculo da acurácia
-    y_real = []
-    y_pred = []
+    # Iterador persistente dos batches de validação, que se repete indefinidamente (criado uma única vez).
+    # O repeat antes do batch garante batches sempre completos, com formato fixo, mesmo se VAL_SIZE < BATCH_SIZE
+    if IS_CHIEF:
+        val_iterator = iter(val_ds.unbatch().repeat().batch(config.BATCH_SIZE, drop_remainder=True).prefetch(1))
 
     # Uso de memória
     mem_usage = utils.print_used_memory()
-    wandb.log(mem_usage)
+    logger.log(mem_usage)
     print("")
 
+    # A primeira chamada de cada step inclui o tracing e a compilação (XLA, se JIT_COMPILE), e é medida separadamente
+    compiled_train = False
+    compiled_val = False
+    last_trace_counts = {}
+
+    # Salva o checkpoint (todos os workers salvam, mas só o do chefe é mantido), numerado pela iteração global
+    # Apenas a cópia para a memória bloqueia o treinamento, a escrita no disco é feita em segundo plano
+    last_checkpoint_time = time.perf_counter()
+
+    def save_checkpoint(description):
+        nonlocal last_checkpoint_time
+        t_ckpt = time.perf_counter()
+        ckpt_writer.save(int(global_step.numpy()))
+        logger.log({'checkpoint save time (s)': time.perf_counter() - t_ckpt})
+        print(f'\nSalvando checkpoint {description} (iteração {global_step.numpy()})')
+        last_checkpoint_time = time.perf_counter()
+
     # ---------- LOOP DE TREINAMENTO ----------
     for epoch in range(first_epoch, epochs + 1):
         t1 = time.perf_counter()
         print(f"Época: {epoch}")
 
+        # Tempo dos steps de treino já compilados (a sincronização com a GPU é feita só no fim da época)
+        steady_time = 0
+        steady_steps = 0
+
         # Train
-        for n, input_image in train_ds.enumerate():
+        # O iterador é persistente entre as épocas, e epoch_step guarda quantos batches da época já foram treinados
+        # (diferente de zero apenas quando o treinamento é retomado de um checkpoint no meio de uma época)
+        n = int(epoch_step.numpy())
+        while n < progbar_iterations:
+
+            # Realiza até STEPS_PER_CALL steps de treinamento em uma única chamada
+            # A acurácia é calculada com as saídas do discriminador no próprio step
+            num_steps = min(config.STEPS_PER_CALL, progbar_iterations - n)
+            # A chamada termina exatamente na iteração do próximo checkpoint (num_steps é um tensor, sem retracing)
+            if config.SAVE_CHECKPOINT and config.CHECKPOINT_STEPS > 0:
+                num_steps = min(num_steps, config.CHECKPOINT_STEPS - int(global_step.numpy()) % config.CHECKPOINT_STEPS)
+            t_step = time.perf_counter()
+            losses_train = gan_trainer.train_multiple_steps(train_iterator, tf.constant(num_steps))
+            if not compiled_train:
+                float(losses_train['gen_total_loss'][-1])  # Espera o fim da execução
+                logger.log({'train compile time (s)': time.perf_counter() - t_step})
+                compiled_train = True
+            else:
+                steady_time += time.perf_counter() - t_step
+                steady_steps += num_steps
+            first_n = n
+            n += num_steps
 
             # Faz o update da Progress Bar
-            i = n.numpy() + 1  # Ajuste porque n começa em 0
-            progbar.update(i)
-
-            # Step de treinamento
-            target = input_image
-
-            if adversarial:
-                # Realiza o step de treino adversário
-                losses_train = train_step(generator, discriminator, input_image, target)
-                # Cálculo da acurácia com imagens de validação
-                y_real, y_pred, acc = metrics.evaluate_accuracy(generator, discriminator, val_ds, y_real, y_pred)
-                losses_train['accuracy'] = acc
-            else:
-                # Realiza o step de treino não adversário
-                losses_train = train_step_not_adversarial(generator, input_image, target)
+            progbar.update(n)
 
             # Acrescenta a época, para manter o controle
             losses_train['epoch'] = epoch
-
-            # Log as métricas no wandb
-            wandb.log(utils.dict_tensor_to_numpy(losses_train))
-
-            # A cada EVAL_ITERATIONS iterações, avalia as losses para o conjunto de val
-            if (n % config.EVAL_ITERATIONS) == 0 or n == 1 or n == progbar_iterations:
-                for example_input in val_dataset.unbatch().batch(config.BATCH_SIZE).take(1):
-                    # Calcula as losses
-                    if adversarial:
-                        losses_val = evaluate_validation_losses(generator, discriminator, example_input, example_input)
-                    else:
-                        losses_val = evaluate_validation_losses_not_adversarial(generator, example_input, example_input)
-
-                    # Loga as losses de val no weights and biases
-                    wandb.log(utils.dict_tensor_to_numpy(losses_val))
-
-        # Salva o checkpoint
+            epoch_step.assign(n)
+            global_step.assign_add(num_steps)
+
+            # Checkpoint no meio da época, a cada CHECKPOINT_STEPS iterações ou CHECKPOINT_MINUTES minutos
+            # (o fim da época é tratado abaixo, com CHECKPOINT_EPOCHS)
+            if config.SAVE_CHECKPOINT and n < progbar_iterations:
+                if config.CHECKPOINT_STEPS > 0 and global_step.numpy() % config.CHECKPOINT_STEPS == 0:
+                    save_checkpoint(f'da época {epoch}, batch {n}')
+                elif config.CHECKPOINT_MINUTES > 0 and time.perf_counter() - last_checkpoint_time >= 60 * config.CHECKPOINT_MINUTES:
+                    save_checkpoint(f'da época {epoch}, batch {n}')
+
+            # Acumula as métricas empilhadas (sem sincronizar com a GPU), que são registradas a cada LOG_EVERY iterações
+            logger.log_steps(losses_train, num_steps)
+
+            # A cada EVAL_ITERATIONS iterações, avalia as losses para o conjunto de val (apenas no worker chefe)
+            if IS_CHIEF and any((k % config.EVAL_ITERATIONS) == 0 or k == 1 for k in range(first_n, n)):
+                example_input = next(val_iterator)
+
+                # Calcula as losses
+                t_val = time.perf_counter()
+                losses_val = gan_trainer.evaluate_validation_losses(example_input, example_input)
+                if not compiled_val:
+                    float(losses_val['gen_total_loss_val'])  # Espera o fim da execução
+                    logger.log({'val compile time (s)': time.perf_counter() - t_val})
+                    compiled_val = True
+
+                # Registra as losses de val
+                logger.log(losses_val)
+
+        # Tempo médio dos steps de treino, sem a compilação
+        if steady_steps > 0:
+            t_sync = time.perf_counter()
+            float(losses_train['gen_total_loss'][-1])  # Espera o fim do último step
+            steady_time += time.perf_counter() - t_sync
+            logger.log({'train step time (ms)': 1000 * steady_time / steady_steps})
+
+        # Número de tracings de cada passo compilado. Depois da primeira época, um aumento indica um retracing
+        trace_counts = gan_trainer.get_trace_counts()
+        logger.log({f'{name} traces': count for name, count in trace_counts.items()})
+        retraced = [name for name, count in trace_counts.items() if name in last_trace_counts and count > last_trace_counts[name]]
+        if retraced:
+            print(f"Aviso: funções retraçadas nesta época: {', '.join(retraced)}")
+        last_trace_counts = trace_counts
+
+        # Fim da época
+        logger.flush()
+        epoch_step.assign(0)
+        train_epoch.assign(epoch)
+
+        # Salva o checkpoint do fim da época
         if config.SAVE_CHECKPOINT:
             if (epoch) % config.CHECKPOINT_EPOCHS == 0:
-                ckpt_manager.save()
-                print(f'\nSalvando checkpoint da época {epoch}')
+                save_checkpoint(f'da época {epoch}')
 
         # Gera as imagens após o treinamento desta época
-        utils.generate_fixed_images(fixed_train, fixed_val, generator, epoch, epochs, result_folder, QUIET_PLOT)
+        if IS_CHIEF:
+            previews.write_fixed_images(fixed_train, fixed_val, epoch, epochs, result_folder)
 
         # --- AVALIAÇÃO DAS MÉTRICAS DE QUALIDADE ---
-        if (config.EVALUATE_EVERY_EPOCH is True or config.EVALUATE_EVERY_EPOCH is False and epoch == epochs):
+        # Apenas no worker chefe. Os demais seguem para a próxima época e esperam por ele no primeiro step
+        if IS_CHIEF and (config.EVALUATE_EVERY_EPOCH is True or config.EVALUATE_EVERY_EPOCH is False and epoch == epochs):
             print("Avaliando as métricas de qualidade...")
 
             if config.EVALUATE_TRAIN_IMGS:
                 # Avaliação para as imagens de treino
                 train_sample = train_ds.unbatch().batch(config.METRIC_BATCH_SIZE).take(config.METRIC_SAMPLE_SIZE_TRAIN)  # Corrige o tamanho do batch
-                metric_results = metrics.evaluate_metrics(train_sample, generator, config.EVALUATE_IS, config.EVALUATE_FID, config.EVALUATE_L1)
+                metric_results = metrics.evaluate_metrics(train_sample, generator, config.EVALUATE_IS, config.EVALUATE_FID, config.EVALUATE_L1,
+                                                          num_batches=config.METRIC_SAMPLE_SIZE_TRAIN)
                 train_metrics = {k + "_train": v for k, v in metric_results.items()}  # Renomeia o dicionário para incluir "train" no final das keys
-                wandb.log(train_metrics)
+                logger.log(train_metrics)
 
             # Avaliação para as imagens de validação
             val_sample = val_ds.unbatch().shuffle(config.BUFFER_SIZE).batch(config.METRIC_BATCH_SIZE).take(config.METRIC_SAMPLE_SIZE_VAL)  # Corrige o tamanho do batch
-            metric_results = metrics.evaluate_metrics(val_sample, generator, config.EVALUATE_IS, config.EVALUATE_FID, config.EVALUATE_L1)
+            metric_results = metrics.evaluate_metrics(val_sample, generator, config.EVALUATE_IS, config.EVALUATE_FID, config.EVALUATE_L1,
+                                                      num_batches=config.METRIC_SAMPLE_SIZE_VAL)
             val_metrics = {k + "_val": v for k, v in metric_results.items()}  # Renomeia o dicionário para incluir "val" no final das keys
-            wandb.log(val_metrics)
+            logger.log(val_metrics)
 
         # Uso de memória
         mem_usage = utils.print_used_memory()
-        wandb.log(mem_usage)
+        logger.log(mem_usage)
 
         # Loga o tempo de duração da época no wandb
         dt = time.perf_counter() - t1
         print(f'Tempo usado para a época {epoch} foi de {dt / 60:.2f} min ({dt:.2f} sec)\n')
-        wandb.log({'epoch time (s)': dt, 'epoch time (min)': dt / 60})
+        logger.log({'epoch time (s)': dt, 'epoch time (min)': dt / 60})
 
 
 # %% PREPARAÇÃO DOS MODELOS
@@ -600,49 +618,76 @@ constrained = False
 if config.loss_type == 'wgan':
     constrained = True
 
-# ---- GERADORES
-if config.gen_model == 'pix2pix':
-    generator = net.pix2pix_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE)
-elif config.gen_model == 'unet':
-    generator = net.unet_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE)
-elif config.gen_model == 'residual':
-    generator = net.residual_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE, num_residual_blocks=config.NUM_RESIDUAL_BLOCKS)
-elif config.gen_model == 'residual_vetor':
-    generator = net.residual_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE, create_latent_vector=True, num_residual_blocks=config.NUM_RESIDUAL_BLOCKS)
-elif config.gen_model == 'full_residual':
-    generator = net.full_residual_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE, disentanglement=config.DISENTANGLEMENT, num_residual_blocks=config.NUM_RESIDUAL_BLOCKS)
-elif config.gen_model == 'simple_decoder':
-    generator = net.simple_decoder_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE, disentanglement=config.DISENTANGLEMENT, num_residual_blocks=config.NUM_RESIDUAL_BLOCKS)
-elif config.gen_model == 'transfer':
-    generator = transfer.transfer_model(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE, config.transfer_generator_path, config.transfer_generator_filename,
-                                        config.transfer_upsample_type, config.transfer_encoder_last_layer, config.transfer_decoder_first_layer, config.transfer_trainable,
-                                        config.DISENTANGLEMENT)
-elif config.gen_model == 'resnet_adaptado':
-    generator = rn.resnet_adapted_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE, disentanglement=config.DISENTANGLEMENT)
-else:
-    raise utils.GeneratorError(config.gen_model)
+# Os modelos e otimizadores são criados no escopo da estratégia, para que as variáveis sejam espelhadas entre as réplicas
+with strategy.scope():
+    # ---- GERADORES
+    if config.gen_model == 'pix2pix':
+        generator = net.pix2pix_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE)
+    elif config.gen_model == 'unet':
+        generator = net.unet_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE)
+    elif config.gen_model == 'residual':
+        generator = net.residual_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE, num_residual_blocks=config.NUM_RESIDUAL_BLOCKS,
+                                           recompute=config.RECOMPUTE_RESIDUAL_BLOCKS)
+    elif config.gen_model == 'residual_vetor':
+        generator = net.residual_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE, create_latent_vector=True, num_residual_blocks=config.NUM_RESIDUAL_BLOCKS,
+                                           recompute=config.RECOMPUTE_RESIDUAL_BLOCKS)
+    elif config.gen_model == 'full_residual':
+        generator = net.full_residual_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE, disentanglement=config.DISENTANGLEMENT, num_residual_blocks=config.NUM_RESIDUAL_BLOCKS,
+                                                recompute=config.RECOMPUTE_RESIDUAL_BLOCKS)
+    elif config.gen_model == 'simple_decoder':
+        generator = net.simple_decoder_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE, disentanglement=config.DISENTANGLEMENT, num_residual_blocks=config.NUM_RESIDUAL_BLOCKS,
+                                                 recompute=config.RECOMPUTE_RESIDUAL_BLOCKS)
+    elif config.gen_model == 'transfer':
+        generator = transfer.transfer_model(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE, config.transfer_generator_path, config.transfer_generator_filename,
+                                            config.transfer_upsample_type, config.transfer_encoder_last_layer, config.transfer_decoder_first_layer, config.transfer_trainable,
+                                            config.DISENTANGLEMENT)
+    elif config.gen_model == 'resnet_adaptado':
+        generator = rn.resnet_adapted_generator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE, disentanglement=config.DISENTANGLEMENT, recompute=config.RECOMPUTE_RESIDUAL_BLOCKS)
+    else:
+        raise utils.GeneratorError(config.gen_model)
 
-# ---- DISCRIMINADORES
-if config.ADVERSARIAL:
-    if config.disc_model == 'patchgan':
-        disc = net.patchgan_discriminator(config.IMG_SIZE, config.OUTPUT_CHANNELS, constrained=constrained)
-    elif config.disc_model == 'progan_adapted':
-        disc = net.progan_discriminator(config.IMG_SIZE, config.OUTPUT_CHANNELS, constrained=constrained, output_type='patchgan')
-    elif config.disc_model == 'progan':
-        disc = net.progan_discriminator(config.IMG_SIZE, config.OUTPUT_CHANNELS, constrained=constrained, output_type='unit')
-    elif config.disc_model == 'residual':
-        disc = net.residual_discriminator(config.IMG_SIZE, config.OUTPUT_CHANNELS, constrained=constrained)
-    elif config.disc_model == 'resnet_adaptado':
-        disc = rn.resnet_adapted_discriminator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE)
+    # ---- DISCRIMINADORES
+    if config.ADVERSARIAL:
+        if config.disc_model == 'patchgan':
+            disc = net.patchgan_discriminator(config.IMG_SIZE, config.OUTPUT_CHANNELS, constrained=constrained)
+        elif config.disc_model == 'progan_adapted':
+            disc = net.progan_discriminator(config.IMG_SIZE, config.OUTPUT_CHANNELS, constrained=constrained, output_type='patchgan')
+        elif config.disc_model == 'progan':
+            disc = net.progan_discriminator(config.IMG_SIZE, config.OUTPUT_CHANNELS, constrained=constrained, output_type='unit')
+        elif config.disc_model == 'residual':
+            disc = net.residual_discriminator(config.IMG_SIZE, config.OUTPUT_CHANNELS, constrained=constrained)
+        elif config.disc_model == 'resnet_adaptado':
+            disc = rn.resnet_adapted_discriminator(config.IMG_SIZE, config.OUTPUT_CHANNELS, config.NORM_TYPE)
+        else:
+            raise utils.DiscriminatorError(config.disc_model)
     else:
-        raise utils.DiscriminatorError(config.disc_model)
-else:
-    disc = None
+        disc = None
+
+    # ---- OTIMIZADORES
+    generator_optimizer = utils.get_optimizer(config.LEARNING_RATE_G, config.ADAM_BETA_1, config.PRECISION_POLICY)
+    if config.ADVERSARIAL:
+        discriminator_optimizer = utils.get_optimizer(config.LEARNING_RATE_D, config.ADAM_BETA_1, config.PRECISION_POLICY)
+    else:
+        discriminator_optimizer = None
+
+# Com batchnorm, as estatísticas do batch concatenado misturariam as imagens reais e sintéticas, então o discriminador é chamado duas vezes
+batched_discriminator = config.BATCHED_DISCRIMINATOR and config.ADVERSARIAL and not utils.has_batch_normalization(disc)
+if config.BATCHED_DISCRIMINATOR and config.ADVERSARIAL and not batched_discriminator:
+    print("O discriminador tem batchnorm: as imagens reais e sintéticas serão discriminadas em chamadas separadas.")
+
+# ---- TREINADOR
+# Guarda os modelos, os otimizadores e a loss, e compila os passos de treinamento e de validação
+# Os acumuladores dos gradientes (ACCUMULATION_STEPS > 1) são pré-alocados, para que a acumulação não aloque memória a cada micro-batch
+gan_trainer = trainer.Trainer(generator, disc, generator_optimizer, discriminator_optimizer, config.loss_type, config.IMG_SIZE, config.OUTPUT_CHANNELS,
+                              lambda_l1=config.LAMBDA, lambda_disc=config.LAMBDA_DISC, lambda_gp=config.LAMBDA_GP,
+                              accumulation_steps=config.ACCUMULATION_STEPS, n_critic=config.N_CRITIC, batched_discriminator=batched_discriminator,
+                              strategy=strategy, jit_compile=config.JIT_COMPILE)
+
+# ---- IMAGENS DE ACOMPANHAMENTO
+# O gerador roda uma vez por batch, e as grades são codificadas e gravadas em segundo plano
+# As grades das imagens fixas são registradas pelo logger, no mesmo destino (LOG_SINK) e na mesma thread das métricas
+previews = preview_writer.PreviewWriter(generator, logger=logger)
 
-# ---- OTIMIZADORES
-generator_optimizer = tf.keras.optimizers.Adam(config.LEARNING_RATE_G, beta_1=config.ADAM_BETA_1)
-if config.ADVERSARIAL:
-    discriminator_optimizer = tf.keras.optimizers.Adam(config.LEARNING_RATE_D, beta_1=config.ADAM_BETA_1)
 
 # %% CONSUMO DE MEMÓRIA
 mem_dict = {}
@@ -657,9 +702,11 @@ if config.ADVERSARIAL:
     mem_dict['disc_mem_usage_gbbytes'] = disc_mem_usage
 
 print("Uso de memória dos datasets:")
-train_ds_mem_usage = utils.get_full_dataset_memory_usage(config.TRAIN_SIZE, config.IMG_SIZE, config.OUTPUT_CHANNELS, data_type=train_dataset.element_spec.dtype)
-test_ds_mem_usage = utils.get_full_dataset_memory_usage(config.TEST_SIZE, config.IMG_SIZE, config.OUTPUT_CHANNELS, data_type=test_dataset.element_spec.dtype)
-val_ds_mem_usage = utils.get_full_dataset_memory_usage(config.VAL_SIZE, config.IMG_SIZE, config.OUTPUT_CHANNELS, data_type=val_dataset.element_spec.dtype)
+# No cache memmap as imagens ficam guardadas em uint8, e não no dtype do dataset (float32)
+cache_dtype = tf.uint8 if (config.USE_CACHE and config.CACHE_MODE in ['memmap', 'memory']) else train_dataset.element_spec.dtype
+train_ds_mem_usage = utils.get_full_dataset_memory_usage(config.TRAIN_SIZE, config.IMG_SIZE, config.OUTPUT_CHANNELS, data_type=cache_dtype)
+test_ds_mem_usage = utils.get_full_dataset_memory_usage(config.TEST_SIZE, config.IMG_SIZE, config.OUTPUT_CHANNELS, data_type=cache_dtype)
+val_ds_mem_usage = utils.get_full_dataset_memory_usage(config.VAL_SIZE, config.IMG_SIZE, config.OUTPUT_CHANNELS, data_type=cache_dtype)
 print(f"Train dataset   = {train_ds_mem_usage:,.2f} GB")
 print(f"Test dataset    = {test_ds_mem_usage:,.2f} GB")
 print(f"Val dataset     = {val_ds_mem_usage:,.2f} GB")
@@ -668,23 +715,70 @@ mem_dict['test_ds_mem_usage_gbytes'] = test_ds_mem_usage
 mem_dict['val_ds_mem_usage_gbytes'] = val_ds_mem_usage
 print("")
 
-wandb.log(mem_dict)
+logger.log(mem_dict)
 
 # %% CHECKPOINTS
 
+# Iterações por época (com vários workers, cada um percorre a sua parte do dataset)
+if config.DROP_REMAINDER:
+    train_batches = config.TRAIN_SIZE_PER_WORKER // config.BATCH_SIZE
+else:
+    train_batches = int(ceil(config.TRAIN_SIZE_PER_WORKER / config.BATCH_SIZE))
+# Com a acumulação de gradientes, cada iteração (atualização dos pesos) usa ACCUMULATION_STEPS batches, e com N_CRITIC > 1
+# usa N_CRITIC batches (um por atualização do discriminador). Os batches que sobram no fim da passada pelo dataset
+# são descartados (assim cada época corresponde a exatamente uma passada)
+batches_per_step = config.ACCUMULATION_STEPS * (config.N_CRITIC if config.ADVERSARIAL else 1)
+config.STEPS_PER_EPOCH = train_batches // batches_per_step
+if config.STEPS_PER_EPOCH == 0:
+    raise BaseException(f"O dataset de treino tem {train_batches} batches por worker, menos que os {batches_per_step} batches de cada iteração.")
+train_batches_per_epoch = config.STEPS_PER_EPOCH * batches_per_step
+
+# Iterador persistente do dataset de treino, que percorre as épocas em sequência
+# O numpy_function do cache memmap não tem estado a salvar, então o estado externo é ignorado no checkpoint do iterador
+train_options = tf.data.Options()
+train_options.experimental_external_state_policy = tf.data.experimental.ExternalStatePolicy.IGNORE
+# O dataset é distribuído entre as réplicas do worker (cada réplica recebe um batch de BATCH_SIZE imagens).
+# Com a estratégia padrão (um único worker) o dataset é usado diretamente
+train_iterator = iter(strategy.distribute_datasets_from_function(
+    lambda input_context: train_dataset.take(train_batches_per_epoch).repeat().with_options(train_options)))
+
+# Posição do treinamento: última época completa, batches já treinados da época atual e iterações desde o início
+train_epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+epoch_step = tf.Variable(0, dtype=tf.int64, trainable=False)
+global_step = tf.Variable(0, dtype=tf.int64, trainable=False)
+
 # Prepara o checkpoint
 if config.ADVERSARIAL:
     # Prepara o checkpoint (adversário)
     ckpt = tf.train.Checkpoint(generator_optimizer=generator_optimizer,
                                discriminator_optimizer=discriminator_optimizer,
                                generator=generator,
-                               disc=disc)
+                               disc=disc,
+                               train_epoch=train_epoch,
+                               epoch_step=epoch_step,
+                               global_step=global_step)
 else:
     # Prepara o checkpoint (não adversário)
     ckpt = tf.train.Checkpoint(generator_optimizer=generator_optimizer,
-                               generator=generator)
-
-ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_dir, max_to_keep=config.KEEP_CHECKPOINTS)
+                               generator=generator,
+                               train_epoch=train_epoch,
+                               epoch_step=epoch_step,
+                               global_step=global_step)
+
+# Com vários workers, cada um lê uma parte diferente do dataset de treino, e o estado do iterador não é salvo.
+# Nesse caso, a época é retomada com um iterador novo, pulando os batches já treinados (ver abaixo).
+# Os caches em memória e em memmap são lidos por índices (ver utils.create_memmap_dataset), então o estado do iterador
+# guarda apenas os índices embaralhados, e não as imagens
+iterator_in_checkpoint = config.CHECKPOINT_DATASET_ITERATOR and NUM_WORKERS == 1
+if config.CHECKPOINT_DATASET_ITERATOR and NUM_WORKERS > 1:
+    print("Aviso: com vários workers o estado do iterador do dataset não é salvo no checkpoint (a época é retomada com um iterador novo).")
+if iterator_in_checkpoint:
+    ckpt.train_iterator = train_iterator
+
+# Os checkpoints são escritos em segundo plano. Todos os workers salvam o checkpoint (a gravação envolve operações
+# coletivas), mas apenas o chefe grava os arquivos na pasta
+ckpt_writer = checkpoint_writer.AsyncCheckpointWriter(ckpt, checkpoint_dir, max_to_keep=config.KEEP_CHECKPOINTS,
+                                                      max_in_flight=config.CHECKPOINT_MAX_IN_FLIGHT, persist=IS_CHIEF)
 
 # Se for o caso, recupera o checkpoint mais recente
 if config.LOAD_CHECKPOINT:
@@ -692,7 +786,19 @@ if config.LOAD_CHECKPOINT:
     if latest_checkpoint is not None:
         print("Carregando checkpoint mais recente...")
         ckpt.restore(latest_checkpoint)
-        config.FIRST_EPOCH = int(latest_checkpoint.split("-")[1]) + 1
+        # Checkpoints antigos (salvos por época, sem a posição do treinamento) têm a época no nome do arquivo
+        if global_step.numpy() == 0 and train_epoch.numpy() == 0 and epoch_step.numpy() == 0:
+            train_epoch.assign(int(latest_checkpoint.split("-")[1]))
+        config.FIRST_EPOCH = int(train_epoch.numpy()) + 1
+        if epoch_step.numpy() > 0:
+            print(f"Retomando a época {config.FIRST_EPOCH} a partir do batch {epoch_step.numpy()} (iteração {global_step.numpy()})")
+            # Sem o estado do iterador, o iterador novo começa uma passada pelo dataset. Os batches já treinados na época
+            # são pulados (com um novo embaralhamento), para que a época continue terminando junto com a passada
+            if not iterator_in_checkpoint:
+                skip_batches = min(int(epoch_step.numpy()), config.STEPS_PER_EPOCH) * batches_per_step
+                print(f"Pulando {skip_batches} batches do dataset de treino...")
+                for _ in range(skip_batches):
+                    next(train_iterator)
     else:
         config.FIRST_EPOCH = 1
 else:
@@ -701,21 +807,25 @@ else:
 
 # %% TREINAMENTO
 
-if config.FIRST_EPOCH <= config.EPOCHS:
-    try:
-        fit(generator, disc, train_dataset, val_dataset, config.FIRST_EPOCH, config.EPOCHS, adversarial=config.ADVERSARIAL)
-    except Exception:
-        # Printa  o uso de memória
-        mem_usage = utils.print_used_memory()
-        wandb.log(mem_usage)
-        # Printa o traceback
-        traceback.print_exc()
-        # Levanta a exceção
-        raise BaseException("Erro durante o treinamento")
+try:
+    if config.FIRST_EPOCH <= config.EPOCHS:
+        try:
+            fit(generator, disc, train_dataset, val_dataset, config.FIRST_EPOCH, config.EPOCHS, adversarial=config.ADVERSARIAL)
+        except Exception:
+            # Printa  o uso de memória
+            mem_usage = utils.print_used_memory()
+            logger.log(mem_usage)
+            # Printa o traceback
+            traceback.print_exc()
+            # Levanta a exceção
+            raise BaseException("Erro durante o treinamento")
+finally:
+    # Espera a escrita dos checkpoints pendentes (também se o treinamento falhar, para não perder o último checkpoint)
+    ckpt_writer.close()
 
 # %% VALIDAÇÃO
 
-if config.VALIDATION:
+if config.VALIDATION and IS_CHIEF:
 
     # Gera imagens do dataset de validação
     print("\nCriando imagens do conjunto de validação...")
@@ -726,27 +836,26 @@ if config.VALIDATION:
     else:
         num_imgs = config.NUM_VAL_PRINTS
 
-    # Prepara a progression bar
-    progbar_iterations = num_imgs
-    progbar = tf.keras.utils.Progbar(progbar_iterations)
+    # Prepara a progression bar (uma grade com até PREVIEW_GRID_SIZE imagens por arquivo)
+    num_grids = int(ceil(num_imgs / config.PREVIEW_GRID_SIZE))
+    progbar = tf.keras.utils.Progbar(num_imgs)
 
     # Rotina de plot das imagens de validação
-    for c, image in val_dataset.enumerate():
-        # Caso seja zero, não plota nenhuma. Caso seja um número positivo, plota a quantidade descrita.
-        if config.NUM_VAL_PRINTS >= 0 and c >= config.NUM_VAL_PRINTS:
-            break
+    val_grids = val_dataset.take(num_imgs).unbatch().batch(config.PREVIEW_GRID_SIZE)
+    for c, images in val_grids.enumerate():
+        # Salva o arquivo
+        i = c.numpy() + 1
+        filename = f"val_results_{str(i).zfill(len(str(num_grids)))}.jpg"
+        previews.write(images, result_val_folder + filename)
 
         # Atualização da progbar
-        i = c.numpy() + 1
-        progbar.update(i)
+        progbar.update(min(i * config.PREVIEW_GRID_SIZE, num_imgs))
 
-        # Salva o arquivo
-        filename = f"val_results_{str(i).zfill(len(str(num_imgs)))}.jpg"
-        utils.generate_images(generator, image, result_val_folder, filename, QUIET_PLOT=QUIET_PLOT)
+    previews.wait()
 
 # %% TESTE
 
-if config.TEST:
+if config.TEST and IS_CHIEF:
 
     # Gera imagens do dataset de teste
     print("\nCriando imagens do conjunto de teste...")
@@ -757,46 +866,48 @@ if config.TEST:
     else:
         num_imgs = config.NUM_TEST_PRINTS
 
-    # Prepara a progression bar
-    progbar_iterations = num_imgs
-    progbar = tf.keras.utils.Progbar(progbar_iterations)
+    # Prepara a progression bar (uma grade com até PREVIEW_GRID_SIZE imagens por arquivo)
+    num_grids = int(ceil(num_imgs / config.PREVIEW_GRID_SIZE))
+    progbar = tf.keras.utils.Progbar(num_imgs)
 
     # Rotina de plot das imagens de teste
+    test_grids = test_dataset.take(num_imgs).unbatch().batch(config.PREVIEW_GRID_SIZE)
     t1 = time.perf_counter()
-    for c, image in test_dataset.enumerate():
-        # Caso seja zero, não plota nenhuma. Caso seja um número positivo, plota a quantidade descrita.
-        if config.NUM_TEST_PRINTS >= 0 and c >= config.NUM_TEST_PRINTS:
-            break
-
-        # Atualização da progbar
+    for c, images in test_grids.enumerate():
+        # Salva o arquivo
         i = c.numpy() + 1
-        progbar.update(i)
+        filename = f"test_results_{str(i).zfill(len(str(num_grids)))}.jpg"
+        previews.write(images, result_test_folder + filename)
 
-        # Salva o arquivo
-        filename = f"test_results_{str(i).zfill(len(str(num_imgs)))}.jpg"
-        utils.generate_images(generator, image, result_test_folder, filename, QUIET_PLOT=QUIET_PLOT)
+        # Atualização da progbar
+        progbar.update(min(i * config.PREVIEW_GRID_SIZE, num_imgs))
 
+    # Inclui o tempo da gravação das imagens pendentes
+    previews.wait()
     dt = time.perf_counter() - t1
 
     # Loga os tempos de inferência no wandb
     if num_imgs != 0:
         mean_inference_time = dt / num_imgs
-        wandb.log({'mean inference time (s)': mean_inference_time})
+        logger.log({'mean inference time (s)': mean_inference_time})
 
     # Gera métricas do dataset de teste
     print("Iniciando avaliação das métricas de qualidade do dataset de teste")
     test_sample = test_dataset.unbatch().batch(config.METRIC_BATCH_SIZE).take(config.METRIC_SAMPLE_SIZE_TEST)  # Corrige o tamanho do batch
-    metric_results = metrics.evaluate_metrics(test_sample, generator, config.EVALUATE_IS, config.EVALUATE_FID, config.EVALUATE_L1)
+    metric_results = metrics.evaluate_metrics(test_sample, generator, config.EVALUATE_IS, config.EVALUATE_FID, config.EVALUATE_L1,
+                                              num_batches=config.METRIC_SAMPLE_SIZE_TEST)
     test_metrics = {k + "_test": v for k, v in metric_results.items()}  # Renomeia o dicionário para incluir "_test" no final das keys
-    wandb.log(test_metrics)
+    logger.log(test_metrics)
 
 # %% FINAL
 
-# Finaliza o Weights and Biases
+# Espera a gravação das imagens pendentes, registra as métricas pendentes e finaliza o Weights and Biases
+previews.close()
+logger.close()
 wandb.finish()
 
 # Salva os modelos
-if config.SAVE_MODELS:
+if config.SAVE_MODELS and IS_CHIEF:
     print("Salvando modelos...\n")
     generator.save(model_folder + 'generator.h5')
     if config.ADVERSARIAL:
@@ -3,7 +3,6 @@ import time
 import numpy as np
 
 from scipy.linalg import sqrtm
-from sklearn.metrics import accuracy_score as accuracy
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Silencia o TF (https://stackoverflow.com/questions/35911252/disable-tensorflow-debugging-information)
 import tensorflow as tf
@@ -22,14 +21,19 @@ model_FID = InceptionV3(include_top=False, pooling='avg', input_shape=(299, 299,
 # %% FUNÇÕES BASE
 
 
-def evaluate_metrics(sample_ds, generator, evaluate_is, evaluate_fid, evaluate_l1, verbose=False):
+def evaluate_metrics(sample_ds, generator, evaluate_is, evaluate_fid, evaluate_l1, verbose=False, num_batches=None):
     """Calcula as métricas de qualidade.
 
     Calcula Inception Score e Frechét Inception Distance para o gerador.
     Calcula a distância L1 (distância média absoluta pixel a pixel) entre a imagem sintética e a objetivo.
+    O tamanho da progression bar vem de num_batches ou da cardinalidade do sample_ds (sem percorrer o dataset).
     """
     # Prepara a progression bar
-    progbar_iterations = len(list(sample_ds))
+    if num_batches is not None:
+        progbar_iterations = num_batches
+    else:
+        cardinality = int(sample_ds.cardinality())
+        progbar_iterations = cardinality if cardinality >= 0 else None
     progbar = tf.keras.utils.Progbar(progbar_iterations)
 
     # Prepara as listas que irão guardar as medidas
@@ -244,42 +248,50 @@ def get_l1_distance(image1, image2):
 
 
 # Acurácia do discriminador
-def evaluate_accuracy(generator, discriminator, test_ds, y_real, y_pred, window=100):
-    """Avalia a acurácia do discriminador, como um classificador binário."""
-    # Gera uma imagem-base
-    for img_real in test_ds.take(1):
-        target = img_real
-
-        # A partir dela, gera uma imagem sintética
-        img_fake = generator(img_real, training=True)
-
-        # Avalia ambas
-        disc_real = discriminator([img_real, target], training=True)
-        disc_fake = discriminator([img_fake, target], training=True)
-
-        # Para o caso de ser um discriminador PatchGAN, tira a média
-        disc_real = np.mean(disc_real)
-        disc_fake = np.mean(disc_fake)
-
-        # Aplica o threshold
-        disc_real = 1 if disc_real > 0.5 else 0
-        disc_fake = 1 if disc_fake > 0.5 else 0
-
-        # Acrescenta a observação real como y_real = 1
-        y_real.append(1)
-        y_pred.append(disc_real)
-
-        # Acrescenta a observação fake como y_real = 0
-        y_real.append(0)
-        y_pred.append(disc_fake)
-
-        # Calcula a acurácia pela janela
-        if len(y_real) > window:
-            acc = accuracy(y_real[-window:], y_pred[-window:])
-        else:
-            acc = accuracy(y_real, y_pred)
+class StreamingAccuracy(tf.Module):
+    """Acurácia do discriminador como um classificador binário, calculada sobre uma janela móvel de observações.
+
+    Usa as saídas (logits) que o próprio passo de treinamento já calculou para as imagens reais e sintéticas.
+    Os acertos ficam em um buffer circular de tamanho fixo na GPU, então a memória não cresce ao longo do treinamento.
+    """
 
-        return y_real, y_pred, acc
+    def __init__(self, window=100, threshold=0.5, name=None):
+        super().__init__(name=name)
+        self.window = window
+        self.threshold = threshold
+        self.hits = tf.Variable(tf.zeros([window]), trainable=False)
+        self.position = tf.Variable(0, dtype=tf.int32, trainable=False)
+        self.count = tf.Variable(0, dtype=tf.int32, trainable=False)
+
+    @tf.function
+    def update_state(self, disc_real, disc_fake):
+        """Acrescenta as observações de um batch: imagens reais (y_real = 1) e sintéticas (y_real = 0)."""
+        # Para o caso de ser um discriminador PatchGAN, tira a média de cada imagem
+        disc_real = tf.reduce_mean(tf.reshape(tf.cast(disc_real, tf.float32), [tf.shape(disc_real)[0], -1]), axis=1)
+        disc_fake = tf.reduce_mean(tf.reshape(tf.cast(disc_fake, tf.float32), [tf.shape(disc_fake)[0], -1]), axis=1)
+
+        # Aplica o threshold: acerto quando a real é classificada como 1 e a sintética como 0
+        # As reais e as sintéticas são intercaladas (real, sintética, real, ...), para que, se o batch for maior que a janela,
+        # o corte mantenha as duas classes na mesma proporção
+        hits = tf.stack([disc_real > self.threshold, disc_fake <= self.threshold], axis=1)
+        hits = tf.cast(tf.reshape(hits, [-1]), tf.float32)
+        hits = hits[-self.window:]
+        num_hits = tf.shape(hits)[0]
+
+        # Escreve no buffer circular, a partir da posição atual
+        indices = (self.position + tf.range(num_hits)) % self.window
+        self.hits.scatter_nd_update(indices[:, tf.newaxis], hits)
+        self.position.assign((self.position + num_hits) % self.window)
+        self.count.assign(tf.minimum(self.count + num_hits, self.window))
+
+    def result(self):
+        """Retorna a acurácia na janela"""
+        return tf.reduce_sum(self.hits) / tf.cast(tf.maximum(self.count, 1), tf.float32)
+
+    def reset_state(self):
+        self.hits.assign(tf.zeros([self.window]))
+        self.position.assign(0)
+        self.count.assign(0)
 
 
 # %% TESTE
@@ -0,0 +1,207 @@
+""" Registro das métricas de treinamento, com buffer e envio em segundo plano """
+
+import os
+import json
+import time
+import queue
+import sqlite3
+import threading
+import numpy as np
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Silencia o TF (https://stackoverflow.com/questions/35911252/disable-tensorflow-debugging-information)
+import tensorflow as tf
+import wandb
+
+# %% DESTINOS (SINKS)
+
+'''
+Os sinks recebem dicionários de valores numéricos (já convertidos para Python) e os gravam em algum destino.
+As imagens de acompanhamento (log_image) só são enviadas pelo WandbSink; nos demais elas já estão gravadas em disco.
+Todas as chamadas são feitas a partir da thread do MetricsLogger, então um sink pode manter conexões abertas.
+'''
+
+
+class WandbSink:
+    """Envia as métricas para o Weights and Biases (com wandb.init(mode='offline') elas são gravadas localmente)."""
+
+    def log(self, values):
+        wandb.log(values)
+
+    def log_image(self, key, image, caption=None):
+        wandb.log({key: wandb.Image(image, caption=caption)})
+
+    def close(self):
+        pass
+
+
+class JsonlSink:
+    """Grava as métricas em um arquivo JSONL (um dicionário por linha)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def log(self, values):
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(json.dumps(values) + '\n')
+        self.file.flush()
+
+    def log_image(self, key, image, caption=None):
+        pass
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class SqliteSink:
+    """Grava as métricas em um banco SQLite, na tabela metrics(time, name, value)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+
+    def log(self, values):
+        # A conexão é criada na thread que a usa (exigência do sqlite3)
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS metrics (time REAL, name TEXT, value REAL)")
+        t = time.time()
+        rows = [(t, name, value) for name, value in values.items() if isinstance(value, (int, float))]
+        self.connection.executemany("INSERT INTO metrics VALUES (?, ?, ?)", rows)
+        self.connection.commit()
+
+    def log_image(self, key, image, caption=None):
+        pass
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+class NullSink:
+    """Descarta as métricas."""
+
+    def log(self, values):
+        pass
+
+    def log_image(self, key, image, caption=None):
+        pass
+
+    def close(self):
+        pass
+
+
+def get_sink(sink_type, log_folder=None):
+    """Cria o sink: 'wandb', 'jsonl', 'sqlite' ou 'none'. Os arquivos locais são gravados em log_folder."""
+    if sink_type == 'wandb':
+        return WandbSink()
+    elif sink_type == 'jsonl':
+        return JsonlSink(os.path.join(log_folder, 'metrics.jsonl'))
+    elif sink_type == 'sqlite':
+        return SqliteSink(os.path.join(log_folder, 'metrics.sqlite'))
+    elif sink_type == 'none':
+        return NullSink()
+    raise BaseException(f"Sink de métricas {sink_type} desconhecido. Opções = 'wandb', 'jsonl', 'sqlite' ou 'none'.")
+
+
+# %% LOGGER
+
+def to_python(value):
+    """Converte tensores / arrays numpy escalares em números Python"""
+    if isinstance(value, (tf.Tensor, tf.Variable)):
+        value = value.numpy()
+    if isinstance(value, np.ndarray) or isinstance(value, np.generic):
+        value = value.item()
+    return value
+
+
+class MetricsLogger:
+    """Acumula as métricas de cada step e as envia agregadas, a cada flush_every steps, por uma thread em segundo plano.
+
+    Os tensores de cada step ficam na GPU (sem sincronização com o host) até o flush, quando são concatenados
+    e entregues à thread, que faz a conversão para numpy, calcula média / mínimo / máximo da janela e chama o sink.
+    Valores que não são tensores (época, step) são registrados com o último valor da janela.
+    Métricas avulsas (por época, validação) podem ser registradas sem agregação com log(), e imagens com log_image().
+    Como todas passam pela mesma thread, só ela chama o sink (e o wandb).
+    """
+
+    def __init__(self, sink, flush_every=50, max_pending=8):
+        self.sink = sink
+        self.flush_every = flush_every
+        self.window = []
+        self.window_steps = 0
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def log_step(self, values):
+        """Acumula as métricas (escalares) de um step de treinamento"""
+        self.log_steps(values, 1)
+
+    def log_steps(self, values, num_steps):
+        """Acumula as métricas de num_steps steps de treinamento, já empilhadas (um tensor de tamanho num_steps por métrica)"""
+        self.window.append(values)
+        self.window_steps += num_steps
+        if self.window_steps >= self.flush_every:
+            self.flush()
+
+    def log(self, values):
+        """Registra métricas sem agregação (a conversão dos tensores também é feita em segundo plano)"""
+        self.queue.put(('raw', values))
+
+    def log_image(self, key, image, caption=None):
+        """Registra uma imagem uint8 [H, W, C] (pode ser chamado de outras threads, como as do PreviewWriter)"""
+        self.queue.put(('image', (key, image, caption)))
+
+    def flush(self):
+        """Envia a janela atual para a thread"""
+        if not self.window:
+            return
+        window = self.window
+        self.window = []
+        self.window_steps = 0
+        stacked = {}
+        for key in window[0]:
+            if isinstance(window[0][key], (tf.Tensor, tf.Variable)):
+                stacked[key] = tf.concat([tf.reshape(tf.cast(values[key], tf.float32), [-1]) for values in window], axis=0)
+            else:
+                stacked[key] = window[-1][key]
+        self.queue.put(('window', stacked))
+
+    def close(self):
+        """Envia o que restou e espera a thread terminar"""
+        self.flush()
+        self.queue.put(('close', None))
+        self.thread.join()
+
+    def _worker(self):
+        while True:
+            kind, values = self.queue.get()
+            if kind == 'close':
+                self.sink.close()
+                break
+            try:
+                if kind == 'window':
+                    self.sink.log(self._aggregate(values))
+                elif kind == 'image':
+                    self.sink.log_image(*values)
+                else:
+                    self.sink.log({key: to_python(value) for key, value in values.items()})
+            except Exception as e:
+                # Um erro no envio das métricas não deve interromper o treinamento
+                print(f"Erro ao registrar as métricas: {e}")
+
+    @staticmethod
+    def _aggregate(stacked):
+        aggregated = {}
+        for key, value in stacked.items():
+            if isinstance(value, tf.Tensor):
+                array = value.numpy()
+                aggregated[key] = float(np.mean(array))
+                aggregated[key + '_min'] = float(np.min(array))
+                aggregated[key + '_max'] = float(np.max(array))
+            else:
+                aggregated[key] = to_python(value)
+        return aggregated
@@ -1,4 +1,5 @@
 import os
+from functools import partial
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 import tensorflow as tf
@@ -10,6 +11,9 @@ from tensorflow.keras import backend
 # Modo de inicialização dos pesos
 initializer = tf.random_normal_initializer(0., 0.02)
 
+# As camadas de normalização e a ativação tanh da saída usam sempre float32 (dtype='float32'),
+# mesmo quando a política de precisão mista (mixed_float16 / mixed_bfloat16) está ativa
+
 # %% CLASSES AUXILIARES
 
 
@@ -17,8 +21,8 @@ class PixelNormalization(tf.keras.layers.Layer):
 
     """Pixel Normalization (usada na ProGAN)."""
 
-    def __init__(self):
-        super(PixelNormalization, self).__init__()
+    def __init__(self, **kwargs):
+        super(PixelNormalization, self).__init__(**kwargs)
         self.epsilon = 1e-8
 
     def call(self, inputs):
@@ -46,6 +50,42 @@ class ClipConstraint(Constraint):
     def get_config(self):
         return {'clip_value': self.clip_value}
 
+
+@tf.keras.utils.register_keras_serializable(package='Autoencoders')
+class RecomputeGrad(tf.keras.layers.Layer):
+
+    """
+    Executa um bloco (sub-modelo) sem guardar as ativações intermediárias para o backward (gradient checkpointing).
+    Apenas a entrada do bloco é guardada, e as ativações são recalculadas durante o cálculo dos gradientes,
+    trocando memória por tempo de processamento (aprox. um forward a mais por bloco).
+    https://arxiv.org/abs/1604.06174
+    """
+
+    def __init__(self, block, **kwargs):
+        super(RecomputeGrad, self).__init__(**kwargs)
+        self.block = block
+
+    def call(self, inputs, training=None):
+        return tf.recompute_grad(lambda x: self.block(x, training=training))(inputs)
+
+    def get_config(self):
+        config = super(RecomputeGrad, self).get_config()
+        config['block'] = self.block.get_config()
+        return config
+
+    @classmethod
+    def from_config(cls, config):
+        custom_objects = {'PixelNormalization': PixelNormalization, 'InstanceNormalization': tfa.layers.InstanceNormalization}
+        config['block'] = tf.keras.Model.from_config(config['block'], custom_objects=custom_objects)
+        return cls(**config)
+
+
+def recompute_block(block_fn, input_tensor, *args, **kwargs):
+    """Cria o bloco block_fn como um sub-modelo e o aplica em input_tensor com recomputação das ativações (RecomputeGrad)"""
+    inputs = tf.keras.layers.Input(shape=input_tensor.shape[1:], dtype=input_tensor.dtype)
+    block = tf.keras.Model(inputs=inputs, outputs=block_fn(inputs, *args, **kwargs))
+    return RecomputeGrad(block)(input_tensor)
+
 # %% BLOCOS
 
 # -- Básicos
@@ -55,11 +95,11 @@ def upsample(x, filters, kernel_size=(3, 3), apply_dropout=False, norm_type='ins
 
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -77,11 +117,11 @@ def downsample(x, filters, kernel_size=(3, 3), apply_norm=True, norm_type='insta
 
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -97,20 +137,24 @@ def downsample(x, filters, kernel_size=(3, 3), apply_norm=True, norm_type='insta
 # -- Residuais
 
 
-def residual_block(input_tensor, filters, norm_type='instancenorm'):
+def residual_block(input_tensor, filters, norm_type='instancenorm', recompute=False):
 
     '''
     Cria um bloco resnet baseado na Resnet34
     https://openaccess.thecvf.com/content_cvpr_2016/papers/He_Deep_Residual_Learning_CVPR_2016_paper.pdf
     '''
 
+    # Recomputa as ativações do bloco no backward em vez de guardá-las
+    if recompute:
+        return recompute_block(residual_block, input_tensor, filters, norm_type=norm_type)
+
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -133,20 +177,24 @@ def residual_block(input_tensor, filters, norm_type='instancenorm'):
     return x
 
 
-def residual_block_transpose(input_tensor, filters, norm_type='instancenorm'):
+def residual_block_transpose(input_tensor, filters, norm_type='instancenorm', recompute=False):
 
     '''
     Cria um bloco resnet baseado na Resnet34, mas invertido (convoluções transpostas)
     https://openaccess.thecvf.com/content_cvpr_2016/papers/He_Deep_Residual_Learning_CVPR_2016_paper.pdf
     '''
 
+    # Recomputa as ativações do bloco no backward em vez de guardá-las
+    if recompute:
+        return recompute_block(residual_block_transpose, input_tensor, filters, norm_type=norm_type)
+
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -178,11 +226,11 @@ def residual_bottleneck_block(input_tensor, filters, norm_type='instancenorm'):
 
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -219,11 +267,11 @@ def residual_downsample_bottleneck_block(input_tensor, filters, norm_type='insta
 
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -298,11 +346,11 @@ def simple_upsample_block(x, filters, scale=2, kernel_size=(3, 3), interpolation
 
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -352,7 +400,7 @@ def pix2pix_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE):
     x = upsample(x, 64, 4, norm_type=NORM_TYPE)
 
     initializer = tf.random_normal_initializer(0., 0.02)
-    x = tf.keras.layers.Conv2DTranspose(OUTPUT_CHANNELS, 4, strides=2, padding='same', kernel_initializer=initializer, activation='tanh')(x)
+    x = tf.keras.layers.Conv2DTranspose(OUTPUT_CHANNELS, 4, strides=2, padding='same', kernel_initializer=initializer, activation='tanh', dtype='float32')(x)
 
     return tf.keras.Model(inputs=inputs, outputs=x)
 
@@ -394,12 +442,12 @@ def unet_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE):
         x = tf.keras.layers.Concatenate()([x, skip])
 
     # Última camada
-    x = tf.keras.layers.Conv2DTranspose(OUTPUT_CHANNELS, 4, strides=2, padding='same', kernel_initializer=initializer, activation='tanh')(x)
+    x = tf.keras.layers.Conv2DTranspose(OUTPUT_CHANNELS, 4, strides=2, padding='same', kernel_initializer=initializer, activation='tanh', dtype='float32')(x)
 
     return tf.keras.Model(inputs=inputs, outputs=x)
 
 
-def residual_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, create_latent_vector=False, num_residual_blocks=6):
+def residual_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, create_latent_vector=False, num_residual_blocks=6, recompute=False):
 
     '''
     Adaptado do gerador utilizado nos papers Pix2Pix e CycleGAN
@@ -408,11 +456,11 @@ def residual_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, create_latent_vecto
 
     # Define o tipo de normalização usada
     if NORM_TYPE == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif NORM_TYPE == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif NORM_TYPE == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -438,7 +486,7 @@ def residual_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, create_latent_vecto
 
     # Blocos Residuais
     for i in range(num_residual_blocks):
-        x = residual_block(x, 256, norm_type=NORM_TYPE)
+        x = residual_block(x, 256, norm_type=NORM_TYPE, recompute=recompute)
 
     # Criação do vetor latente
     if create_latent_vector:
@@ -481,7 +529,7 @@ def residual_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, create_latent_vecto
 
         # Camadas finais
         x = tf.keras.layers.Conv2D(filters=3, kernel_size=(7, 7), strides=(1, 1), padding="same", kernel_initializer=initializer, use_bias=True)(x)
-        x = tf.keras.layers.Activation('tanh')(x)
+        x = tf.keras.layers.Activation('tanh', dtype='float32')(x)
 
     else:
         # Reconstrução da imagem
@@ -496,7 +544,7 @@ def residual_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, create_latent_vecto
         # Camadas finais
         x = tf.keras.layers.ZeroPadding2D([[2, 2], [2, 2]])(x)
         x = tf.keras.layers.Conv2D(filters=OUTPUT_CHANNELS, kernel_size=(7, 7), strides=(1, 1), padding="same", kernel_initializer=initializer, use_bias=True)(x)
-        x = tf.keras.layers.Activation('tanh')(x)
+        x = tf.keras.layers.Activation('tanh', dtype='float32')(x)
 
     # Cria o modelo
     return tf.keras.Model(inputs=inputs, outputs=x)
@@ -505,7 +553,7 @@ def residual_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, create_latent_vecto
 # Modelos customizados
 
 
-def full_residual_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentanglement='none', num_residual_blocks=6):
+def full_residual_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentanglement='none', num_residual_blocks=6, recompute=False):
 
     '''
     Adaptado com base no gerador Resnet da Pix2Pix
@@ -515,11 +563,11 @@ def full_residual_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentanglemen
 
     # Define o tipo de normalização usada
     if NORM_TYPE == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif NORM_TYPE == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif NORM_TYPE == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -545,7 +593,7 @@ def full_residual_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentanglemen
 
     # Blocos Residuais
     for i in range(num_residual_blocks):
-        x = residual_block(x, 256, norm_type=NORM_TYPE)
+        x = residual_block(x, 256, norm_type=NORM_TYPE, recompute=recompute)
 
     # Criação do vetor latente
     vecsize = 512
@@ -617,7 +665,7 @@ def full_residual_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentanglemen
 
     # Blocos Residuais
     for i in range(num_residual_blocks):
-        x = residual_block_transpose(x, 256, norm_type=NORM_TYPE)
+        x = residual_block_transpose(x, 256, norm_type=NORM_TYPE, recompute=recompute)
 
     # Reconstrução pós blocos residuais
 
@@ -634,13 +682,13 @@ def full_residual_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentanglemen
 
     # Camadas finais
     x = tf.keras.layers.Conv2DTranspose(filters=OUTPUT_CHANNELS, kernel_size=(3, 3), strides=(1, 1), padding="same", kernel_initializer=initializer, use_bias=True)(x)
-    x = tf.keras.layers.Activation('tanh')(x)
+    x = tf.keras.layers.Activation('tanh', dtype='float32')(x)
 
     # Cria o modelo
     return tf.keras.Model(inputs=inputs, outputs=x)
 
 
-def simple_decoder_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentanglement='none', num_residual_blocks=6):
+def simple_decoder_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentanglement='none', num_residual_blocks=6, recompute=False):
 
     '''
     Adaptado com base no gerador Resnet da Pix2Pix
@@ -650,11 +698,11 @@ def simple_decoder_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentangleme
 
     # Define o tipo de normalização usada
     if NORM_TYPE == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif NORM_TYPE == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif NORM_TYPE == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -680,7 +728,7 @@ def simple_decoder_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentangleme
 
     # Blocos Residuais
     for i in range(num_residual_blocks):
-        x = residual_block(x, 256, norm_type=NORM_TYPE)
+        x = residual_block(x, 256, norm_type=NORM_TYPE, recompute=recompute)
 
     # Criação do vetor latente
     vecsize = 512
@@ -738,7 +786,7 @@ def simple_decoder_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentangleme
 
     # Camadas finais
     x = tf.keras.layers.Conv2DTranspose(filters=OUTPUT_CHANNELS, kernel_size=(3, 3), strides=(1, 1), padding="same", kernel_initializer=initializer, use_bias=True)(x)
-    x = tf.keras.layers.Activation('tanh')(x)
+    x = tf.keras.layers.Activation('tanh', dtype='float32')(x)
 
     # Cria o modelo
     return tf.keras.Model(inputs=inputs, outputs=x)
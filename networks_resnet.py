@@ -1,13 +1,19 @@
 import os
+from functools import partial
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 import tensorflow as tf
 tf.get_logger().setLevel('ERROR')
 import tensorflow_addons as tfa
 
+from networks_general import recompute_block
+
 # Modo de inicialização dos pesos
 initializer = tf.random_normal_initializer(0., 0.02)
 
+# As camadas de normalização e a ativação tanh da saída usam sempre float32 (dtype='float32'),
+# mesmo quando a política de precisão mista (mixed_float16 / mixed_bfloat16) está ativa
+
 # %% CLASSES AUXILIARES
 
 
@@ -15,8 +21,8 @@ class PixelNormalization(tf.keras.layers.Layer):
 
     """Pixel Normalization (usada na ProGAN)."""
 
-    def __init__(self):
-        super(PixelNormalization, self).__init__()
+    def __init__(self, **kwargs):
+        super(PixelNormalization, self).__init__(**kwargs)
         self.epsilon = 1e-8
 
     def call(self, inputs):
@@ -29,20 +35,24 @@ class PixelNormalization(tf.keras.layers.Layer):
 # -- Residuais
 
 
-def residual_block(input_tensor, filters, norm_type='instancenorm'):
+def residual_block(input_tensor, filters, norm_type='instancenorm', recompute=False):
 
     '''
     Cria um bloco resnet baseado na Resnet34
     https://openaccess.thecvf.com/content_cvpr_2016/papers/He_Deep_Residual_Learning_CVPR_2016_paper.pdf
     '''
 
+    # Recomputa as ativações do bloco no backward em vez de guardá-las
+    if recompute:
+        return recompute_block(residual_block, input_tensor, filters, norm_type=norm_type)
+
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -65,20 +75,24 @@ def residual_block(input_tensor, filters, norm_type='instancenorm'):
     return x
 
 
-def residual_downsample_block(input_tensor, filters, norm_type='instancenorm'):
+def residual_downsample_block(input_tensor, filters, norm_type='instancenorm', recompute=False):
 
     '''
     Cria um bloco resnet baseado na Resnet34
     https://openaccess.thecvf.com/content_cvpr_2016/papers/He_Deep_Residual_Learning_CVPR_2016_paper.pdf
     '''
 
+    # Recomputa as ativações do bloco no backward em vez de guardá-las
+    if recompute:
+        return recompute_block(residual_downsample_block, input_tensor, filters, norm_type=norm_type)
+
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -105,20 +119,24 @@ def residual_downsample_block(input_tensor, filters, norm_type='instancenorm'):
     return x
 
 
-def residual_block_transpose(input_tensor, filters, norm_type='instancenorm'):
+def residual_block_transpose(input_tensor, filters, norm_type='instancenorm', recompute=False):
 
     '''
     Cria um bloco resnet baseado na Resnet34, mas invertido (convoluções transpostas)
     https://openaccess.thecvf.com/content_cvpr_2016/papers/He_Deep_Residual_Learning_CVPR_2016_paper.pdf
     '''
 
+    # Recomputa as ativações do bloco no backward em vez de guardá-las
+    if recompute:
+        return recompute_block(residual_block_transpose, input_tensor, filters, norm_type=norm_type)
+
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -141,20 +159,24 @@ def residual_block_transpose(input_tensor, filters, norm_type='instancenorm'):
     return x
 
 
-def residual_block_transpose_upsample(input_tensor, filters, norm_type='instancenorm'):
+def residual_block_transpose_upsample(input_tensor, filters, norm_type='instancenorm', recompute=False):
 
     '''
     Cria um bloco resnet baseado na Resnet34, mas invertido (convoluções transpostas)
     https://openaccess.thecvf.com/content_cvpr_2016/papers/He_Deep_Residual_Learning_CVPR_2016_paper.pdf
     '''
 
+    # Recomputa as ativações do bloco no backward em vez de guardá-las
+    if recompute:
+        return recompute_block(residual_block_transpose_upsample, input_tensor, filters, norm_type=norm_type)
+
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -190,11 +212,11 @@ def residual_bottleneck_block(input_tensor, filters, norm_type='instancenorm'):
 
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -225,7 +247,7 @@ def residual_bottleneck_block(input_tensor, filters, norm_type='instancenorm'):
 
 # %% GERADORES
 
-def resnet_adapted_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentanglement='none'):
+def resnet_adapted_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentanglement='none', recompute=False):
 
     '''
     Adaptado com base no gerador Resnet da Pix2Pix
@@ -235,11 +257,11 @@ def resnet_adapted_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentangleme
 
     # Define o tipo de normalização usada
     if NORM_TYPE == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif NORM_TYPE == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif NORM_TYPE == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -255,32 +277,32 @@ def resnet_adapted_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentangleme
 
     if IMG_SIZE == 256:
         # Etapa 256
-        x = residual_block(x, 64, norm_type=NORM_TYPE)
-        x = residual_block(x, 64, norm_type=NORM_TYPE)
-        x = residual_block(x, 64, norm_type=NORM_TYPE)
+        x = residual_block(x, 64, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block(x, 64, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block(x, 64, norm_type=NORM_TYPE, recompute=recompute)
 
         # Etapa 128
-        x = residual_downsample_block(x, 64, norm_type=NORM_TYPE)
-        x = residual_block(x, 64, norm_type=NORM_TYPE)
-        x = residual_block(x, 64, norm_type=NORM_TYPE)
+        x = residual_downsample_block(x, 64, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block(x, 64, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block(x, 64, norm_type=NORM_TYPE, recompute=recompute)
 
     else:
         # Etapa 128
-        x = residual_block(x, 64, norm_type=NORM_TYPE)
-        x = residual_block(x, 64, norm_type=NORM_TYPE)
-        x = residual_block(x, 64, norm_type=NORM_TYPE)
+        x = residual_block(x, 64, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block(x, 64, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block(x, 64, norm_type=NORM_TYPE, recompute=recompute)
 
     # Etapas 64 - 16
     for i in range(3):
-        x = residual_downsample_block(x, 128, norm_type=NORM_TYPE)
-        x = residual_block(x, 128, norm_type=NORM_TYPE)
-        x = residual_block(x, 128, norm_type=NORM_TYPE)
+        x = residual_downsample_block(x, 128, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block(x, 128, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block(x, 128, norm_type=NORM_TYPE, recompute=recompute)
 
     # Etapas 8 - 4
     for i in range(2):
-        x = residual_downsample_block(x, 256, norm_type=NORM_TYPE)
-        x = residual_block(x, 256, norm_type=NORM_TYPE)
-        x = residual_block(x, 256, norm_type=NORM_TYPE)
+        x = residual_downsample_block(x, 256, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block(x, 256, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block(x, 256, norm_type=NORM_TYPE, recompute=recompute)
 
     # 4 para 1
     x = tf.keras.layers.Conv2D(512, (3, 3), strides=1, kernel_initializer=initializer, padding='same')(x)  # (bs, 512, 4, 4)
@@ -329,30 +351,30 @@ def resnet_adapted_generator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE, disentangleme
 
     # Etapas 2 - 8
     for i in range(3):
-        x = residual_block_transpose_upsample(x, 256, norm_type=NORM_TYPE)
-        x = residual_block_transpose(x, 256, norm_type=NORM_TYPE)
-        x = residual_block_transpose(x, 256, norm_type=NORM_TYPE)
+        x = residual_block_transpose_upsample(x, 256, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block_transpose(x, 256, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block_transpose(x, 256, norm_type=NORM_TYPE, recompute=recompute)
 
     # Etapas 16 - 64
     for i in range(3):
-        x = residual_block_transpose_upsample(x, 128, norm_type=NORM_TYPE)
-        x = residual_block_transpose(x, 128, norm_type=NORM_TYPE)
-        x = residual_block_transpose(x, 128, norm_type=NORM_TYPE)
+        x = residual_block_transpose_upsample(x, 128, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block_transpose(x, 128, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block_transpose(x, 128, norm_type=NORM_TYPE, recompute=recompute)
 
     # Etapa 128
-    x = residual_block_transpose_upsample(x, 64, norm_type=NORM_TYPE)
-    x = residual_block_transpose(x, 64, norm_type=NORM_TYPE)
-    x = residual_block_transpose(x, 64, norm_type=NORM_TYPE)
+    x = residual_block_transpose_upsample(x, 64, norm_type=NORM_TYPE, recompute=recompute)
+    x = residual_block_transpose(x, 64, norm_type=NORM_TYPE, recompute=recompute)
+    x = residual_block_transpose(x, 64, norm_type=NORM_TYPE, recompute=recompute)
 
     if IMG_SIZE == 256:
         # Etapa 256
-        x = residual_block_transpose_upsample(x, 64, norm_type=NORM_TYPE)
-        x = residual_block_transpose(x, 64, norm_type=NORM_TYPE)
-        x = residual_block_transpose(x, 64, norm_type=NORM_TYPE)
+        x = residual_block_transpose_upsample(x, 64, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block_transpose(x, 64, norm_type=NORM_TYPE, recompute=recompute)
+        x = residual_block_transpose(x, 64, norm_type=NORM_TYPE, recompute=recompute)
         
     # Camadas finais
     x = tf.keras.layers.Conv2DTranspose(filters=OUTPUT_CHANNELS, kernel_size=(3, 3), strides=(1, 1), padding="same", kernel_initializer=initializer, use_bias=True)(x)
-    x = tf.keras.layers.Activation('tanh')(x)
+    x = tf.keras.layers.Activation('tanh', dtype='float32')(x)
 
     # Cria o modelo
     return tf.keras.Model(inputs=inputs, outputs=x)
@@ -370,11 +392,11 @@ def resnet_adapted_discriminator(IMG_SIZE, OUTPUT_CHANNELS, NORM_TYPE):
 
     # Define o tipo de normalização usada
     if NORM_TYPE == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif NORM_TYPE == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif NORM_TYPE == 'pixelnorm':
-        norm_layer = PixelNormalization
+        norm_layer = partial(PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -0,0 +1,103 @@
+""" Imagens de acompanhamento do gerador (entrada / saída), sem o matplotlib """
+
+import os
+from math import ceil, sqrt
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Silencia o TF (https://stackoverflow.com/questions/35911252/disable-tensorflow-debugging-information)
+import tensorflow as tf
+
+# %% GRADE DE IMAGENS
+
+
+def tile_pairs(input_images, output_images, columns=None, padding=2):
+    """Monta uma grade uint8 com os pares (entrada | saída) lado a lado.
+
+    Recebe dois arrays uint8 [N, H, W, C] e retorna um array [linhas * H, colunas * 2W, C] (mais o espaçamento),
+    com as posições vazias em branco. Por padrão, a grade é aproximadamente quadrada (colunas = ceil(sqrt(N))).
+    """
+    pairs = np.concatenate([input_images, output_images], axis=2)
+    num_pairs, height, width, channels = pairs.shape
+    if columns is None:
+        columns = int(ceil(sqrt(num_pairs)))
+    rows = int(ceil(num_pairs / columns))
+
+    grid = np.full((rows * (height + padding) + padding, columns * (width + padding) + padding, channels), 255, dtype=np.uint8)
+    for i in range(num_pairs):
+        row, column = divmod(i, columns)
+        top = padding + row * (height + padding)
+        left = padding + column * (width + padding)
+        grid[top:top + height, left:left + width] = pairs[i]
+    return grid
+
+
+def encode_image(image, filename):
+    """Codifica a imagem uint8 em PNG (se o arquivo terminar em .png) ou em JPEG"""
+    if filename.lower().endswith('.png'):
+        return tf.io.encode_png(image)
+    return tf.io.encode_jpeg(image, quality=95)
+
+
+# %% ESCRITOR
+
+class PreviewWriter:
+    """Gera e salva as imagens de acompanhamento do gerador sem bloquear o treinamento.
+
+    O write() passa o batch inteiro pelo gerador uma única vez (modo de inferência, training=False) e converte as entradas
+    e as saídas para uint8 no próprio dispositivo. A montagem da grade, a codificação (JPEG / PNG) e a gravação no disco
+    são feitas por um pool de threads. As grades com wandb_key são entregues ao logger (metrics_logger.MetricsLogger), cuja
+    thread é a única que as envia ao destino das métricas (LOG_SINK).
+    Se houver max_pending imagens esperando, o write() espera a mais antiga terminar, para limitar a memória usada.
+    """
+
+    def __init__(self, generator, max_workers=2, max_pending=8, logger=None):
+        self.generator = generator
+        self.max_pending = max_pending
+        self.logger = logger
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = []
+        self.predict = tf.function(self._predict, reduce_retracing=True)
+
+    def _predict(self, images):
+        # Imagens entre -1 e 1 -> uint8
+        outputs = self.generator(images, training=False)
+        to_uint8 = lambda x: tf.image.convert_image_dtype(tf.cast(x, tf.float32) * 0.5 + 0.5, tf.uint8, saturate=True)
+        return to_uint8(images), to_uint8(outputs)
+
+    def write(self, images, path, wandb_key=None, caption=None):
+        """Gera as imagens sintéticas do batch e agenda a gravação da grade em path (e o registro no logger, com a chave wandb_key)"""
+        input_images, output_images = self.predict(images)
+        # As gravações já terminadas são descartadas, levantando os erros que ocorreram nelas
+        done = [future for future in self.pending if future.done()]
+        self.pending = [future for future in self.pending if future not in done]
+        for future in done:
+            future.result()
+        if len(self.pending) >= self.max_pending:
+            self.pending.pop(0).result()
+        self.pending.append(self.executor.submit(self._write, input_images, output_images, path, wandb_key, caption))
+
+    def write_fixed_images(self, fixed_train, fixed_val, epoch, EPOCHS, save_folder):
+        """Grava as imagens fixas de treino e de validação de uma época, como o utils.generate_fixed_images"""
+        suffix = "_epoch_" + str(epoch).zfill(len(str(EPOCHS))) + ".jpg"
+        wandb_title = "Época {}".format(epoch)
+        self.write(fixed_train, save_folder + "train" + suffix, wandb_key=wandb_title + " - Train", caption="Train")
+        self.write(fixed_val, save_folder + "val" + suffix, wandb_key=wandb_title + " - Val", caption="Val")
+
+    def wait(self):
+        """Espera todas as gravações agendadas (e levanta os erros que ocorreram nelas)"""
+        pending = self.pending
+        self.pending = []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        """Espera as gravações agendadas e encerra o pool de threads"""
+        self.wait()
+        self.executor.shutdown()
+
+    def _write(self, input_images, output_images, path, wandb_key, caption):
+        grid = tile_pairs(input_images.numpy(), output_images.numpy())
+        tf.io.write_file(path, encode_image(grid, path))
+        if self.logger is not None and wandb_key is not None:
+            self.logger.log_image(wandb_key, grid, caption)
@@ -0,0 +1,321 @@
+""" Passos de treinamento e de validação compilados (tf.function) usados no main.py """
+
+import os
+from collections import Counter
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Silencia o TF (https://stackoverflow.com/questions/35911252/disable-tensorflow-debugging-information)
+import tensorflow as tf
+
+import utils
+import losses
+import metrics
+
+# %% TREINADOR
+
+
+class Trainer:
+
+    """Treinamento de um gerador, adversário (com discriminador) ou não adversário (discriminator=None).
+
+    O treinador guarda os modelos, os otimizadores, os acumuladores dos gradientes e a escolha da loss, e expõe os passos
+    compilados (tf.function) com input_signature explícita: as imagens têm formato [None, img_size, img_size, num_channels],
+    então batches de tamanhos diferentes (ex.: o último batch da época, sem DROP_REMAINDER) não causam um novo tracing.
+
+    Cada função conta quantas vezes foi traçada (trace_counts). O código Python dentro de uma tf.function só é executado
+    durante o tracing, então o contador só aumenta quando a função é (re)traçada. Os passos que criam as variáveis dos
+    otimizadores na primeira chamada são traçados duas vezes nela, o que é esperado.
+
+    No treinamento adversário, o treinador também guarda a acurácia do discriminador (accuracy, uma metrics.StreamingAccuracy
+    sobre as últimas accuracy_window observações), atualizada dentro do train_multiple_steps.
+    """
+
+    def __init__(self, generator, discriminator, generator_optimizer, discriminator_optimizer, loss_type, img_size, num_channels,
+                 lambda_l1=100, lambda_disc=1, lambda_gp=10, accumulation_steps=1, n_critic=1, batched_discriminator=True,
+                 strategy=None, jit_compile=False, accuracy_window=100):
+
+        self.generator = generator
+        self.discriminator = discriminator
+        self.generator_optimizer = generator_optimizer
+        self.discriminator_optimizer = discriminator_optimizer
+        self.adversarial = discriminator is not None
+        self.loss_type = loss_type
+        self.lambda_l1 = lambda_l1
+        self.lambda_disc = lambda_disc
+        self.lambda_gp = lambda_gp
+        self.accumulation_steps = accumulation_steps
+        self.n_critic = n_critic
+        self.batched_discriminator = batched_discriminator
+        self.strategy = strategy if strategy is not None else tf.distribute.get_strategy()
+        self.trace_counts = Counter()
+        self.accuracy = metrics.StreamingAccuracy(window=accuracy_window) if self.adversarial else None
+
+        if self.adversarial and loss_type not in ['patchganloss', 'wgan', 'wgan-gp']:
+            raise BaseException("Loss desconhecida para o treinamento adversário. Opções = 'patchganloss', 'wgan' ou 'wgan-gp'.")
+        if not self.adversarial and loss_type not in ['l1', 'l2']:
+            raise BaseException("Loss desconhecida para o treinamento não adversário. Opções = 'l1' ou 'l2'.")
+
+        # Acumuladores dos gradientes, pré-alocados (uma variável por peso treinável) no escopo da estratégia
+        # Com a batchnorm, as estatísticas continuam sendo calculadas em cada micro-batch
+        if accumulation_steps > 1:
+            with self.strategy.scope():
+                self.generator_accumulators = utils.create_gradient_accumulators(generator.trainable_variables)
+                if self.adversarial:
+                    self.discriminator_accumulators = utils.create_gradient_accumulators(discriminator.trainable_variables)
+
+        # Passos compilados, com a dimensão do batch dinâmica
+        image_spec = tf.TensorSpec([None, img_size, img_size, num_channels], tf.float32)
+
+        def compile_step(function, num_images):
+            return tf.function(function, input_signature=[image_spec] * num_images, jit_compile=jit_compile)
+
+        self.train_step = compile_step(self._train_step, 2)
+        self.critic_step = compile_step(self._critic_step, 2)
+        self.accumulate_step = compile_step(self._accumulate_step, 2)
+        self.apply_accumulated_gradients = tf.function(self._apply_accumulated_gradients, input_signature=[], jit_compile=jit_compile)
+        self.evaluate_validation_losses = compile_step(self._evaluate_validation_losses, 2)
+        # Única função sem input_signature: o iterador (local ou distribuído) não tem um TensorSpec que possa ser fixado.
+        # Os argumentos são sempre o mesmo iterador, de formato fixo, e num_steps como tensor (a acurácia é estado do
+        # treinador, e não argumento), então a função é traçada uma única vez
+        self.train_multiple_steps = tf.function(self._train_multiple_steps)
+
+    def get_trace_counts(self):
+        """Retorna quantas vezes cada função compilada foi traçada"""
+        return dict(self.trace_counts)
+
+    # -- Losses
+
+    def _compute_losses(self, input_image, gen_image, target, training=True):
+        """Calcula as losses do gerador e do discriminador (treinamento adversário) para imagens já geradas"""
+
+        disc_real, disc_gen = utils.discriminate_real_and_generated(self.discriminator, input_image, gen_image, target, training=training,
+                                                                    batched=self.batched_discriminator)
+
+        if self.loss_type == 'patchganloss':
+            gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_patchgan_generator(disc_gen, gen_image, target, self.lambda_l1)
+            disc_loss, disc_real_loss, disc_fake_loss = losses.loss_patchgan_discriminator(disc_real, disc_gen, self.lambda_disc)
+
+        elif self.loss_type == 'wgan':
+            gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_wgan_generator(disc_gen, gen_image, target, self.lambda_l1)
+            disc_loss, disc_real_loss, disc_fake_loss = losses.loss_wgan_discriminator(disc_real, disc_gen)
+
+        elif self.loss_type == 'wgan-gp':
+            gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_wgangp_generator(disc_gen, gen_image, target, self.lambda_l1)
+            disc_loss, disc_real_loss, disc_fake_loss, gp = losses.loss_wgangp_discriminator(self.discriminator, disc_real, disc_gen, input_image, gen_image,
+                                                                                             target, self.lambda_gp, training=training)
+
+        # Cria um dicionário das losses
+        loss_dict = {
+            'gen_total_loss': gen_loss,
+            'gen_gan_loss': gen_gan_loss,
+            'gen_l1_loss': gen_l1_loss,
+            'disc_total_loss': disc_loss,
+            'disc_real_loss': disc_real_loss,
+            'disc_fake_loss': disc_fake_loss,
+        }
+        if self.loss_type == 'wgan-gp':
+            loss_dict['gp'] = gp
+
+        return loss_dict, disc_real, disc_gen
+
+    def _compute_losses_not_adversarial(self, gen_image, target):
+        """Calcula as losses do gerador (treinamento não adversário) para imagens já geradas"""
+
+        if self.loss_type == 'l1':
+            gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_l1_generator(gen_image, target, self.lambda_l1)
+
+        elif self.loss_type == 'l2':
+            gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_l2_generator(gen_image, target, self.lambda_l1)
+
+        # Cria um dicionário das losses
+        loss_dict = {
+            'gen_total_loss': gen_loss,
+            'gen_l1_loss': gen_l1_loss
+        }
+
+        return loss_dict
+
+    # -- Gradientes
+
+    def _compute_gradients(self, input_image, target):
+        """Calcula as losses e os gradientes de um batch, sem atualizar os pesos.
+
+        Retorna as losses, as saídas do discriminador (usadas no cálculo da acurácia) e os gradientes do gerador e do
+        discriminador (None no treinamento não adversário).
+        """
+
+        with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
+
+            gen_image = self.generator(input_image, training=True)
+
+            if self.adversarial:
+                loss_dict, disc_real, disc_gen = self._compute_losses(input_image, gen_image, target)
+            else:
+                loss_dict = self._compute_losses_not_adversarial(gen_image, target)
+                disc_real, disc_gen = None, None
+
+            # Os gradientes são somados entre as réplicas e entre os micro-batches acumulados, então as losses são divididas
+            # pelo número de réplicas e de micro-batches (média entre eles)
+            # Com a precisão mista em float16, as losses também são escaladas para evitar o underflow dos gradientes
+            num_batches = tf.distribute.get_strategy().num_replicas_in_sync * self.accumulation_steps
+            scaled_gen_loss = utils.scale_loss(loss_dict['gen_total_loss'] / num_batches, self.generator_optimizer)
+            if self.adversarial:
+                scaled_disc_loss = utils.scale_loss(loss_dict['disc_total_loss'] / num_batches, self.discriminator_optimizer)
+
+        generator_gradients = gen_tape.gradient(scaled_gen_loss, self.generator.trainable_variables)
+        generator_gradients = utils.unscale_gradients(generator_gradients, self.generator_optimizer)
+        discriminator_gradients = None
+        if self.adversarial:
+            discriminator_gradients = disc_tape.gradient(scaled_disc_loss, self.discriminator.trainable_variables)
+            discriminator_gradients = utils.unscale_gradients(discriminator_gradients, self.discriminator_optimizer)
+
+        return loss_dict, disc_real, disc_gen, generator_gradients, discriminator_gradients
+
+    # -- Passos compilados
+
+    def _train_step(self, input_image, target):
+        """Realiza um passo de treinamento, atualizando o gerador e o discriminador (se houver).
+
+        Retorna as losses e, no treinamento adversário, as saídas do discriminador (usadas no cálculo da acurácia).
+        """
+        self.trace_counts['train_step'] += 1
+        loss_dict, disc_real, disc_gen, generator_gradients, discriminator_gradients = self._compute_gradients(input_image, target)
+
+        self.generator_optimizer.apply_gradients(zip(generator_gradients, self.generator.trainable_variables))
+        if not self.adversarial:
+            return loss_dict
+
+        self.discriminator_optimizer.apply_gradients(zip(discriminator_gradients, self.discriminator.trainable_variables))
+        return loss_dict, disc_real, disc_gen
+
+    def _critic_step(self, input_image, target):
+        """Realiza um passo de treinamento apenas do discriminador (crítico).
+
+        Cada passo do crítico tem um batch real novo, então as imagens sintéticas não podem ser reaproveitadas entre os
+        passos: elas são geradas aqui, fora do GradientTape (sem calcular os gradientes do gerador), mas no mesmo modo
+        de treinamento (training=True) do gerador que o passo normal otimiza.
+        """
+        self.trace_counts['critic_step'] += 1
+        gen_image = self.generator(input_image, training=True)
+        with tf.GradientTape() as disc_tape:
+            loss_dict, _, _ = self._compute_losses(input_image, gen_image, target)
+
+            # Os gradientes são somados entre as réplicas, então a loss é dividida pelo número de réplicas (média entre elas)
+            num_replicas = tf.distribute.get_strategy().num_replicas_in_sync
+            scaled_disc_loss = utils.scale_loss(loss_dict['disc_total_loss'] / num_replicas, self.discriminator_optimizer)
+
+        discriminator_gradients = disc_tape.gradient(scaled_disc_loss, self.discriminator.trainable_variables)
+        discriminator_gradients = utils.unscale_gradients(discriminator_gradients, self.discriminator_optimizer)
+        self.discriminator_optimizer.apply_gradients(zip(discriminator_gradients, self.discriminator.trainable_variables))
+
+    def _accumulate_step(self, input_image, target):
+        """Calcula os gradientes de um micro-batch e os soma aos acumuladores, sem atualizar os pesos.
+
+        Retorna as losses e, no treinamento adversário, as saídas do discriminador. Cada micro-batch tem a sua própria
+        gradient penalty (WGAN-GP), calculada com as suas imagens reais e sintéticas, como em um passo sem acumulação.
+        """
+        self.trace_counts['accumulate_step'] += 1
+        loss_dict, disc_real, disc_gen, generator_gradients, discriminator_gradients = self._compute_gradients(input_image, target)
+
+        utils.accumulate_gradients(self.generator_accumulators, generator_gradients)
+        if not self.adversarial:
+            return loss_dict
+
+        utils.accumulate_gradients(self.discriminator_accumulators, discriminator_gradients)
+        return loss_dict, disc_real, disc_gen
+
+    def _apply_accumulated_gradients(self):
+        """Atualiza os pesos com os gradientes acumulados nos micro-batches e zera os acumuladores"""
+        self.trace_counts['apply_accumulated_gradients'] += 1
+        utils.apply_accumulated_gradients(self.generator_optimizer, self.generator_accumulators, self.generator.trainable_variables)
+        if self.adversarial:
+            utils.apply_accumulated_gradients(self.discriminator_optimizer, self.discriminator_accumulators, self.discriminator.trainable_variables)
+
+    def _evaluate_validation_losses(self, input_image, target):
+        """Avalia as losses para imagens de validação.
+
+        Isso é úitil para monitorar o quão bem a rede está generalizando com dados não vistos.
+        Os modelos são usados em modo de inferência (training=False), sem atualizar as estatísticas das normalizações.
+        """
+        self.trace_counts['evaluate_validation_losses'] += 1
+        gen_image = self.generator(input_image, training=False)
+
+        if self.adversarial:
+            loss_dict, _, _ = self._compute_losses(input_image, gen_image, target, training=False)
+        else:
+            loss_dict = self._compute_losses_not_adversarial(gen_image, target)
+
+        return {f'{name}_val': loss for name, loss in loss_dict.items()}
+
+    def _train_multiple_steps(self, iterator, num_steps):
+        """Realiza num_steps passos de treinamento em uma única chamada compilada, lendo os batches do iterador dentro do grafo.
+
+        No treinamento adversário, atualiza também a acurácia do discriminador (self.accuracy).
+        Retorna as losses de cada passo empilhadas (um tensor de tamanho num_steps para cada loss).
+        num_steps deve ser um tensor, para que a função não seja retraçada a cada valor diferente.
+
+        Cada passo é executado em todas as réplicas (strategy.run), e as losses retornadas são a média entre elas.
+        A acurácia usa as saídas do discriminador de todas as réplicas.
+
+        Com accumulation_steps > 1, cada passo lê accumulation_steps micro-batches, acumula os seus gradientes
+        e só então atualiza os pesos. As losses retornadas são a média entre os micro-batches.
+
+        Com n_critic > 1 (treinamento adversário), cada passo faz n_critic - 1 atualizações apenas do discriminador
+        (critic_step) e termina com o passo normal, que atualiza o discriminador pela última vez e o gerador.
+        Cada uma dessas atualizações lê um batch novo do iterador, então cada passo lê n_critic batches e faz n_critic - 1
+        passagens do gerador sem gradiente (uma por batch do crítico), além da passagem do passo normal.
+        """
+        self.trace_counts['train_multiple_steps'] += 1
+        strategy = self.strategy
+        accuracy = self.accuracy
+
+        def reduce_losses(loss_dict):
+            return {name: strategy.reduce(tf.distribute.ReduceOp.MEAN, loss, axis=None) for name, loss in loss_dict.items()}
+
+        def run_step(step_function):
+            input_image = next(iterator)
+            target = input_image
+            if not self.adversarial:
+                return reduce_losses(strategy.run(step_function, args=(input_image, target)))
+            loss_dict, disc_real, disc_gen = strategy.run(step_function, args=(input_image, target))
+            accuracy.update_state(strategy.gather(disc_real, axis=0), strategy.gather(disc_gen, axis=0))
+            return reduce_losses(loss_dict)
+
+        def accumulated_step():
+            # O primeiro micro-batch fica fora do loop, para que as losses a somar sejam conhecidas
+            loss_dict = run_step(self.accumulate_step)
+            loss_names = list(loss_dict.keys())
+            loss_sums = [tf.cast(loss_dict[name], tf.float32) for name in loss_names]
+            for _ in tf.range(1, self.accumulation_steps):
+                micro_dict = run_step(self.accumulate_step)
+                loss_sums = [loss_sum + tf.cast(micro_dict[name], tf.float32) for loss_sum, name in zip(loss_sums, loss_names)]
+            strategy.run(self.apply_accumulated_gradients)
+            return {name: loss_sum / self.accumulation_steps for loss_sum, name in zip(loss_sums, loss_names)}
+
+        def critic_steps():
+            # Cada passo do crítico lê um batch novo do iterador, e o passo normal também
+            for _ in tf.range(self.n_critic - 1):
+                input_image = next(iterator)
+                target = input_image
+                strategy.run(self.critic_step, args=(input_image, target))
+            return run_step(self.train_step)
+
+        def step():
+            if self.accumulation_steps > 1:
+                loss_dict = accumulated_step()
+            elif self.adversarial and self.n_critic > 1:
+                loss_dict = critic_steps()
+            else:
+                loss_dict = run_step(self.train_step)
+            if self.adversarial:
+                loss_dict['accuracy'] = accuracy.result()
+            return loss_dict
+
+        # O primeiro passo fica fora do loop, para que as losses a empilhar sejam conhecidas
+        loss_dict = step()
+        loss_names = list(loss_dict.keys())
+        loss_arrays = [tf.TensorArray(tf.float32, size=num_steps).write(0, tf.cast(loss_dict[name], tf.float32)) for name in loss_names]
+        for i in tf.range(1, num_steps):
+            step_dict = step()
+            loss_arrays = [array.write(i, tf.cast(step_dict[name], tf.float32)) for array, name in zip(loss_arrays, loss_names)]
+
+        return {name: array.stack() for array, name in zip(loss_arrays, loss_names)}
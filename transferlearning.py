@@ -9,6 +9,7 @@ https://stackoverflow.com/questions/53907681/how-to-fine-tune-a-functional-model
 
 # Imports
 import os
+from functools import partial
 
 # Tensorflow
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
@@ -31,11 +32,11 @@ def upsample_block(x, filters, name_prefix=None, name_suffix=None, norm_type='in
 
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = net.PixelNormalization
+        norm_layer = partial(net.PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -72,11 +73,11 @@ def simple_upsample_block(x, filters, scale=2, kernel_size=(3, 3), interpolation
 
     # Define o tipo de normalização usada
     if norm_type == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif norm_type == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif norm_type == 'pixelnorm':
-        norm_layer = net.PixelNormalization
+        norm_layer = partial(net.PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
@@ -188,11 +189,11 @@ def include_vector(IMG_SIZE, NORM_TYPE, upsample_type, disentanglement):
 
     # Define o tipo de normalização usada
     if NORM_TYPE == 'batchnorm':
-        norm_layer = tf.keras.layers.BatchNormalization
+        norm_layer = partial(tf.keras.layers.BatchNormalization, dtype='float32')
     elif NORM_TYPE == 'instancenorm':
-        norm_layer = tfa.layers.InstanceNormalization
+        norm_layer = partial(tfa.layers.InstanceNormalization, dtype='float32')
     elif NORM_TYPE == 'pixelnorm':
-        norm_layer = net.PixelNormalization
+        norm_layer = partial(net.PixelNormalization, dtype='float32')
     else:
         raise BaseException("Tipo de normalização desconhecida")
 
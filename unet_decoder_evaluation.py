@@ -22,6 +22,7 @@ import transferlearning as transfer
 USE_CACHE = True
 DATASET = "CelebaHQ"  # "CelebaHQ" ou "InsetosFlickr" ou "CelebaHQ_Small"
 USE_RANDOM_JITTER = False
+REDUCED_JPEG_DECODING = True
 
 # Parâmetros de rede
 NORM_TYPE = "instancenorm"  # "batchnorm", "instancenorm", "pixelnorm"
@@ -118,29 +119,22 @@ test_folder = dataset_folder + 'test'
 val_folder = dataset_folder + 'val'
 
 # Dataset de treinamento
-train_dataset = tf.data.Dataset.list_files(train_folder + dataset_filter_string)
-TRAIN_SIZE = len(list(train_dataset))
-train_dataset = train_dataset.map(lambda x: utils.load_image_train(x, IMG_SIZE, OUTPUT_CHANNELS, USE_RANDOM_JITTER))
-if USE_CACHE:
-    train_dataset = train_dataset.cache()
-train_dataset = train_dataset.shuffle(BUFFER_SIZE)
-train_dataset = train_dataset.batch(BATCH_SIZE)
+train_files = tf.data.Dataset.list_files(train_folder + dataset_filter_string)
+TRAIN_SIZE = len(list(train_files))
+train_dataset = utils.create_image_dataset(train_files, 'train', IMG_SIZE, OUTPUT_CHANNELS, BATCH_SIZE, use_jitter=USE_RANDOM_JITTER,
+                                           use_cache=USE_CACHE, shuffle_buffer=BUFFER_SIZE, reduced_decoding=REDUCED_JPEG_DECODING)
 
 # Dataset de teste
-test_dataset = tf.data.Dataset.list_files(test_folder + dataset_filter_string)
-TEST_SIZE = len(list(test_dataset))
-test_dataset = test_dataset.map(lambda x: utils.load_image_test(x, IMG_SIZE))
-if USE_CACHE:
-    test_dataset = test_dataset.cache()
-test_dataset = test_dataset.batch(1)
+test_files = tf.data.Dataset.list_files(test_folder + dataset_filter_string)
+TEST_SIZE = len(list(test_files))
+test_dataset = utils.create_image_dataset(test_files, 'test', IMG_SIZE, OUTPUT_CHANNELS, 1, use_cache=USE_CACHE,
+                                          reduced_decoding=REDUCED_JPEG_DECODING)
 
 # Dataset de validação
-val_dataset = tf.data.Dataset.list_files(val_folder + dataset_filter_string)
-VAL_SIZE = len(list(val_dataset))
-val_dataset = val_dataset.map(lambda x: utils.load_image_test(x, IMG_SIZE))
-if USE_CACHE:
-    val_dataset = val_dataset.cache()
-val_dataset = val_dataset.batch(1)
+val_files = tf.data.Dataset.list_files(val_folder + dataset_filter_string)
+VAL_SIZE = len(list(val_files))
+val_dataset = utils.create_image_dataset(val_files, 'val', IMG_SIZE, OUTPUT_CHANNELS, 1, use_cache=USE_CACHE,
+                                         reduced_decoding=REDUCED_JPEG_DECODING)
 
 print(f"O dataset de treino tem {TRAIN_SIZE} imagens")
 print(f"O dataset de teste tem {TEST_SIZE} imagens")
@@ -244,8 +238,7 @@ def train_step(generator, discriminator, latent, input_image, target):
 
         gen_image = generator(latent, training=True)
 
-        disc_real = discriminator([input_image, target], training=True)
-        disc_gen = discriminator([gen_image, target], training=True)
+        disc_real, disc_gen = utils.discriminate_real_and_generated(discriminator, input_image, gen_image, target, training=True)
 
         gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_patchgan_generator(disc_gen, gen_image, target, LAMBDA)
         disc_loss, disc_real_loss, disc_fake_loss = losses.loss_patchgan_discriminator(disc_real, disc_gen, LAMBDA_DISC)
@@ -281,8 +274,7 @@ def evaluate_validation_losses(generator, discriminator, latent, input_image, ta
 
     gen_image = generator(latent, training=True)
 
-    disc_real = discriminator([input_image, target], training=True)
-    disc_gen = discriminator([gen_image, target], training=True)
+    disc_real, disc_gen = utils.discriminate_real_and_generated(discriminator, input_image, gen_image, target, training=True)
 
     gen_loss, gen_gan_loss, gen_l1_loss = losses.loss_patchgan_generator(disc_gen, gen_image, target, LAMBDA)
     disc_loss, disc_real_loss, disc_fake_loss = losses.loss_patchgan_discriminator(disc_real, disc_gen, LAMBDA_DISC)
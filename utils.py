@@ -1,10 +1,22 @@
 """ FUNÇÕES DE APOIO PARA O AUTOENCODER """
 
 import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import inspect
 import numpy as np
 import matplotlib.pyplot as plt
 import wandb
 
+# O módulo resource só existe em sistemas Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Silencia o TF (https://stackoverflow.com/questions/35911252/disable-tensorflow-debugging-information)
 import tensorflow as tf
 from tensorflow.keras import backend as K
@@ -90,19 +102,57 @@ def generate_fixed_images(fixed_train, fixed_val, generator, epoch, EPOCHS, save
 # -- Memória
 
 
-def print_used_memory(device='GPU:0'):
-    mem_info = tf.config.experimental.get_memory_info(device)
-
-    mem_info_current_bytes = mem_info['current']
-    mem_info_current_kbytes = mem_info_current_bytes / 1024
-    mem_info_current_mbytes = mem_info_current_kbytes / 1024
+def get_process_memory_usage():
+    """Retorna a memória residente (RSS) atual e de pico do processo, em bytes (None quando não é possível medir)"""
+    current_bytes = None
+    peak_bytes = None
+    # Linux: /proc/self/status
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    current_bytes = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak_bytes = int(line.split()[1]) * 1024
+    # Outros sistemas Unix: apenas o pico (ru_maxrss é dado em KB no Linux e em bytes no macOS)
+    if peak_bytes is None and resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_bytes = peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+    return current_bytes, peak_bytes
+
+
+def print_used_memory(device=None):
+    """Mostra e retorna o uso de memória da GPU ou, sem GPU (ex.: treinamento distribuído em CPU), a RSS do processo.
+
+    O Tensorflow não rastreia a memória do dispositivo CPU, então nesse caso é usada a memória do processo. Se não for
+    possível medir, retorna um dicionário vazio (a medição nunca interrompe o treinamento).
+    """
+    if device is None and len(tf.config.list_physical_devices('GPU')) > 0:
+        device = 'GPU:0'
+    mem_info = None
+    if device is not None:
+        try:
+            mem_info = tf.config.experimental.get_memory_info(device)
+        except ValueError:
+            pass  # "Memory statistics not tracked" (ex.: CPU:0)
+    if mem_info is not None:
+        current_bytes, peak_bytes = mem_info['current'], mem_info['peak']
+    else:
+        current_bytes, peak_bytes = get_process_memory_usage()
 
-    mem_info_peak_bytes = mem_info['peak']
-    mem_info_peak_kbytes = mem_info_peak_bytes / 1024
-    mem_info_peak_mbytes = mem_info_peak_kbytes / 1024
+    mem_dict = {}
+    if current_bytes is not None:
+        mem_dict['current_memory_mbytes'] = current_bytes / 1024**2
+    if peak_bytes is not None:
+        mem_dict['peak_memory_mbytes'] = peak_bytes / 1024**2
+    if len(mem_dict) == 0:
+        print("Uso de memória: não disponível")
+        return mem_dict
 
-    print(f"Uso de memória: Current = {mem_info_current_mbytes:,.2f} MB, Peak = {mem_info_peak_mbytes:,.2f} MB")
-    return {"current_memory_mbytes": mem_info_current_mbytes, "peak_memory_mbytes": mem_info_peak_mbytes}
+    current = f"{mem_dict['current_memory_mbytes']:,.2f} MB" if 'current_memory_mbytes' in mem_dict else "-"
+    peak = f"{mem_dict['peak_memory_mbytes']:,.2f} MB" if 'peak_memory_mbytes' in mem_dict else "-"
+    print(f"Uso de memória: Current = {current}, Peak = {peak}")
+    return mem_dict
 
 
 def get_model_memory_usage(batch_size, model):
@@ -135,7 +185,12 @@ def get_model_memory_usage(batch_size, model):
     if K.floatx() == 'float64':
         number_size = 8.0
 
-    total_memory = number_size * (batch_size * shapes_mem_count + trainable_count + non_trainable_count)
+    # Com a precisão mista, as ativações usam 16 bits e os pesos continuam em float32
+    activation_size = number_size
+    if tf.keras.mixed_precision.global_policy().compute_dtype in ['float16', 'bfloat16']:
+        activation_size = 2.0
+
+    total_memory = activation_size * batch_size * shapes_mem_count + number_size * (trainable_count + non_trainable_count)
     gbytes = np.round(total_memory / (1024.0 ** 3), 3) + internal_model_mem_count
     return gbytes
 
@@ -148,6 +203,8 @@ def get_full_dataset_memory_usage(num_imgs, image_size, image_channels, data_typ
         unit_size = 4.0
     elif data_type == tf.float64:
         unit_size = 8.0
+    elif data_type == tf.uint8:
+        unit_size = 1.0
     else:
         print("Não foi possível obter o data type da imagem")
         unit_size = 1.0
@@ -159,12 +216,197 @@ def get_full_dataset_memory_usage(num_imgs, image_size, image_channels, data_typ
     return dataset_memory_size_gbytes
 
 
+# -- Discriminador
+
+
+def has_batch_normalization(model):
+    """Verifica se o modelo (ou algum modelo interno) tem camadas de batch normalization"""
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.layers.BatchNormalization):
+            return True
+        if isinstance(layer, tf.keras.Model) and has_batch_normalization(layer):
+            return True
+    return False
+
+
+def discriminate_real_and_generated(discriminator, real_image, generated_image, target, training=True, batched=True):
+    """Discrimina os pares (real, target) e (gerada, target) e retorna as duas saídas (disc_real, disc_gen).
+
+    Com batched=True, os dois pares são concatenados em um único batch de 2B imagens, e o discriminador é chamado
+    uma única vez (metade das chamadas e das leituras dos pesos). A saída é então separada nas duas metades.
+    O resultado é o mesmo das duas chamadas separadas desde que cada imagem seja processada de forma independente:
+    vale para instance / pixel normalization e para os pesos restritos (clipping) da WGAN, mas não para a batch
+    normalization em treinamento, em que as estatísticas do batch misturariam as imagens reais e sintéticas.
+    Nesse caso deve-se usar batched=False (ver has_batch_normalization).
+    """
+    if not batched:
+        disc_real = discriminator([real_image, target], training=training)
+        disc_gen = discriminator([generated_image, target], training=training)
+        return disc_real, disc_gen
+
+    batch_size = tf.shape(real_image)[0]
+    images = tf.concat([real_image, tf.cast(generated_image, real_image.dtype)], axis=0)
+    targets = tf.concat([target, target], axis=0)
+    disc_output = discriminator([images, targets], training=training)
+    return disc_output[:batch_size], disc_output[batch_size:]
+
+
+# %% PRECISÃO MISTA
+
+
+def cpu_supports_bfloat16():
+    """Verifica se a CPU tem instruções bfloat16 nativas (AVX512_BF16 ou AMX). Retorna None se não for possível verificar."""
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            flags = f.read()
+    except OSError:
+        return None
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def get_mixed_precision_policy():
+    """Escolhe a política de precisão mista de acordo com o hardware (tf.config.experimental.get_device_details).
+
+    - GPU com compute capability 7.0 ou maior (tensor cores): 'mixed_float16'
+    - GPU mais antiga: 'float32', pois o float16 não é mais rápido nela e o bfloat16 exige compute capability 8.0
+    - CPU: 'mixed_bfloat16' se ela tiver instruções bfloat16 (ou se não for possível verificar), senão 'float32'
+    Se a GPU não informar a compute capability (ex.: ROCm), usa 'mixed_float16'.
+    """
+    gpus = tf.config.list_physical_devices('GPU')
+    if len(gpus) > 0:
+        compute_capability = tf.config.experimental.get_device_details(gpus[0]).get('compute_capability')
+        if compute_capability is None or compute_capability >= (7, 0):
+            return 'mixed_float16'
+        print(f"Aviso: a GPU tem compute capability {compute_capability[0]}.{compute_capability[1]} (< 7.0), sem suporte rápido "
+              "a float16 ou bfloat16. Usando float32.")
+        return 'float32'
+    if cpu_supports_bfloat16() is False:
+        print("Aviso: a CPU não tem instruções bfloat16 (AVX512_BF16 / AMX). Usando float32.")
+        return 'float32'
+    return 'mixed_bfloat16'
+
+
+def set_precision_policy(mixed_precision):
+    """Define a política de precisão do Keras e retorna o seu nome.
+
+    Com mixed_precision=True, usa a política suportada pelo hardware (ver get_mixed_precision_policy). Caso contrário, 'float32'.
+    A política deve ser definida antes da criação dos modelos.
+    """
+    policy = get_mixed_precision_policy() if mixed_precision else 'float32'
+    tf.keras.mixed_precision.set_global_policy(policy)
+    return policy
+
+
+def get_optimizer(learning_rate, beta_1, policy='float32'):
+    """Cria o otimizador Adam. Com a política 'mixed_float16', ele é envolvido por um LossScaleOptimizer (loss scaling dinâmico)."""
+    optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=beta_1)
+    if policy == 'mixed_float16':
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return optimizer
+
+
+def scale_loss(loss, optimizer):
+    """Escala a loss antes do cálculo dos gradientes, se o otimizador usar loss scaling (deve ser chamada dentro do GradientTape)"""
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        return optimizer.get_scaled_loss(loss)
+    return loss
+
+
+def unscale_gradients(gradients, optimizer):
+    """Desfaz a escala dos gradientes, se o otimizador usar loss scaling"""
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        return optimizer.get_unscaled_gradients(gradients)
+    return gradients
+
+
+# %% TREINAMENTO DISTRIBUÍDO
+
+
+def get_worker_info():
+    """Lê a variável de ambiente TF_CONFIG (definida pelo launch_workers.py) e retorna (num_workers, task_index).
+
+    Sem TF_CONFIG, o treinamento é feito em um único processo: (1, 0).
+    """
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    if 'cluster' not in tf_config:
+        return 1, 0
+    num_workers = len(tf_config['cluster'].get('worker', []))
+    task_index = tf_config['task']['index']
+    return num_workers, task_index
+
+
+def create_strategy(num_workers):
+    """Cria a estratégia de distribuição.
+
+    Com mais de um worker, usa a MultiWorkerMirroredStrategy (cada processo é uma réplica, e os gradientes são
+    somados entre os workers com all-reduce em anel, adequado para CPU). Com um único worker, retorna a estratégia
+    padrão, que não altera o treinamento.
+    A MultiWorkerMirroredStrategy deve ser criada antes de qualquer outra operação do Tensorflow.
+    """
+    if num_workers <= 1:
+        return tf.distribute.get_strategy()
+    communication_options = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    return tf.distribute.MultiWorkerMirroredStrategy(communication_options=communication_options)
+
+
+def shard_manifest(entries, num_shards, shard_index):
+    """Retorna a parte do manifesto lida por um worker (as entradas são distribuídas de forma intercalada)."""
+    return entries[shard_index::num_shards]
+
+
+# %% ACUMULAÇÃO DE GRADIENTES
+
+
+def create_gradient_accumulators(variables):
+    """Cria uma variável zerada para acumular o gradiente de cada peso treinável.
+
+    Deve ser chamada no escopo da estratégia de distribuição. Cada réplica acumula os seus próprios gradientes
+    (ON_READ), e a soma entre as réplicas é feita pelo otimizador no apply_gradients.
+    """
+    return [tf.Variable(tf.zeros_like(variable), trainable=False, synchronization=tf.VariableSynchronization.ON_READ,
+                        aggregation=tf.VariableAggregation.SUM) for variable in variables]
+
+
+def accumulate_gradients(accumulators, gradients):
+    """Soma os gradientes de um micro-batch aos acumuladores"""
+    for accumulator, gradient in zip(accumulators, gradients):
+        if gradient is not None:
+            accumulator.assign_add(tf.cast(gradient, accumulator.dtype))
+
+
+def apply_accumulated_gradients(optimizer, accumulators, variables):
+    """Atualiza os pesos com os gradientes acumulados e zera os acumuladores"""
+    optimizer.apply_gradients(zip([accumulator.read_value() for accumulator in accumulators], variables))
+    for accumulator in accumulators:
+        accumulator.assign(tf.zeros_like(accumulator))
+
+
 # %% FUNÇÕES DO DATASET
 
-def load(image_file):
-    """Função de leitura das imagens."""
+# Razões de redução aceitas pelo decodificador JPEG (tf.image.decode_jpeg)
+JPEG_DECODING_RATIOS = [1, 2, 4, 8]
+
+
+def load(image_file, min_size=None):
+    """Função de leitura das imagens.
+
+    Se min_size for definido, o JPEG é decodificado já reduzido (razões 1/2, 1/4 ou 1/8, aplicadas nos coeficientes DCT),
+    escolhendo a maior redução em que o menor lado da imagem ainda tem pelo menos min_size pixels.
+    """
     image = tf.io.read_file(image_file)
-    image = tf.image.decode_jpeg(image)
+    if min_size is None:
+        image = tf.image.decode_jpeg(image)
+    else:
+        # Tamanho original, lido apenas do cabeçalho do JPEG
+        shape = tf.image.extract_jpeg_shape(image)
+        smallest_side = tf.minimum(shape[0], shape[1])
+        # Cada razão que ainda cobre min_size incrementa o índice (0 -> 1, 1 -> 1/2, 2 -> 1/4, 3 -> 1/8)
+        ratio_index = 0
+        for ratio in JPEG_DECODING_RATIOS[1:]:
+            ratio_index += tf.cast((smallest_side + ratio - 1) // ratio >= min_size, tf.int32)
+        branches = [lambda ratio=ratio: tf.image.decode_jpeg(image, ratio=ratio) for ratio in JPEG_DECODING_RATIOS]
+        image = tf.switch_case(ratio_index, branches)
     image = tf.cast(image, tf.float32)
     return image
 
@@ -190,7 +432,7 @@ def random_crop(input_image, img_size, num_channels):
 def random_jitter(input_image, img_size, num_channels):
     """Realiza cortes quadrados aleatórios e inverte aleatoriamente uma imagem"""
     # resizing to 286 x 286 x 3
-    new_size = int(img_size * 1.117)
+    new_size = get_jitter_size(img_size)
     input_image = resize(input_image, new_size, new_size)
     # randomly cropping to IMGSIZE x IMGSIZE x 3
     input_image = random_crop(input_image, img_size, num_channels)
@@ -202,9 +444,51 @@ def random_jitter(input_image, img_size, num_channels):
     return input_image
 
 
-def load_image_train(image_file, img_size, num_channels, use_jitter):
-    """Carrega uma imagem do dataset de treinamento."""
-    input_image = load(image_file)
+def random_jitter_batch(images, img_size, num_channels):
+    """Versão vetorizada do random_jitter, aplicada a um batch inteiro de imagens já no tamanho IMG_SIZE x IMG_SIZE.
+
+    O redimensionamento, o corte e a inversão são feitos em uma única chamada do crop_and_resize: cada imagem
+    do batch recebe uma caixa de corte com deslocamento aleatório próprio, que corresponde a cortar IMG_SIZE pixels
+    da imagem ampliada para get_jitter_size(IMG_SIZE) (a menos do arredondamento do vizinho mais próximo, que troca
+    uma ou duas linhas / colunas em parte dos cortes). Nas imagens invertidas, as coordenadas x da caixa são trocadas,
+    o que espelha o corte.
+
+    Não é o mesmo aumento de dados do load_image_train: lá a imagem é redimensionada a partir do original, e aqui ela
+    é ampliada a partir de IMG_SIZE, o que duplica cerca de 10% das linhas e colunas (128 -> 142, por exemplo).
+    """
+    batch_size = tf.shape(images)[0]
+    new_size = get_jitter_size(img_size)
+    # Deslocamentos do corte, em pixels da imagem redimensionada
+    offsets = tf.random.uniform([batch_size, 2], 0, new_size - img_size + 1, dtype=tf.int32)
+    offsets = tf.cast(offsets, tf.float32)
+    # Posição, na imagem original, do centro do primeiro e do último pixel do corte (como no resize NEAREST_NEIGHBOR),
+    # em coordenadas normalizadas do crop_and_resize (0 = primeiro pixel, 1 = último pixel)
+    scale = img_size / new_size
+    start = ((offsets + 0.5) * scale - 0.5) / (img_size - 1)
+    end = start + scale
+    y1, x1, y2, x2 = start[:, 0], start[:, 1], end[:, 0], end[:, 1]
+    # random mirroring
+    flip = tf.random.uniform([batch_size]) > 0.5
+    boxes = tf.stack([y1, tf.where(flip, x2, x1), y2, tf.where(flip, x1, x2)], axis=1)
+    images = tf.image.crop_and_resize(images, boxes, tf.range(batch_size), [img_size, img_size], method='nearest')
+    images = tf.ensure_shape(images, [None, img_size, img_size, num_channels])
+    return images
+
+
+def get_jitter_size(img_size):
+    """Retorna o tamanho para o qual a imagem é redimensionada antes do corte aleatório do random jitter"""
+    return int(img_size * 1.117)
+
+
+def load_image_train(image_file, img_size, num_channels, use_jitter, reduced_decoding=False):
+    """Carrega uma imagem do dataset de treinamento.
+
+    Com reduced_decoding, o JPEG é decodificado já reduzido (ver load), cobrindo o tamanho usado pelo random jitter.
+    """
+    min_size = None
+    if reduced_decoding:
+        min_size = get_jitter_size(img_size) if use_jitter else img_size
+    input_image = load(image_file, min_size)
     if use_jitter:
         input_image = random_jitter(input_image, img_size, num_channels)
     else:
@@ -213,13 +497,628 @@ def load_image_train(image_file, img_size, num_channels, use_jitter):
     return input_image
 
 
-def load_image_test(image_file, img_size):
+def load_image_test(image_file, img_size, reduced_decoding=False):
     """Carrega uma imagem do dataset de teste / validação."""
-    input_image = load(image_file)
+    input_image = load(image_file, img_size if reduced_decoding else None)
     input_image = resize(input_image, img_size, img_size)
     input_image = normalize(input_image)
     return input_image
 
+
+# -- Manifesto do dataset
+
+
+def get_manifest_path(cache_folder, dataset_name, split):
+    """Retorna o caminho do manifesto de um split do dataset"""
+    return cache_folder + f'{dataset_name}_{split}_manifest.json'
+
+
+def update_dataset_manifest(manifest_path, file_pattern):
+    """Carrega o manifesto de um split do dataset, atualizando-o se os arquivos tiverem mudado.
+
+    O manifesto guarda, para cada imagem, o caminho, o tamanho em bytes, a label (nome da pasta) e o mtime,
+    além do mtime das pastas do dataset. Se nenhuma pasta mudou e nenhum arquivo mudou de tamanho ou de mtime
+    (imagens editadas ou substituídas), o manifesto é usado sem listar os arquivos.
+    Caso contrário, os arquivos são listados novamente, mas as entradas com tamanho e mtime inalterados são reaproveitadas.
+    Retorna a lista de entradas, ordenada pelo caminho.
+    """
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+        # Se o padrão é o mesmo e nenhuma pasta mudou, não é preciso listar os arquivos de novo
+        if manifest['file_pattern'] == file_pattern:
+            folders_unchanged = True
+            for folder, mtime in manifest['folders'].items():
+                if not os.path.isdir(folder) or os.stat(folder).st_mtime != mtime:
+                    folders_unchanged = False
+                    break
+            if folders_unchanged:
+                files_unchanged = True
+                for entry in manifest['files']:
+                    try:
+                        stat = os.stat(entry['path'])
+                    except FileNotFoundError:
+                        files_unchanged = False
+                        break
+                    if stat.st_size != entry['size'] or stat.st_mtime != entry['mtime']:
+                        files_unchanged = False
+                        break
+                if files_unchanged:
+                    return manifest['files']
+        else:
+            manifest = None
+
+    # Lista os arquivos, reaproveitando as entradas que não mudaram
+    old_entries = {} if manifest is None else {entry['path']: entry for entry in manifest['files']}
+    entries = []
+    folders = {}
+    for path in sorted(tf.io.gfile.glob(file_pattern)):
+        stat = os.stat(path)
+        entry = old_entries.get(path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'path': path, 'size': stat.st_size, 'label': os.path.basename(os.path.dirname(path)), 'mtime': stat.st_mtime}
+        entries.append(entry)
+
+        # Guarda o mtime da pasta da imagem e da pasta acima dela (novas labels mudam o mtime da pasta do split)
+        label_folder = os.path.dirname(path)
+        for folder in [label_folder, os.path.dirname(label_folder)]:
+            if folder not in folders:
+                folders[folder] = os.stat(folder).st_mtime
+
+    # Salva o manifesto (de forma atômica, para não corromper com execuções simultâneas)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'file_pattern': file_pattern, 'folders': folders, 'files': entries}, f)
+    os.replace(tmp_path, manifest_path)
+
+    return entries
+
+
+def get_manifest_fingerprint(entries):
+    """Calcula um hash do conteúdo do manifesto (caminho, tamanho e mtime de cada arquivo).
+
+    Muda sempre que um arquivo é adicionado, removido, editado ou substituído, e é usado para validar os caches em disco.
+    """
+    sha = hashlib.sha1()
+    for entry in entries:
+        sha.update(f"{entry['path']}|{entry['size']}|{entry['mtime']}\n".encode('utf-8'))
+    return sha.hexdigest()
+
+
+def manifest_to_dataset(entries, shuffle=True, interleave_labels=True):
+    """Cria um dataset com os caminhos das imagens do manifesto, com cardinalidade conhecida.
+
+    Com shuffle=True a ordem dos arquivos é embaralhada por completo a cada época (permutação dos caminhos, que é barata),
+    como no tf.data.Dataset.list_files. Com interleave_labels=True o embaralhamento é estratificado: cada label (pasta) é
+    embaralhada separadamente a cada época, e as labels são intercaladas em uma sequência fixa, proporcional ao tamanho
+    de cada uma (um round-robin ponderado). Assim qualquer trecho da época tem as labels na mesma proporção do dataset,
+    e basta um buffer de shuffle pequeno depois da decodificação.
+    """
+    paths = [entry['path'] for entry in entries]
+    if not shuffle or len(paths) == 0:
+        return tf.data.Dataset.from_tensor_slices(paths)
+    if not interleave_labels:
+        return tf.data.Dataset.from_tensor_slices(paths).shuffle(len(paths), reshuffle_each_iteration=True)
+
+    # Um dataset embaralhado por label
+    labels = sorted(set(entry['label'] for entry in entries))
+    label_datasets = []
+    slot_labels = []
+    slot_positions = []
+    for i, label in enumerate(labels):
+        label_paths = [entry['path'] for entry in entries if entry['label'] == label]
+        label_ds = tf.data.Dataset.from_tensor_slices(label_paths)
+        label_datasets.append(label_ds.shuffle(len(label_paths), reshuffle_each_iteration=True))
+        # A j-ésima imagem da label ocupa a posição (j + 0.5) / n da época, espaçando as imagens de cada label por igual
+        slot_labels += [i] * len(label_paths)
+        slot_positions += [(j + 0.5) / len(label_paths) for j in range(len(label_paths))]
+
+    # Sequência das labels ordenada pela posição de cada imagem (a mesma em todas as épocas)
+    order = np.argsort(np.array(slot_positions), kind='stable')
+    choice_ds = tf.data.Dataset.from_tensor_slices(tf.constant(np.array(slot_labels)[order], dtype=tf.int64))
+    files_ds = tf.data.Dataset.choose_from_datasets(label_datasets, choice_ds)
+    files_ds = files_ds.apply(tf.data.experimental.assert_cardinality(len(paths)))
+    return files_ds
+
+
+# -- TFRecords (imagens pré-redimensionadas pelo convert_dataset.py)
+
+
+def get_tfrecord_folder(dataset_folder, img_size):
+    """Retorna a pasta onde ficam os shards TFRecord do dataset para um dado IMG_SIZE"""
+    return dataset_folder + f'tfrecords_{img_size}/'
+
+
+def serialize_image_example(image, label):
+    """Serializa uma imagem uint8 (já redimensionada) e o nome da sua pasta (label) em um tf.train.Example."""
+    image = np.asarray(image, dtype=np.uint8)
+    feature = {
+        'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+        'height': tf.train.Feature(int64_list=tf.train.Int64List(value=[image.shape[0]])),
+        'width': tf.train.Feature(int64_list=tf.train.Int64List(value=[image.shape[1]])),
+        'channels': tf.train.Feature(int64_list=tf.train.Int64List(value=[image.shape[2]])),
+        'label': tf.train.Feature(bytes_list=tf.train.BytesList(value=[label.encode('utf-8')])),
+    }
+    example = tf.train.Example(features=tf.train.Features(feature=feature))
+    return example.SerializeToString()
+
+
+def list_tfrecord_shards(tfrecord_folder, split, num_workers=1, task_index=0):
+    """Lista os shards TFRecord de um split e lê a quantidade de imagens registrada pelo convert_dataset.py
+
+    Com num_workers > 1, retorna apenas os shards lidos pelo worker task_index (a quantidade de imagens
+    retornada passa a ser uma estimativa, pois os shards podem ter tamanhos diferentes).
+    """
+    with open(tfrecord_folder + f'{split}.json', 'r') as f:
+        metadata = json.load(f)
+    if num_workers <= 1:
+        files_ds = tf.data.Dataset.list_files(tfrecord_folder + f'{split}-*.tfrecord')
+        return files_ds, metadata['num_images']
+
+    # A divisão é feita antes do embaralhamento, para que os workers leiam shards diferentes
+    files_ds = tf.data.Dataset.list_files(tfrecord_folder + f'{split}-*.tfrecord', shuffle=False)
+    files_ds = files_ds.shard(num_workers, task_index)
+    num_files = int(files_ds.cardinality().numpy())
+    if num_files == 0:
+        raise BaseException(f"Não há shards TFRecord suficientes do split {split} para {num_workers} workers")
+    files_ds = files_ds.shuffle(num_files, reshuffle_each_iteration=True)
+    return files_ds, metadata['num_images'] // num_workers
+
+
+def get_tfrecord_fingerprint(tfrecord_folder, split):
+    """Calcula o hash dos shards TFRecord de um split e do seu arquivo de metadados (ver get_manifest_fingerprint)"""
+    paths = sorted(tf.io.gfile.glob(tfrecord_folder + f'{split}-*.tfrecord')) + [tfrecord_folder + f'{split}.json']
+    entries = []
+    for path in paths:
+        stat = os.stat(path)
+        entries.append({'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime})
+    return get_manifest_fingerprint(entries)
+
+
+def load_tfrecord(serialized_example, img_size, num_channels):
+    """Função de leitura das imagens pré-processadas, guardadas nos shards TFRecord."""
+    features = {
+        'image': tf.io.FixedLenFeature([], tf.string),
+        'label': tf.io.FixedLenFeature([], tf.string),
+    }
+    example = tf.io.parse_single_example(serialized_example, features)
+    image = tf.io.decode_raw(example['image'], tf.uint8)
+    image = tf.reshape(image, [img_size, img_size, num_channels])
+    image = tf.cast(image, tf.float32)
+    return image
+
+
+def load_tfrecord_image_train(serialized_example, img_size, num_channels, use_jitter):
+    """Carrega uma imagem do dataset de treinamento a partir de um shard TFRecord."""
+    input_image = load_tfrecord(serialized_example, img_size, num_channels)
+    if use_jitter:
+        input_image = random_jitter(input_image, img_size, num_channels)
+    input_image = normalize(input_image)
+    return input_image
+
+
+def load_tfrecord_image_test(serialized_example, img_size, num_channels):
+    """Carrega uma imagem do dataset de teste / validação a partir de um shard TFRecord."""
+    input_image = load_tfrecord(serialized_example, img_size, num_channels)
+    input_image = normalize(input_image)
+    return input_image
+
+
+# -- Cache em disco (memmap uint8)
+
+
+def get_memmap_cache_path(cache_folder, dataset_name, split, img_size, num_channels, reduced_decoding=False):
+    """Retorna o caminho do cache memmap de um split do dataset para um dado IMG_SIZE"""
+    decoding = '_reduced' if reduced_decoding else ''
+    return cache_folder + f'{dataset_name}_{split}_{img_size}x{img_size}x{num_channels}{decoding}_uint8.npy'
+
+
+def load_uint8(record, img_size, num_channels, source_format='jpeg', reduced_decoding=False):
+    """Carrega uma imagem já redimensionada para IMG_SIZE, em uint8 (sem normalização)."""
+    if source_format == 'jpeg':
+        image = resize(load(record, img_size if reduced_decoding else None), img_size, img_size)
+    elif source_format == 'tfrecord':
+        image = load_tfrecord(record, img_size, num_channels)
+    else:
+        raise BaseException(f"Formato de dataset {source_format} desconhecido")
+    image = tf.cast(image, tf.uint8)
+    return image
+
+
+def decode_uint8_batches(files_ds, img_size, num_channels, source_format='jpeg', reduced_decoding=False):
+    """Retorna um dataset com as imagens decodificadas em paralelo, em uint8 e no tamanho IMG_SIZE, em batches de 64."""
+    if source_format == 'tfrecord':
+        records_ds = files_ds.interleave(tf.data.TFRecordDataset, num_parallel_calls=tf.data.AUTOTUNE)
+    else:
+        records_ds = files_ds
+    images_ds = records_ds.map(lambda x: load_uint8(x, img_size, num_channels, source_format, reduced_decoding), num_parallel_calls=tf.data.AUTOTUNE)
+    images_ds = images_ds.batch(64).prefetch(tf.data.AUTOTUNE)
+    return images_ds
+
+
+def build_memmap_cache(files_ds, cache_path, num_images, img_size, num_channels, source_format='jpeg', reduced_decoding=False,
+                       source_fingerprint=None):
+    """Cria (ou reaproveita) um cache .npy uint8 de shape (N, IMG_SIZE, IMG_SIZE, C) e o abre como memmap.
+
+    As imagens são decodificadas uma única vez. O arquivo é gravado com um nome temporário e renomeado
+    ao final, então um cache incompleto nunca é lido e várias execuções podem compartilhar o mesmo arquivo
+    (através do page cache do sistema operacional).
+    O source_fingerprint (ver get_manifest_fingerprint) é guardado em um arquivo .json ao lado do cache, e um cache
+    com outro fingerprint é recriado, mesmo com o shape correto (imagens editadas ou substituídas).
+    """
+    expected_shape = (num_images, img_size, img_size, num_channels)
+    fingerprint_path = cache_path + '.json'
+
+    # Se já existe um cache válido, apenas o abre
+    if os.path.exists(cache_path):
+        cache = np.load(cache_path, mmap_mode='r')
+        cached_fingerprint = None
+        if os.path.exists(fingerprint_path):
+            with open(fingerprint_path, 'r') as f:
+                cached_fingerprint = json.load(f).get('source_fingerprint')
+        if cache.shape != expected_shape or cache.dtype != np.uint8:
+            print(f"O cache {cache_path} tem shape {cache.shape}, esperado {expected_shape}. Recriando...")
+        elif source_fingerprint is not None and cached_fingerprint != source_fingerprint:
+            print(f"As imagens do dataset mudaram desde a criação do cache {cache_path}. Recriando...")
+        else:
+            return cache
+        del cache
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    # Decodifica as imagens em paralelo e grava no arquivo temporário
+    images_ds = decode_uint8_batches(files_ds, img_size, num_channels, source_format, reduced_decoding)
+
+    print(f"Criando o cache {cache_path}...")
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    cache = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=expected_shape)
+    c = 0
+    for images in images_ds:
+        n = images.shape[0]
+        cache[c:c + n] = images.numpy()
+        c += n
+    if c != num_images:
+        del cache
+        os.remove(tmp_path)
+        raise BaseException(f"Foram lidas {c} imagens para o cache, mas eram esperadas {num_images}")
+    cache.flush()
+    del cache
+    os.replace(tmp_path, cache_path)
+
+    # O fingerprint é gravado depois do cache: se a execução for interrompida entre os dois, o cache é recriado
+    tmp_fingerprint_path = f'{fingerprint_path}.{os.getpid()}.tmp'
+    with open(tmp_fingerprint_path, 'w') as f:
+        json.dump({'source_fingerprint': source_fingerprint}, f)
+    os.replace(tmp_fingerprint_path, fingerprint_path)
+
+    return np.load(cache_path, mmap_mode='r')
+
+
+def build_memory_cache(files_ds, img_size, num_channels, source_format='jpeg', reduced_decoding=False):
+    """Decodifica todas as imagens uma única vez para um array uint8 de shape (N, IMG_SIZE, IMG_SIZE, C) em memória.
+
+    É o cache do cache_mode='memory'. Ao contrário do dataset.cache(), que repete para sempre a ordem (e o jitter) da
+    primeira época, o array é lido pelo create_memmap_dataset, que embaralha os índices a cada época e aplica o jitter
+    depois do cache. Ocupa 1/4 da memória do cache em float32.
+    """
+    print("Criando o cache em memória...")
+    images = [batch.numpy() for batch in decode_uint8_batches(files_ds, img_size, num_channels, source_format, reduced_decoding)]
+    if len(images) == 0:
+        raise BaseException("Nenhuma imagem foi lida para o cache em memória")
+    return np.concatenate(images)
+
+
+def create_memmap_dataset(cache, img_size, num_channels, batch_size, use_jitter=False, shuffle=False, drop_remainder=False,
+                          batch_jitter=False):
+    """Cria o pipeline tf.data a partir de um cache uint8 (memmap ou array em memória).
+
+    O dataset percorre índices (embaralhados a cada época, se shuffle=True), e cada batch é lido do memmap
+    de uma vez e só então convertido para float32 e normalizado para [-1, 1].
+    Com batch_jitter=True o random jitter é aplicado ao batch inteiro (random_jitter_batch).
+    """
+    num_images = cache.shape[0]
+
+    def gather(indices):
+        # Ler os índices em ordem crescente melhora o acesso ao disco
+        return cache[np.sort(indices)]
+
+    def load_batch(indices):
+        images = tf.numpy_function(gather, [indices], tf.uint8)
+        images = tf.ensure_shape(images, [None, img_size, img_size, num_channels])
+        images = tf.cast(images, tf.float32)
+        if use_jitter and batch_jitter:
+            images = random_jitter_batch(images, img_size, num_channels)
+        elif use_jitter:
+            images = tf.map_fn(lambda image: random_jitter(image, img_size, num_channels), images)
+        images = normalize(images)
+        return images
+
+    dataset = tf.data.Dataset.range(num_images)
+    if shuffle:
+        dataset = dataset.shuffle(num_images, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+    dataset = dataset.map(load_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    return dataset
+
+
+# -- Cache em disco (tf.data)
+
+
+def get_file_cache_prefix(cache_folder, dataset_name, split, img_size, num_channels):
+    """Retorna o prefixo das pastas de cache tf.data de um split do dataset para um dado IMG_SIZE"""
+    return cache_folder + f'tfdata_{dataset_name}_{split}_{img_size}x{img_size}x{num_channels}'
+
+
+def get_preprocessing_hash(preprocessing_params):
+    """Calcula um hash do código de pré-processamento das imagens e dos parâmetros que afetam o resultado.
+
+    Qualquer alteração nas funções de leitura / pré-processamento muda o hash, e com isso invalida os caches antigos.
+    """
+    preprocessing_functions = [load, normalize, resize, random_crop, random_jitter, get_jitter_size, load_image_train, load_image_test,
+                               load_tfrecord, load_tfrecord_image_train, load_tfrecord_image_test]
+    sha = hashlib.sha1()
+    for function in preprocessing_functions:
+        sha.update(inspect.getsource(function).encode('utf-8'))
+    sha.update(repr(JPEG_DECODING_RATIOS).encode('utf-8'))
+    sha.update(repr(preprocessing_params).encode('utf-8'))
+    return sha.hexdigest()[:12]
+
+
+def acquire_file_lock(lock_path, stale_seconds=2 * 60 * 60):
+    """Tenta criar o arquivo de lock de forma atômica. Retorna True se o lock foi obtido.
+
+    Um lock mais antigo que stale_seconds é considerado abandonado (processo interrompido) e é removido.
+    """
+    if os.path.exists(lock_path) and time.time() - os.path.getmtime(lock_path) > stale_seconds:
+        print(f"Removendo o lock abandonado {lock_path}")
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(os.getpid()))
+    return True
+
+
+def release_file_lock(lock_path):
+    """Remove o arquivo de lock"""
+    try:
+        os.remove(lock_path)
+    except FileNotFoundError:
+        pass
+
+
+def read_cache_marker(complete_file):
+    """Lê o marcador COMPLETE de um cache em arquivo. Retorna um dicionário (vazio para marcadores antigos, só com a data)"""
+    with open(complete_file, 'r') as f:
+        try:
+            marker = json.load(f)
+        except json.JSONDecodeError:
+            return {}
+    return marker if isinstance(marker, dict) else {}
+
+
+def cache_to_file(dataset, cache_prefix, preprocessing_params, max_unused_days=7, source_fingerprint=None):
+    """Aplica um cache tf.data em arquivo, persistente entre execuções.
+
+    A pasta do cache é cache_prefix + parâmetros de pré-processamento + hash do código e dos parâmetros, então
+    configurações diferentes (jitter, decodificação reduzida etc.) têm pastas diferentes e convivem entre si.
+    Na primeira execução, o cache é preenchido aqui mesmo (uma passada completa pelo dataset) sob um lock; só depois
+    disso ele é marcado como completo e passa a ser lido. Se outra execução estiver criando o mesmo cache, o dataset
+    é usado sem cache.
+    Cada uso do cache atualiza a data do arquivo COMPLETE. Caches dos mesmos parâmetros mas de versões anteriores do
+    código só são removidos se não forem usados há mais de max_unused_days dias (None não remove nenhum).
+    O source_fingerprint (ver get_manifest_fingerprint) é guardado no COMPLETE, e um cache criado a partir de outros
+    arquivos (imagens adicionadas, removidas ou editadas) é recriado.
+    """
+    params_tag = '-'.join(f'{key}={value}' for key, value in preprocessing_params.items())
+    cache_dir = cache_prefix + '_' + params_tag + '_' + get_preprocessing_hash(preprocessing_params) + '/'
+    cache_file = cache_dir + 'cache'
+    complete_file = cache_dir + 'COMPLETE'
+    lock_file = cache_dir + 'LOCK'
+
+    # Cache pronto (execução "quente"): as imagens são lidas direto do cache, sem decodificação
+    if os.path.exists(complete_file):
+        if source_fingerprint is None or read_cache_marker(complete_file).get('source_fingerprint') == source_fingerprint:
+            os.utime(complete_file)
+            return dataset.cache(cache_file)
+        print(f"As imagens do dataset mudaram desde a criação do cache {cache_dir}.")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    if not acquire_file_lock(lock_file):
+        print(f"O cache {cache_dir} está sendo criado por outra execução. Usando o dataset sem cache.")
+        return dataset
+
+    try:
+        # O cache desatualizado deixa de ser marcado como completo antes de ser recriado
+        if os.path.exists(complete_file):
+            os.remove(complete_file)
+
+        # Remove caches de versões anteriores do pré-processamento (mesmos parâmetros) que não são usados há muito tempo
+        if max_unused_days is not None:
+            for old_cache_dir in tf.io.gfile.glob(cache_prefix + '_' + params_tag + '_*'):
+                old_cache_dir = old_cache_dir.rstrip('/\\') + '/'
+                if old_cache_dir == cache_dir or os.path.exists(old_cache_dir + 'LOCK'):
+                    continue
+                last_used = os.path.getmtime(old_cache_dir + 'COMPLETE' if os.path.exists(old_cache_dir + 'COMPLETE') else old_cache_dir)
+                if time.time() - last_used > max_unused_days * 24 * 60 * 60:
+                    print(f"Removendo o cache antigo {old_cache_dir}")
+                    shutil.rmtree(old_cache_dir, ignore_errors=True)
+
+        # Remove restos de uma criação interrompida e preenche o cache
+        for partial_file in tf.io.gfile.glob(cache_file + '*'):
+            os.remove(partial_file)
+        print(f"Criando o cache {cache_dir}...")
+        for _ in dataset.cache(cache_file).batch(256).prefetch(tf.data.AUTOTUNE):
+            pass
+        with open(complete_file, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'source_fingerprint': source_fingerprint}, f)
+    finally:
+        release_file_lock(lock_file)
+
+    return dataset.cache(cache_file)
+
+
+# -- Pipeline
+
+
+def create_image_dataset(files_ds, split, img_size, num_channels, batch_size, use_jitter=False, use_cache=False,
+                         shuffle_buffer=None, drop_remainder=False, deterministic=True, source_format='jpeg',
+                         cache_mode='memory', cache_path=None, num_images=None, reduced_decoding=False, batch_jitter=False,
+                         num_parallel_calls=tf.data.AUTOTUNE, source_fingerprint=None):
+    """Cria o pipeline tf.data de um split do dataset a partir de um dataset com os caminhos dos arquivos.
+
+    As imagens são lidas e decodificadas em paralelo (num_parallel_calls, AUTOTUNE por padrão) e o pipeline termina
+    com um prefetch, para que a leitura do próximo batch aconteça enquanto o modelo treina com o atual.
+    Com deterministic=False o tf.data pode entregar as imagens fora de ordem, evitando que uma imagem
+    lenta de decodificar segure as demais.
+    O split 'train' usa load_image_train (com random jitter, se for o caso), e os demais usam load_image_test.
+
+    Com source_format='tfrecord', files_ds deve conter os shards gerados pelo convert_dataset.py, que
+    são lidos de forma intercalada e já estão no tamanho IMG_SIZE (não há decodificação de JPEG).
+
+    O cache pode ser feito em um array uint8 em memória (cache_mode='memory', ver build_memory_cache) ou em um memmap uint8
+    no disco (cache_mode='memmap'), que é reaproveitado entre execuções. Nesse caso cache_path e num_images são obrigatórios,
+    e source_fingerprint valida o cache existente (ver build_memmap_cache). Nos dois modos o dataset percorre índices
+    embaralhados a cada época e o jitter é aplicado depois do cache (ver create_memmap_dataset).
+    Com cache_mode='file' o cache tf.data é gravado em disco e reaproveitado entre execuções (ver cache_to_file).
+    Nesse caso cache_path é o prefixo da pasta do cache (ver get_file_cache_prefix), e source_fingerprint também valida o cache.
+    O cache em arquivo repete a ordem da passada que o criou, então a partir daí o único embaralhamento é o shuffle_buffer.
+
+    Com reduced_decoding=True os JPEGs são decodificados já reduzidos pelo decodificador (ver load).
+
+    Com batch_jitter=True o random jitter do treino é feito depois do batch(), de forma vetorizada (random_jitter_batch),
+    e as imagens são lidas e guardadas no cache sem aumento de dados. Assim o cache não congela um único corte por imagem.
+    Como nos caches em memória / memmap e nos TFRecords, o jitter parte das imagens já reduzidas para IMG_SIZE, e não do
+    JPEG original como no load_image_train (ver random_jitter_batch).
+    """
+    if use_cache and cache_mode in ['memmap', 'memory']:
+        if cache_mode == 'memmap':
+            cache = build_memmap_cache(files_ds, cache_path, num_images, img_size, num_channels, source_format, reduced_decoding,
+                                       source_fingerprint)
+        else:
+            cache = build_memory_cache(files_ds, img_size, num_channels, source_format, reduced_decoding)
+        return create_memmap_dataset(cache, img_size, num_channels, batch_size, use_jitter=(use_jitter and split == 'train'),
+                                     shuffle=bool(shuffle_buffer), drop_remainder=drop_remainder, batch_jitter=batch_jitter)
+
+    # Com o jitter em batch, a leitura de cada imagem é feita sem jitter
+    image_jitter = use_jitter and not batch_jitter
+
+    if source_format == 'jpeg':
+        if split == 'train':
+            def load_fn(image_file):
+                return load_image_train(image_file, img_size, num_channels, image_jitter, reduced_decoding)
+        else:
+            def load_fn(image_file):
+                return load_image_test(image_file, img_size, reduced_decoding)
+        records_ds = files_ds
+
+    elif source_format == 'tfrecord':
+        if split == 'train':
+            def load_fn(serialized_example):
+                return load_tfrecord_image_train(serialized_example, img_size, num_channels, image_jitter)
+        else:
+            def load_fn(serialized_example):
+                return load_tfrecord_image_test(serialized_example, img_size, num_channels)
+        records_ds = files_ds.interleave(tf.data.TFRecordDataset, num_parallel_calls=num_parallel_calls, deterministic=deterministic)
+
+    else:
+        raise BaseException(f"Formato de dataset {source_format} desconhecido")
+
+    # O decode_jpeg não define o número de canais no grafo, e os passos de treinamento têm o formato das imagens fixo
+    dataset = records_ds.map(lambda record: tf.ensure_shape(load_fn(record), [img_size, img_size, num_channels]),
+                             num_parallel_calls=num_parallel_calls, deterministic=deterministic)
+    if use_cache and cache_mode == 'file':
+        preprocessing_params = {'split': 'train' if split == 'train' else 'test', 'use_jitter': image_jitter and split == 'train',
+                                'source_format': source_format, 'reduced_decoding': reduced_decoding}
+        dataset = cache_to_file(dataset, cache_path, preprocessing_params, source_fingerprint=source_fingerprint)
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer)
+    dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+    if use_jitter and batch_jitter and split == 'train':
+        dataset = dataset.map(lambda images: random_jitter_batch(images, img_size, num_channels),
+                              num_parallel_calls=num_parallel_calls, deterministic=deterministic)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    return dataset
+
+
+# -- Comparações
+
+
+def compare_reduced_decoding(file_pattern, img_size, num_images=100):
+    """Compara a decodificação reduzida do JPEG (load com min_size) com a decodificação completa.
+
+    Para cada imagem, as duas versões são redimensionadas para IMG_SIZE (como no load_image_test) e comparadas
+    pixel a pixel, na escala [0, 255]. Também mede o tempo médio de decodificação de cada caminho.
+    """
+    image_files = sorted(tf.io.gfile.glob(file_pattern))[:num_images]
+
+    abs_diffs = []
+    max_diffs = []
+    psnrs = []
+    time_full = 0
+    time_reduced = 0
+    for image_file in image_files:
+        t = time.perf_counter()
+        image_full = resize(load(image_file), img_size, img_size)
+        time_full += time.perf_counter() - t
+
+        t = time.perf_counter()
+        image_reduced = resize(load(image_file, img_size), img_size, img_size)
+        time_reduced += time.perf_counter() - t
+
+        diff = tf.abs(image_full - image_reduced)
+        abs_diffs.append(float(tf.reduce_mean(diff)))
+        max_diffs.append(float(tf.reduce_max(diff)))
+        psnrs.append(float(tf.image.psnr(image_full, image_reduced, max_val=255.0)))
+
+    results = {
+        'num_images': len(image_files),
+        'mean_abs_diff': np.mean(abs_diffs),
+        'max_abs_diff': np.max(max_diffs),
+        'mean_psnr': np.mean(psnrs),
+        'mean_decode_time_full': time_full / len(image_files),
+        'mean_decode_time_reduced': time_reduced / len(image_files),
+    }
+    return results
+
+
+def compare_jitter_throughput(img_size, num_channels, batch_size, num_batches=200, num_images=256):
+    """Compara a vazão (imagens / s) do random jitter por imagem (random_jitter no map, antes do batch)
+    com a do random jitter em batch (random_jitter_batch no map, depois do batch).
+
+    As imagens são geradas aleatoriamente em memória, para medir apenas a etapa de aumento de dados.
+    """
+    images = tf.random.uniform([num_images, img_size, img_size, num_channels], -1, 1)
+
+    per_image_ds = tf.data.Dataset.from_tensor_slices(images).repeat()
+    per_image_ds = per_image_ds.map(lambda image: random_jitter(image, img_size, num_channels), num_parallel_calls=tf.data.AUTOTUNE)
+    per_image_ds = per_image_ds.batch(batch_size).take(num_batches).prefetch(tf.data.AUTOTUNE)
+
+    batched_ds = tf.data.Dataset.from_tensor_slices(images).repeat().batch(batch_size)
+    batched_ds = batched_ds.map(lambda batch: random_jitter_batch(batch, img_size, num_channels), num_parallel_calls=tf.data.AUTOTUNE)
+    batched_ds = batched_ds.take(num_batches).prefetch(tf.data.AUTOTUNE)
+
+    results = {}
+    for name, dataset in [('per_image', per_image_ds), ('batched', batched_ds)]:
+        # Aquecimento (tracing das funções)
+        for _ in dataset.take(5):
+            pass
+        t = time.perf_counter()
+        for _ in dataset:
+            pass
+        results[name] = num_batches * batch_size / (time.perf_counter() - t)
+    return results
+
+
 # %% TRATAMENTO DE EXCEÇÕES
 
 
@@ -251,3 +1150,27 @@ class SizeCompatibilityError(Exception):
 class TransferUpsampleError(Exception):
     def __init__(self, upsample):
         print(f"Tipo de upsampling {upsample} não definido")
+
+
+# %% TESTE
+
+if __name__ == "__main__":
+
+    root_path = '../../0_Datasets/celeba_hq/train/'
+
+    # DECODIFICAÇÃO REDUZIDA DO JPEG
+    for IMG_SIZE in [128, 256]:
+        print(f"\nComparando a decodificação reduzida com a completa (IMG_SIZE = {IMG_SIZE})")
+        results = compare_reduced_decoding(root_path + '*/*.jpg', IMG_SIZE)
+        print(f"Imagens avaliadas: {results['num_images']}")
+        print(f"Diferença absoluta média: {results['mean_abs_diff']:.2f} (máxima: {results['max_abs_diff']:.0f})")
+        print(f"PSNR médio: {results['mean_psnr']:.2f} dB")
+        print(f"Tempo médio de decodificação: completa = {results['mean_decode_time_full'] * 1000:.2f} ms, "
+              f"reduzida = {results['mean_decode_time_reduced'] * 1000:.2f} ms")
+
+    # RANDOM JITTER POR IMAGEM x EM BATCH
+    for IMG_SIZE in [128, 256]:
+        print(f"\nComparando o random jitter por imagem com o random jitter em batch (IMG_SIZE = {IMG_SIZE})")
+        results = compare_jitter_throughput(IMG_SIZE, 3, batch_size=16)
+        print(f"Por imagem: {results['per_image']:.0f} imagens/s")
+        print(f"Em batch: {results['batched']:.0f} imagens/s")